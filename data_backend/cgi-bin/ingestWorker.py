@@ -0,0 +1,142 @@
+#!/usr/bin/python3.10
+"""
+Background half of rockblockService.py's ack-then-process ingestion.
+
+A request only runs rockblockIngest.accept, which makes the delivery
+durable in the transmission log, then calls notify(serial) and answers.
+This worker thread then, for each serial it was told about:
+
+  1. replays the serial's log past its cursor (cursorFile, {serial: seq})
+     and runs rockblockIngest.process on each message: the legacy CSV, the
+     catalog row, the MOMSN ledger and the status snapshot
+  2. runs updateScript --serial <sn> ... as a separate process, which brings
+     just those serials' store, rollups, raw archive and plot up to date
+
+Serials notified while a round is running are merged into the next one,
+so a burst of deliveries costs one update run. The log is the queue and
+the cursor is its read position: at start every serial is replayed past
+its cursor, so messages acknowledged just before a crash or restart are
+still processed. The first start takes everything already in the log as
+processed (rockblock.py did that synchronously).
+
+A round that fails (the log can't be read, the cursor can't be written, the
+update exits non-zero) advances nothing past the cursor on disk: its serials
+go back into the queue and are retried after retrySeconds, doubling up to
+maxRetrySeconds while the failures go on.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import rockblockIngest
+import transmissionLog
+import metrics
+
+#update-data-2023.py takes over from here; None (or OBS_UPDATE_SCRIPT set
+#empty) leaves it to cron
+updateScript = os.environ.get('OBS_UPDATE_SCRIPT',
+                              os.path.join(rockblockIngest.libPath, 'update-data-2023.py')) or None
+retrySeconds = 1
+maxRetrySeconds = 300
+
+
+def _load(fileName):
+    try:
+        with open(fileName) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _dump(obj, fileName):
+    tmp = fileName + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(obj, file)
+    os.replace(tmp, fileName)
+
+
+class IngestWorker(threading.Thread):
+    def __init__(self, dataPath, walDir, catalogFile, statusDir, cursorFile,
+                 ledgerDir=rockblockIngest.ledgerDir):
+        super().__init__(daemon=True)
+        self.dataPath = dataPath
+        self.walDir = walDir
+        self.catalogFile = catalogFile
+        self.statusDir = statusDir
+        self.cursorFile = cursorFile
+        self.ledgerDir = ledgerDir
+        self.cond = threading.Condition()
+        self.pending = {}    #serial -> perf_counter of the oldest waiting ack, None on recovery
+
+        self.cursors = _load(cursorFile)
+        if self.cursors is None:
+            os.makedirs(os.path.dirname(cursorFile) or '.', exist_ok=True)
+            self.cursors = {sn: transmissionLog.lastSeq(walDir, sn)
+                            for sn in transmissionLog.listSerials(walDir)}
+            _dump(self.cursors, cursorFile)
+        for sn in transmissionLog.listSerials(walDir):
+            if transmissionLog.lastSeq(walDir, sn) > self.cursors.get(sn, 0):
+                self.pending[sn] = None
+
+    def notify(self, serial, acceptedAt=None):
+        with self.cond:
+            serial = str(serial)
+            if self.pending.get(serial) is None:
+                self.pending[serial] = acceptedAt
+            self.cond.notify()
+
+    def requeue(self, batch):
+        #merge a failed round back in, keeping the oldest ack time
+        with self.cond:
+            for serial, acceptedAt in batch.items():
+                waiting = self.pending.setdefault(serial, acceptedAt)
+                if acceptedAt is not None and (waiting is None or acceptedAt < waiting):
+                    self.pending[serial] = acceptedAt
+
+    def run(self):
+        delay = retrySeconds
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch, self.pending = self.pending, {}
+            try:
+                self.processSerials(batch)
+                delay = retrySeconds
+            except Exception:
+                #keep serving; only what the cursor file says is done is done
+                rockblockIngest.logFailure(f"worker: {sorted(batch)}", rockblockIngest.newTimeString(),
+                                           self.dataPath)
+                self.cursors = _load(self.cursorFile) or self.cursors
+                self.requeue(batch)
+                metrics.flush()
+                time.sleep(delay)
+                delay = min(2*delay, maxRetrySeconds)
+                continue
+            metrics.flush()
+
+    def processSerials(self, batch):
+        for sn in sorted(batch):
+            for seq, fields in transmissionLog.replayMessages(self.walDir, sn, self.cursors.get(sn, 0) + 1):
+                try:
+                    rockblockIngest.process(fields, fields.get('received'), seq, self.dataPath,
+                                            self.catalogFile, self.statusDir, self.ledgerDir)
+                except Exception:
+                    rockblockIngest.logFailure(str(fields), fields.get('received'), self.dataPath)
+                self.cursors[sn] = seq
+            _dump(self.cursors, self.cursorFile)
+
+        if updateScript:
+            args = [sys.executable, updateScript]
+            for sn in sorted(batch):
+                args += ['--serial', sn]
+            with metrics.timer('obs_update_seconds', stage='worker'):
+                subprocess.run(args, cwd=os.path.dirname(updateScript), check=True)
+
+        #how long after the ack the site had the data
+        now = time.perf_counter()
+        for sn, acceptedAt in batch.items():
+            if acceptedAt is not None:
+                metrics.observe('obs_publish_seconds', now - acceptedAt)
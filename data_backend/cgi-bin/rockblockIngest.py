@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""
+Shared handling of one RockBLOCK delivery, used by the CGI script
+(rockblock.py) and the long running service (rockblockService.py).
+
+accept() only needs the transmission log and the dedupe index. The catalog,
+status snapshot (numpy), ledger and metrics modules are imported where
+they're used, so a request that is only accepted doesn't load them.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import struct
+from datetime import datetime
+
+#OBS_DATA_PATH moves all of it, e.g. for a test instance (scripts/loadTest.py)
+dataPath = os.environ.get('OBS_DATA_PATH', "/srv/data")
+walDir = dataPath + "/wal"
+catalogFile = dataPath + "/catalog.sqlite"
+statusDir = dataPath + "/status"
+dedupeFile = dataPath + "/dedupe"
+ledgerDir = dataPath + "/ledger"
+#the per-message CSVs are still what update-data.py/email-report.py read
+writeCsv = True
+
+#the storage modules live with the update scripts
+libPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+sys.path.insert(0, libPath)
+import transmissionLog
+import dedupeIndex
+
+formFields = ["imei", "serial", "momsn", "transmit_time", "iridium_latitude",
+              "iridium_longitude", "iridium_cep", "data"]
+labels = ["UnixTime","Pressure[bar_1E-4]","Ambient[DN]","Backscatter[DN]","WaterTemp[C_1E-2]"]
+recordStruct = struct.Struct("<2L2Hh")
+
+#serial directories we already know exist, so a warm process skips makedirs
+knownDirs = set()
+logs = {}
+catalogs = {}
+
+
+def getLog(walDir=walDir):
+    #one writer per log directory per process, kept open while we're warm
+    if walDir not in logs:
+        logs[walDir] = transmissionLog.TransmissionLog(walDir)
+    return logs[walDir]
+
+
+def getCatalog(catalogFile=catalogFile):
+    import transmissionCatalog
+    if catalogFile not in catalogs:
+        catalogs[catalogFile] = transmissionCatalog.TransmissionCatalog(catalogFile)
+    return catalogs[catalogFile]
+
+
+def unpackLegacy(hexData):
+    #Interpret the data as bytes.
+    byteArray = bytes.fromhex(hexData)
+
+    #nibble the first two bytes as the battery int.
+    batteryVolts = (byteArray[1]<<8 | byteArray[0]) / 1023 * 5
+    byteArray = byteArray[:-2] #first time is incorrect because of bad byte packing (overlapping time and volts). We can infer from the second two times.
+
+    #Create iterable for unpacking one line of data at a time.
+    #Will catch here if the data format is incorrect.
+    records = [list(line) for line in recordStruct.iter_unpack(byteArray)]
+
+    #first record's time is corrupted by the battery bytes, so we fix it using the second and third
+    time0 = records[1][0] - (records[2][0]-records[1][0])
+    records[0][0] = time0
+    return batteryVolts, records
+
+
+def handleMessage(fields, timeString, dataPath=dataPath, walDir=walDir, catalogFile=catalogFile,
+                  statusDir=statusDir, dedupeFile=dedupeFile, ledgerDir=ledgerDir):
+    """
+    Append one delivery to the transmission log, then (if writeCsv) decode
+    it to dataPath/<serial>/<timeString>_<momsn>.csv, add it to the catalog
+    and the MOMSN ledger and merge it into the serial's status snapshot for
+    the email report.
+    fields maps the RockBLOCK form names to strings. Raises if the payload
+    can't be decoded, after the raw delivery is already safe in the log and
+    cataloged. A redelivery of a message we already have (same imei and
+    momsn) is dropped and returns None.
+    """
+    start = time.perf_counter()
+    outcome = 'failed'
+    try:
+        seq = accept(fields, timeString, walDir, dedupeFile)
+        if seq is None:
+            outcome = 'duplicate'
+            return None
+        location = process(fields, timeString, seq, dataPath, catalogFile, statusDir, ledgerDir)
+        outcome = 'stored'
+        return location
+    finally:
+        seconds = time.perf_counter() - start
+        import metrics
+        metrics.observe('obs_ingest_seconds', seconds, outcome=outcome)
+        metrics.inc('obs_ingest_total', outcome=outcome)
+
+
+def accept(fields, timeString, walDir=walDir, dedupeFile=dedupeFile):
+    """
+    The part of a delivery that has to happen before we acknowledge it:
+    drop redeliveries and make the message durable in the transmission log.
+    Returns its sequence number, or None for a redelivery.
+    The key goes into the dedupe index only once the record is fsynced, so
+    a kill in between can't drop the message; at worst the log holds it
+    twice, which the series store's compact() drops.
+    """
+    #RockBLOCK redelivers when we're slow to answer
+    key = dedupeIndex.messageKey(fields.get('imei'), fields.get('momsn'), fields.get('data'))
+    with dedupeIndex.DedupeIndex(dedupeFile) as index:
+        if index.get(key) is not None:
+            return None
+
+    record = dict(fields, received=timeString)
+    seq = getLog(walDir).appendMessage(record)
+    with dedupeIndex.DedupeIndex(dedupeFile) as index:
+        if index.add(key, timeString) is not None:
+            #a redelivery raced us here, whoever added the key handles it
+            return None
+    return seq
+
+
+def process(fields, timeString, seq, dataPath=dataPath, catalogFile=catalogFile, statusDir=statusDir,
+            ledgerDir=ledgerDir):
+    """
+    The rest of a delivery, once it is in the log as seq: the legacy CSV,
+    the catalog row, the MOMSN ledger and the status snapshot. Returns
+    where it was stored.
+    """
+    import statusSnapshot
+    import momsnLedger
+    import metrics
+    #counted here rather than in accept(), the same record appendMessage wrote
+    metrics.inc('obs_bytes_written_total', transmissionLog.header.size +
+                len(json.dumps(dict(fields, received=timeString), separators=(',', ':'))), kind='wal')
+    location = f"wal:{fields['serial']}:{seq}"
+    batteryVolts = None
+    try:
+        if writeCsv:
+            batteryVolts, records = unpackLegacy(fields["data"])
+            location = writeLegacyCsv(fields, timeString, batteryVolts, records, dataPath)
+            metrics.inc('obs_bytes_written_total', metrics.fileBytes(location), kind='csv')
+    finally:
+        getCatalog(catalogFile).add(fields, location, timeString, batteryVolts)
+        if fields.get('imei') and fields.get('momsn') not in (None, ''):
+            momsnLedger.add(ledgerDir, fields['imei'], fields['momsn'], timeString, fields.get('serial'))
+    if batteryVolts is not None:
+        statusSnapshot.update(statusDir, int(fields['serial']), [r+[batteryVolts] for r in records],
+                              fields.get('iridium_latitude'), fields.get('iridium_longitude'),
+                              timeString, batteryVolts)
+    return location
+
+
+def writeLegacyCsv(fields, timeString, batteryVolts, records, dataPath=dataPath):
+    filePath = f"{dataPath}/{fields['serial']}"
+    if filePath not in knownDirs:
+        os.makedirs(filePath, exist_ok=True)
+        knownDirs.add(filePath)
+
+    #momsn keeps two deliveries in the same second from overwriting each other
+    fileName = filePath+f"/{timeString}_{fields['momsn']}.csv"
+    with open(fileName,'w') as file:
+        write = csv.writer(file)
+        write.writerow([f"imei: {fields['imei']}"])
+        write.writerow([f"serial: {fields['serial']}"])
+        write.writerow([f"transmit time: {fields['transmit_time']}"])
+        write.writerow([f"latitude: {fields['iridium_latitude']}"])
+        write.writerow([f"longitude: {fields['iridium_longitude']}"])
+        write.writerow([f"cep: {fields['iridium_cep']}"])
+        write.writerow([f"battery: {batteryVolts}"])
+        write.writerow(labels)
+        write.writerows(records)
+    return fileName
+
+
+def logFailure(raw, timeString, dataPath=dataPath):
+    #log the raw input data if anything went wrong.
+    with open(dataPath+'/log.txt','a') as file:
+        file.write(f"{timeString}: {raw}\n\n")
+
+
+def newTimeString():
+    return datetime.now().strftime('%Y%m%d%H%M%S')
@@ -0,0 +1,152 @@
+#!/usr/bin/python3.10
+"""
+Long running RockBLOCK endpoint. Does the same job as rockblock.py but as a
+WSGI application, so the interpreter, imports and per-serial directory
+cache stay warm between deliveries instead of being rebuilt per request.
+
+A delivery is acknowledged as soon as it is durable in the transmission
+log. Decoding and everything downstream of it happen in ingestWorker.py,
+which updates only the serials that got data, within seconds.
+
+Run under any WSGI server (e.g. gunicorn rockblockService:application) or
+stand-alone for testing:
+    python rockblockService.py [port] [dataPath] [walDir]
+then
+    curl -d "imei=300434&serial=209175&momsn=1&data=..." localhost:8080/
+A GET of /metrics returns the Prometheus text from metrics.py, and a GET
+of /status the delivery summary of every modem from momsnLedger.py
+(?days=N for the last N days, default statusDays).
+"""
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+import rockblockIngest
+import metrics
+import ingestWorker
+import momsnLedger
+
+dataPath = rockblockIngest.dataPath
+walDir = rockblockIngest.walDir
+catalogFile = rockblockIngest.catalogFile
+statusDir = rockblockIngest.statusDir
+dedupeFile = rockblockIngest.dedupeFile
+ledgerDir = rockblockIngest.ledgerDir
+statusDays = 7
+#the worker's position in the transmission log
+cursorFile = rockblockIngest.dataPath + '/ingest-cursor.json'
+#request metrics are merged into the metrics file this often rather than
+#per request, a flush locks the file and rewrites two files
+flushSeconds = 5
+
+worker = None
+workerLock = threading.Lock()
+
+
+def getWorker():
+    #started by the first request, so it also runs under a WSGI server
+    global worker
+    with workerLock:
+        if worker is None:
+            worker = ingestWorker.IngestWorker(dataPath, walDir, catalogFile, statusDir, cursorFile,
+                                               ledgerDir)
+            worker.start()
+            threading.Thread(target=flushMetrics, daemon=True).start()
+        return worker
+
+
+def flushMetrics():
+    while True:
+        time.sleep(flushSeconds)
+        metrics.flush()
+
+
+def readForm(environ):
+    #RockBLOCK posts application/x-www-form-urlencoded, but accept a query
+    #string too like cgi.FieldStorage did.
+    query = environ.get('QUERY_STRING', '')
+    body = ''
+    if environ.get('REQUEST_METHOD') == 'POST':
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length).decode('latin-1')
+    form = parse_qs(query)
+    for k, v in parse_qs(body).items():
+        form.setdefault(k, []).extend(v)
+    return {f: form[f][0] if f in form else None for f in rockblockIngest.formFields}
+
+
+def application(environ, start_response):
+    if environ.get('REQUEST_METHOD') == 'GET' and environ.get('PATH_INFO') == '/metrics':
+        metrics.flush()
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [metrics.read().encode()]
+    if environ.get('REQUEST_METHOD') == 'GET' and environ.get('PATH_INFO') == '/status':
+        return status(environ, start_response)
+
+    timeString = rockblockIngest.newTimeString()
+    fields = readForm(environ)
+
+    if fields["imei"] is None:
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return [b"missing imei"]
+
+    start = time.perf_counter()
+    outcome = 'failed'
+    try:
+        seq = rockblockIngest.accept(fields, timeString, walDir, dedupeFile)
+        outcome = 'duplicate' if seq is None else 'queued'
+        if seq is not None:
+            getWorker().notify(fields['serial'], start)
+    except Exception:
+        #same as the CGI script: acknowledge anyway and keep the raw form
+        rockblockIngest.logFailure(str(fields), timeString, dataPath)
+    metrics.observe('obs_ingest_seconds', time.perf_counter() - start, outcome=outcome)
+    metrics.inc('obs_ingest_total', outcome=outcome)
+
+    start_response('200 OK', [('Content-Type', 'text/html')])
+    return [b"OK"]
+
+
+def status(environ, start_response):
+    try:
+        days = int(parse_qs(environ.get('QUERY_STRING', '')).get('days', [statusDays])[0])
+    except ValueError:
+        days = statusDays
+    firstDay = (datetime.now() - timedelta(days=days)).strftime('%Y%m%d')
+    body = {imei: ledger.summary(firstDay) for imei, ledger in momsnLedger.loadAll(ledgerDir).items()}
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(body).encode()]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=8080, host=''):
+    getWorker()
+    server = make_server(host, port, application, ThreadingWSGIServer, QuietHandler)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        dataPath = sys.argv[2]
+        walDir = sys.argv[3] if len(sys.argv) > 3 else dataPath + '/wal'
+        catalogFile = dataPath + '/catalog.sqlite'
+        statusDir = dataPath + '/status'
+        dedupeFile = dataPath + '/dedupe'
+        ledgerDir = dataPath + '/ledger'
+        cursorFile = dataPath + '/ingest-cursor.json'
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
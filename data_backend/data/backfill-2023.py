@@ -0,0 +1,364 @@
+#!/usr/bin/python3.10
+"""
+Rebuild unpackedDir, the series store (with its rollups), the chart tiles
+and the long per-serial CSVs from the whole raw archive and transmission
+log, e.g. after a conversion in derived.py changed.
+
+    python backfill-2023.py [--dry-run] [--from-archive] [processes]
+
+The archive is split into chunks of one serial and one month of receive
+time. Chunks are decoded and derived in parallel, and each serial's
+chunks are appended to the new store strictly in chunk order, so the
+result doesn't depend on which worker finished first.
+
+Everything, the chart tiles included, is built next to the live
+directories (<dir>.backfill) and swapped in at the end, so no tile of the
+old build outlives it; the old ones are kept as <dir>.pre-backfill-<time>.
+The swap is written to <storeDir>.backfill-swap.json before any directory
+moves, and a run that finds that file finishes the swap first, so a crash
+can't leave a new store next to an old manifest. The chunk plan (the
+transmissions of each chunk, by raw file name and transmission log seq
+range) and the progress through it are kept in <storeDir>.backfill
+(plan.json, progress.json), so running the command again after an
+interruption carries on where it stopped. It holds update-data-2023.py's
+run lock throughout, so transmissions that arrive while it runs wait for
+the next update-data-2023.py run after it.
+
+--dry-run decodes everything and reports what it found without writing.
+
+--from-archive decodes the binary rawArchive.py instead of the raw text
+files and transmission log, straight from memmaps over it, in chunks of
+archiveChunkRows payloads. The archive holds exactly what update-data-2023.py
+has taken in, so the manifest and dedupe index are carried over as they are.
+"""
+import os
+import sys
+import json
+import shutil
+import time
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import ingestManifest
+import unpackBatch
+import dedupeIndex
+import seriesStore
+import rollups
+import tiles
+import qcFlags
+import rawArchive
+import transmissionLog
+import metrics
+
+os.umask(0)
+
+rawDir = '/Users/Ted/Documents/IridiumDump/raw'
+unpackedDir = '/Users/Ted/Documents/IridiumDump/unpacked'
+assetDir = '/Users/Ted/Documents/IridiumDump/full-files'
+storeDir = '/Users/Ted/Documents/IridiumDump/store'
+walDir = '/Users/Ted/Documents/IridiumDump/wal'
+archiveDir = '/Users/Ted/Documents/IridiumDump/archive'
+# rawDir = '/srv/data/IridiumDump/raw'
+# unpackedDir = '/srv/data/IridiumDump/unpacked'
+# assetDir = '/var/www/html/assets'
+# storeDir = '/srv/data/IridiumDump/store'
+# walDir = '/srv/data/wal'
+# archiveDir = '/srv/data/IridiumDump/archive'
+calibrationFile = os.path.join(unpackedDir,'calibration.json')
+tileDir = os.path.join(assetDir,'tiles')
+#as update-data-2023.py, clear of update-data.py's <sn>.csv
+assetSuffix = '_2023'
+exportCsv = True
+archiveChunkRows = 1 << 14
+
+workStore = storeDir + '.backfill'
+workUnpacked = unpackedDir + '.backfill'
+workTiles = tileDir + '.backfill'
+planFile = os.path.join(workStore,'plan.json')
+progressFile = os.path.join(workStore,'progress.json')
+swapFile = storeDir + '.backfill-swap.json'
+
+
+def chunkKey(sn, name):
+    #names start with the receive time, YYYYmmddHHMMSS
+    month = name[:6] if name[:6].isdigit() else 'other'
+    return f"{sn}/{month}"
+
+
+def seqRanges(seqs):
+    #[first, last] runs of consecutive sequence numbers
+    out = []
+    for seq in seqs:
+        if out and out[-1][1] == seq - 1:
+            out[-1][1] = seq
+        else:
+            out.append([seq, seq])
+    return out
+
+
+def makePlan(dedupeFile):
+    """
+    Chunks of {'raw': [sn/name], 'wal': [[sn, first seq, last seq]]}, in
+    chunk order; runChunk reads the payloads again. Redeliveries are dropped
+    here, in one pass in archive order, and recorded in dedupeFile.
+    """
+    manifest = ingestManifest.IngestManifest(rawDir,os.path.join(workUnpacked,'.manifest'))
+    entries = manifest.newEntries()
+    walMessages = manifest.newWalMessages(walDir)
+    chunks = {}
+    walSeqs = {}
+    duplicates = 0
+    with dedupeIndex.DedupeIndex(dedupeFile) as dedupe:
+        for sn, name, size, mtime in sorted(entries):
+            header, dataString = unpackBatch.readRaw(os.path.join(rawDir,sn,name))
+            key = dedupeIndex.messageKey(header.get('imei') or sn,header.get('momsn'),dataString)
+            if dedupe.isDuplicate(key,os.path.join(sn,name)):
+                duplicates += 1
+                continue
+            chunks.setdefault(chunkKey(sn,name),{'raw': [], 'wal': []})['raw'].append(os.path.join(sn,name))
+        for sn, seq, fields in walMessages:
+            dataString = (fields.get('data') or "").strip()
+            key = dedupeIndex.messageKey(fields.get('imei') or sn,fields.get('momsn'),dataString)
+            if dedupe.isDuplicate(key,f"wal:{sn}:{seq}"):
+                duplicates += 1
+                continue
+            chunk = chunkKey(sn,unpackBatch.walName(fields))
+            chunks.setdefault(chunk,{'raw': [], 'wal': []})
+            walSeqs.setdefault(chunk,[]).append(seq)
+    for chunk, seqs in walSeqs.items():
+        sn = chunk.split('/')[0]
+        chunks[chunk]['wal'] = [[sn, first, last] for first, last in seqRanges(seqs)]
+    print(f"{duplicates} duplicate transmissions dropped")
+    return {'chunks': [[key, chunks[key]] for key in sorted(chunks)],
+            'entries': entries,
+            'pendingDirs': manifest.pendingDirs,
+            'pendingWal': manifest.pendingWal}
+
+
+def makeArchivePlan(dedupeFile):
+    """Chunks of rows of the archive, as [sn, payload length, start, stop]."""
+    chunks = []
+    for sn in rawArchive.listSerials(archiveDir):
+        archive = rawArchive.RawArchive(archiveDir,sn)
+        for n in archive.lengths():
+            rows = archive.rows(n)
+            for start in range(0,rows,archiveChunkRows):
+                chunks.append([f"{sn}/{n:04d}/{start:010d}", [sn, n, start, min(rows,start+archiveChunkRows)]])
+    #the live index already holds everything in the archive
+    liveDedupe = os.path.join(storeDir,'dedupe')
+    for ext in ('', '.db', '.dat', '.dir', '.bak', '.pag'):
+        if os.path.exists(liveDedupe + ext):
+            shutil.copy2(liveDedupe + ext,dedupeFile + ext)
+    return {'chunks': chunks, 'source': 'archive'}
+
+
+def save(obj, fileName):
+    tmp = fileName + '.tmp'
+    with open(tmp,'w') as file:
+        json.dump(obj,file)
+    os.replace(tmp,fileName)
+
+
+def load(fileName):
+    with open(fileName) as file:
+        return json.load(file)
+
+
+def chunkSize(items, source='raw'):
+    if source == 'archive':
+        return items[3] - items[2]
+    return len(items['raw']) + sum(last - first + 1 for sn, first, last in items['wal'])
+
+
+def readChunk(items):
+    """[unpacked name, hex payload] of a chunk of the plan, in name order."""
+    out = []
+    for name in items['raw']:
+        header, dataString = unpackBatch.readRaw(os.path.join(rawDir,name))
+        out.append([name, dataString])
+    for sn, first, last in items['wal']:
+        for seq, fields in transmissionLog.replayMessages(walDir,sn,first):
+            if seq > last:
+                break
+            out.append([os.path.join(sn,unpackBatch.walName(fields)), (fields.get('data') or "").strip()])
+    return sorted(out)
+
+
+def runChunk(items, write, source='raw'):
+    start = time.perf_counter()
+    if source == 'archive':
+        #decoded in place from a memmap over the chunk's rows
+        sn, n, first, stop = items
+        archive = rawArchive.RawArchive(archiveDir,sn)
+        files = [os.path.join(workUnpacked,sn,name.decode()) for name in archive.metadata(n,first,stop)['name']]
+        counts, out = unpackBatch.runSlices([(files, archive.packets(n,first,stop))],calibrationFile,write)
+    else:
+        candidates = [(os.path.join(workUnpacked,name),dataString) for name, dataString in readChunk(items)]
+        counts, out = unpackBatch.runChunk(candidates,calibrationFile,write)
+        files = [f for f, d in candidates]
+    seconds = time.perf_counter() - start
+    #workers report their own timings, the parent only sees the results
+    nRecords = sum(len(cols['time']) for cols in out.values())
+    metrics.observe('obs_decode_seconds',seconds,stage='backfill')
+    metrics.gauge('obs_records_per_second',round(nRecords/max(seconds,1e-9)),stage='backfill')
+    for name, n in counts.items():
+        metrics.inc('obs_transmissions_total',n,format=name,stage='backfill')
+    if write:
+        metrics.inc('obs_bytes_written_total',sum(metrics.fileBytes(f) for f in files),kind='unpacked')
+    metrics.flush()
+    return counts, out
+
+
+def resume(progress):
+    #an interrupted run can have appended a chunk to a serial's store without
+    #recording it. Chunks go in strictly in order, so it was the next one.
+    for sn in seriesStore.listSerials(workStore):
+        rows = seriesStore.SeriesStore(workStore,sn).rows
+        if rows != progress['rows'].get(sn,0):
+            progress['done'][sn] = progress['done'].get(sn,0) + 1
+            progress['rows'][sn] = rows
+
+
+def finishSwap():
+    """Carry out the moves in swapFile that haven't been done yet."""
+    swap = load(swapFile)
+    for src, dst in swap['moves']:
+        if os.path.exists(src) and not os.path.exists(dst):
+            os.replace(src,dst)
+    for name in ('plan.json', 'progress.json'):
+        if os.path.exists(os.path.join(storeDir,name)):
+            os.remove(os.path.join(storeDir,name))
+    #calibrations stay with the live unpacked directory
+    old = os.path.join(f"{unpackedDir}.pre-backfill-{swap['stamp']}",'calibration.json')
+    if os.path.exists(old):
+        shutil.copy2(old,calibrationFile)
+    os.remove(swapFile)
+    print(f"previous directories kept as *.pre-backfill-{swap['stamp']}")
+
+
+def buildTiles(rollupFile):
+    #a whole new tree from the work store, an interrupted build starts over
+    shutil.rmtree(workTiles,ignore_errors=True)
+    os.makedirs(workTiles)
+    for sn in seriesStore.listSerials(workStore):
+        t = seriesStore.query(workStore,sn,columns=['time'])['time']
+        n = tiles.update(workTiles,workStore,rollupFile,sn,t.astype('int64'))
+        metrics.inc('obs_bytes_written_total',n,kind='tiles')
+
+
+def publish():
+    #the tiles came in with the swap, only the exports are left
+    if exportCsv:
+        for sn in seriesStore.listSerials(storeDir):
+            fileName = os.path.join(assetDir,sn+assetSuffix+'.csv')
+            seriesStore.SeriesStore(storeDir,sn).exportCsv(fileName)
+            metrics.inc('obs_bytes_written_total',metrics.fileBytes(fileName),kind='export')
+
+
+def backfill(processes=None, dryRun=False, fromArchive=False):
+    progress = {'done': {}, 'rows': {}}
+    if not dryRun:
+        #no update-data-2023.py run while the store is rebuilt and swapped
+        runLock = ingestManifest.runLock(unpackedDir)
+        if os.path.exists(swapFile):
+            print("finishing an interrupted swap")
+            finishSwap()
+            publish()
+            return
+    planner = makeArchivePlan if fromArchive else makePlan
+    if dryRun:
+        with tempfile.TemporaryDirectory() as tmp:
+            plan = planner(os.path.join(tmp,'dedupe'))
+    elif os.path.exists(planFile):
+        plan = load(planFile)
+        if os.path.exists(progressFile):
+            progress = load(progressFile)
+        resume(progress)
+        print("resuming")
+    else:
+        if os.path.exists(workStore) or os.path.exists(workUnpacked):
+            sys.exit(f"{workStore} or {workUnpacked} exists without a plan, remove it first")
+        os.makedirs(workStore)
+        plan = planner(os.path.join(workStore,'dedupe'))
+        save(plan,planFile)
+    source = plan.get('source','raw')
+
+    #chunks are sorted by serial then month, and each serial's store only
+    #needs its own chunks in order
+    chunks = plan['chunks']
+    position = {}
+    todo = []
+    for i, (key, items) in enumerate(chunks):
+        sn = key.split('/')[0]
+        position[sn] = position.get(sn,-1) + 1
+        if position[sn] >= progress['done'].get(sn,0):
+            todo.append(i)
+    print(f"{len(chunks)} chunks, {len(todo)} to do")
+    metrics.gauge('obs_backlog_transmissions',sum(chunkSize(chunks[i][1],source) for i in todo),stage='backfill')
+
+    counts = {}
+    records = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {i: pool.submit(runChunk,chunks[i][1],not dryRun,source) for i in todo}
+        #take the results in plan order whatever order they finish in
+        for i in todo:
+            chunkCounts, data = futures.pop(i).result()
+            for name, n in chunkCounts.items():
+                counts[name] = counts.get(name,0) + n
+            for sn, cols in data.items():
+                records[sn] = records.get(sn,0) + len(cols['time'])
+                if not dryRun:
+                    #QC runs here, in plan order, since it looks back on the records before
+                    cols['qc'] = qcFlags.update(os.path.join(workStore,'qc'),workStore,sn,cols)
+                    store = seriesStore.SeriesStore(workStore,sn)
+                    store.append(cols)
+                    metrics.inc('obs_records_total',len(cols['time']),stage='backfill')
+                    metrics.inc('obs_bytes_written_total',len(cols['time'])*store.recordBytes,kind='store')
+            if not dryRun:
+                sn = chunks[i][0].split('/')[0]
+                progress['done'][sn] = progress['done'].get(sn,0) + 1
+                progress['rows'].update({s: seriesStore.SeriesStore(workStore,s).rows for s in data})
+                save(progress,progressFile)
+
+    print(", ".join(f"{n} {name}" for name, n in counts.items()))
+    for sn in sorted(records):
+        print(f"{sn}: {records[sn]} records")
+    if dryRun:
+        return
+
+    #summaries for everything, then the manifest as of the plan
+    rollupFile = os.path.join(workStore,'rollups.sqlite')
+    for sn in seriesStore.listSerials(workStore):
+        t = seriesStore.query(workStore,sn,columns=['time'])['time']
+        rollups.update(rollupFile,workStore,sn,t.astype('int64'))
+    buildTiles(rollupFile)
+    if source == 'archive':
+        shutil.copytree(os.path.join(unpackedDir,'.manifest'),os.path.join(workUnpacked,'.manifest'),
+                        dirs_exist_ok=True)
+    else:
+        manifest = ingestManifest.IngestManifest(rawDir,os.path.join(workUnpacked,'.manifest'))
+        manifest.markDone(plan['entries'])
+        manifest.pendingDirs = plan['pendingDirs']
+        manifest.pendingWal = plan['pendingWal']
+        manifest.commit()
+
+    #swap the rebuilt directories in, the moves written down first
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    os.makedirs(workUnpacked,exist_ok=True)
+    moves = []
+    for live, work in [(storeDir,workStore), (unpackedDir,workUnpacked), (tileDir,workTiles)]:
+        moves += [[live, f"{live}.pre-backfill-{stamp}"], [work, live]]
+    save({'stamp': stamp, 'moves': moves},swapFile)
+    finishSwap()
+    publish()
+
+
+if __name__ == '__main__':
+    #OBS_PROFILE=<dir> profiles the run (the parent process), see metrics.py
+    metrics.profile()
+    metrics.runTimer('backfill')
+    args = sys.argv[1:]
+    dryRun = '--dry-run' in args
+    fromArchive = '--from-archive' in args
+    args = [a for a in args if not a.startswith('--')]
+    backfill(int(args[0]) if args else None, dryRun, fromArchive)
@@ -0,0 +1,95 @@
+#!/usr/bin/python3.10
+"""
+Downsampling of long time series before they are drawn.
+
+A 4 inch wide panel at 300 dpi is 1200 pixels across, so plotting more than
+a couple of points per pixel column only costs time and memory. minMax keeps
+the smallest and largest sample of every pixel column, which keeps spikes
+exactly where they were. lttb (Largest-Triangle-Three-Buckets, Steinarsson
+2013) keeps the point of each bucket that best preserves the visual shape and
+is the better choice for line plots.
+"""
+import numpy as np
+
+
+def _asNumber(x):
+    #datetime64 -> int64 so we can do arithmetic on it
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.view(np.int64)
+    return x
+
+
+def minMaxIndex(x, y, nBuckets, xRange=None):
+    """
+    Indices (sorted) of the min and max y in each of nBuckets equal width
+    x buckets. x must be sorted. NaN y values are never chosen.
+    """
+    xn = _asNumber(x).astype(float)
+    y = np.asarray(y, dtype=float)
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) <= 2*nBuckets:
+        return valid
+    if xRange is None:
+        x0, x1 = xn[valid[0]], xn[valid[-1]]
+    else:
+        x0, x1 = (float(v) for v in _asNumber(np.asarray(xRange, dtype=np.asarray(x).dtype)))
+    span = max(x1 - x0, 1)
+    bucket = np.clip(((xn[valid] - x0) / span * nBuckets).astype(np.int64), -1, nBuckets)
+
+    #sort by bucket then y, the first/last of each bucket are its min/max
+    order = np.lexsort((y[valid], bucket))
+    b = bucket[order]
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    ends = np.r_[starts[1:], len(b)] - 1
+    keep = np.union1d(valid[order[starts]], valid[order[ends]])
+    return keep
+
+
+def minMax(x, y, nBuckets, xRange=None):
+    idx = minMaxIndex(x, y, nBuckets, xRange)
+    return np.asarray(x)[idx], np.asarray(y)[idx]
+
+
+def lttbIndex(x, y, nOut):
+    """Indices of the nOut points chosen by LTTB. x must be sorted."""
+    xn = _asNumber(x).astype(float)
+    y = np.asarray(y, dtype=float)
+    n = len(xn)
+    if nOut >= n or nOut < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n-1, nOut-1).astype(np.int64)
+    out = np.empty(nOut, dtype=np.int64)
+    out[0] = 0
+    out[-1] = n-1
+    a = 0
+    for i in range(nOut-2):
+        lo, hi = edges[i], edges[i+1]
+        #average point of the next bucket (or the last point)
+        nlo, nhi = edges[i+1], edges[i+2] if i+2 < len(edges) else n
+        cx, cy = xn[nlo:nhi].mean(), y[nlo:nhi].mean()
+        #pick the point making the largest triangle with a and the average
+        area = np.abs((xn[a]-cx)*(y[lo:hi]-y[a]) - (xn[a]-xn[lo:hi])*(cy-y[a]))
+        a = lo + int(np.nanargmax(area)) if hi > lo else lo
+        out[i+1] = a
+    return out
+
+
+def lttb(x, y, nOut):
+    idx = lttbIndex(x, y, nOut)
+    return np.asarray(x)[idx], np.asarray(y)[idx]
+
+
+def decimateJob(job, nBuckets=None):
+    """
+    Min/max decimate every series of a plotRender job in place, with one
+    bucket per horizontal pixel unless nBuckets is given.
+    """
+    if nBuckets is None:
+        nBuckets = int(job.get('size', (4, 6))[0] * job.get('dpi', 300))
+    for p in job['panels']:
+        for s in p['series']:
+            if len(s['y']) > 2*nBuckets:
+                s['x'], s['y'] = minMax(s['x'], s['y'], nBuckets, job.get('xlim'))
+    return job
@@ -0,0 +1,77 @@
+#!/usr/bin/python3.10
+"""
+Persistent index of transmissions already stored, to drop RockBLOCK
+redeliveries.
+
+A delivery is keyed on (imei, momsn). Payloads without a MOMSN (e.g. raw
+files whose header doesn't carry one) are keyed on a sha1 of the imei and
+payload instead. The index is a dbm hash file, so a check is one lookup
+however big the archive gets (dbm.gnu or dbm.ndbm; Python falls back to
+dbm.dumb, which keeps its key table in memory, when neither is built in).
+
+Opening the index takes an exclusive lock, so the check and the insert of a
+delivery are atomic across the CGI processes and service threads.
+
+Duplicates already in the series store can be dropped with
+    python seriesStore.py compact <storeDir> [sn]
+"""
+import os
+import dbm
+import fcntl
+import hashlib
+
+
+def messageKey(imei, momsn, payload=None):
+    if momsn not in (None, ''):
+        return f"m:{imei}:{momsn}"
+    return "h:" + hashlib.sha1(f"{imei}:{(payload or '').strip().upper()}".encode()).hexdigest()
+
+
+class DedupeIndex:
+    def __init__(self, fileName):
+        dirName = os.path.dirname(fileName)
+        if dirName:
+            os.makedirs(dirName, exist_ok=True)
+        self.lock = open(fileName + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.db = dbm.open(fileName, 'c')
+
+    def get(self, key):
+        """Where the first copy of key went, or None."""
+        value = self.db.get(key.encode())
+        return None if value is None else value.decode()
+
+    def add(self, key, location):
+        """
+        Record key -> location unless key is already there. Returns the
+        location of the earlier copy for a duplicate, else None.
+        """
+        first = self.get(key)
+        if first is None:
+            self.db[key.encode()] = location.encode()
+        return first
+
+    def isDuplicate(self, key, location):
+        """
+        True if key was first stored somewhere other than location, else
+        record it. Seeing the same location again (a rerun after a crash)
+        is not a duplicate.
+        """
+        first = self.add(key, location)
+        return first is not None and first != location
+
+    def remove(self, key):
+        try:
+            del self.db[key.encode()]
+        except KeyError:
+            pass
+
+    def close(self):
+        self.db.close()
+        self.lock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/python3.10
+"""
+Reference delta codec for 2023 records, to fit more of them into one 50
+byte SBD message (one Iridium credit) than the 3 fixed-width
+single_record_t the firmware sends now.
+
+Message layout, padded with zeros to nBytes:
+
+    byte 0        version (0xD1)
+    byte 1        number of records n
+    bytes 2-17    first record, as a plain single_record_t
+    8 varints     one per field (packetDecode.fields order):
+                  zigzag(base) << 6 | mode << 5 | residual bit width
+    bit stream    records 2..n, field after field, each residual in its
+                  field's width, LSB first
+
+Field values are what packetDecode extracts (signed fields sign extended).
+In mode 0 a residual is the delta from the previous record minus the
+smallest delta in the message (base). The logger steps time by a fixed
+interval and slow sensors move a few counts, so those fields need a
+handful of bits per record, or none. Noisy fields (backscatter) have
+deltas wider than their range, so mode 1 stores value - base with base
+the smallest value of records 2..n instead. The encoder picks the
+narrower mode per field and message.
+
+encode() packs as many records as fit, decodePackets() decodes a batch of
+messages for payloadFormats.py. Both are plain Python/numpy, for checking a
+firmware implementation against and for the backend. A message whose
+header or bit stream doesn't fit in it (corrupt, or another payload that
+happens to start with 0xD1) raises DecodeError.
+"""
+import numpy as np
+import packetDecode
+
+version = 0xD1
+nBytes = 50
+maxWidth = 31
+names = packetDecode.labels
+#a header varint never needs more, zigzag(base) fits 58 bits
+maxVarintBytes = 9
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def zigzag(v):
+    v = int(v)
+    return 2*v if v >= 0 else -2*v - 1
+
+
+def unzigzag(u):
+    return (u >> 1) ^ -(u & 1)
+
+
+def _varint(u):
+    out = bytearray()
+    while True:
+        b = u & 0x7f
+        u >>= 7
+        if u:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _bitLength(x):
+    #elementwise int.bit_length for non-negative int64
+    x = np.asarray(x, np.int64)
+    out = np.zeros(x.shape, np.int64)
+    while x.any():
+        out += x > 0
+        x = x >> 1
+    return out
+
+
+def _readVarint(buf, pos):
+    u = 0
+    shift = 0
+    while True:
+        if pos >= len(buf) or shift >= 7*maxVarintBytes:
+            raise DecodeError("header varint runs past the message")
+        b = buf[pos]
+        pos += 1
+        u |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return u, pos
+
+
+def _message(values, modes):
+    """values is (n, 8) int64 in field order, modes 0 (delta) or 1 per field."""
+    n = len(values)
+    first = {name: values[:1, i] for i, name in enumerate(names)}
+    series = np.where(modes == 1, values[1:], np.diff(values, axis=0))
+    low = series.min(axis=0) if n > 1 else np.zeros(len(names), np.int64)
+    residual = series - low
+    widths = _bitLength(residual.max(axis=0)) if n > 1 else np.zeros(len(names), np.int64)
+
+    head = bytes([version, n]) + _packFirst(first)
+    for lo, mode, w in zip(low, modes, widths):
+        head += _varint(zigzag(lo) << 6 | int(mode) << 5 | int(w))
+    #bit stream, record after record, LSB first
+    bits = [(residual[:, [i]] >> np.arange(w)) & 1 for i, w in enumerate(widths)]
+    bits = np.concatenate(bits, axis=1).astype(np.uint8).ravel()
+    return head + np.packbits(bits, bitorder='little').tobytes()
+
+
+def _packFirst(first):
+    words = np.zeros(4, '<u4')
+    for name, word, offset, width, signed in packetDecode.fields:
+        v = int(first[name][0]) & ((1 << width) - 1)
+        words[word] |= np.uint32(v << offset)
+    return words.tobytes()
+
+
+def encode(rec, start=0):
+    """
+    Pack records start, start+1, ... (rec is a dict of packetDecode field
+    arrays) into one message. Returns (message, number of records used).
+    """
+    values = np.stack([np.asarray(rec[name][start:start+255], np.int64) for name in names], axis=1)
+    if len(values) == 1:
+        return _message(values, np.zeros(len(names), np.int64)).ljust(nBytes, b'\x00'), 1
+
+    #size of a message of the first n records, for every n at once, with
+    #the narrower mode for each field
+    options = []
+    for series in (np.diff(values, axis=0), values[1:]):
+        low = np.minimum.accumulate(series, axis=0)
+        widths = _bitLength(np.maximum.accumulate(series, axis=0) - low)
+        zz = np.where(low >= 0, 2*low, -2*low - 1) << 6 | widths
+        options.append((widths, np.maximum(1, (_bitLength(zz) + 6) // 7)))
+    (wDelta, hDelta), (wValue, hValue) = options
+    modes = (wValue + hValue*8 < wDelta + hDelta*8).astype(np.int64)
+    widths = np.where(modes == 1, wValue, wDelta)
+    headBytes = np.where(modes == 1, hValue, hDelta).sum(axis=1)
+    nRec = np.arange(2, len(values) + 1)
+    size = 18 + headBytes + ((nRec - 1) * widths.sum(axis=1) + 7) // 8
+    ok = (size <= nBytes) & (widths.max(axis=1) <= maxWidth)
+    if not ok.any():
+        return _message(values[:1], np.zeros(len(names), np.int64)).ljust(nBytes, b'\x00'), 1
+    k = int(np.flatnonzero(ok).max())
+    return _message(values[:k+2], modes[k]).ljust(nBytes, b'\x00'), k + 2
+
+
+def encodeAll(rec):
+    """All records as a list of messages."""
+    out = []
+    start = 0
+    total = len(rec[names[0]])
+    while start < total:
+        msg, n = encode(rec, start)
+        out.append(msg)
+        start += n
+    return out
+
+
+def readHeader(buf):
+    """(n, bases, modes, widths, offset of the bit stream) of one message."""
+    if len(buf) < 18 or buf[0] != version or buf[1] == 0:
+        raise DecodeError("not a delta message")
+    pos = 18
+    low = []
+    modes = []
+    widths = []
+    for name in names:
+        u, pos = _readVarint(buf, pos)
+        widths.append(u & 0x1f)
+        modes.append(u >> 5 & 1)
+        low.append(unzigzag(u >> 6))
+    n = buf[1]
+    if pos + ((n-1)*sum(widths) + 7) // 8 > len(buf):
+        raise DecodeError(f"{n} records don't fit in the message")
+    return n, low, modes, widths, pos
+
+
+def decodeMessage(buf):
+    """One message -> (n, 8) int64 of field values."""
+    buf = bytes(buf)
+    n, low, modes, widths, pos = readHeader(buf)
+    first = packetDecode.decodePackets(np.frombuffer(buf[2:18], np.uint8).reshape(1, 16), 16)
+    values = np.empty((n, len(names)), np.int64)
+    values[0] = [int(first[name][0]) for name in names]
+    if n > 1:
+        step = sum(widths)
+        bits = np.unpackbits(np.frombuffer(buf[pos:], np.uint8), bitorder='little')
+        bits = bits[:(n-1)*step].reshape(n-1, step).astype(np.int64)
+        col = 0
+        for i, w in enumerate(widths):
+            series = bits[:, col:col+w] @ (1 << np.arange(w, dtype=np.int64)) + low[i]
+            values[1:, i] = series if modes[i] else values[0, i] + np.cumsum(series)
+            col += w
+    return values
+
+
+def decodePackets(raw):
+    """
+    Decode a (nPackets, nBytes) uint8 array of messages. Same output as
+    packetDecode.decodePackets: a column per field plus 'packet'.
+    """
+    parts = [decodeMessage(row) for row in raw]
+    values = np.concatenate(parts) if parts else np.zeros((0, len(names)), np.int64)
+    out = {}
+    for i, (name, word, offset, width, signed) in enumerate(packetDecode.fields):
+        out[name] = values[:, i].astype(np.int32 if signed else np.uint32)
+    out['packet'] = np.repeat(np.arange(len(parts)), [len(p) for p in parts])
+    return out
@@ -0,0 +1,150 @@
+#!/usr/bin/python3.10
+"""
+Derived variables (engineering units, air pressure, water density, depth),
+declared once as vectorized expressions and shared by the 2023 and legacy
+pipelines.
+
+A Dataset wraps the decoded columns of one serial. Asking it for a column
+computes it on first use from whatever it depends on and keeps the result,
+so e.g. density is worked out once however many variables need it:
+
+    d = derived.Dataset(decoded, '2023', sn)
+    d['waterDepth']             #pulls in waterPressure, airPressure, density
+    d.get(['time', 'waterTemp'])
+
+Each format maps engineering columns to a decoded column and a divisor. The
+'legacy' format reads the columns obsData.OBS keeps (pressure in mbar, temp
+in C), 'legacyPacket' the raw legacy columns payloadFormats.py decodes.
+Per-serial calibration constants come from a JSON file {serial: {name:
+value}} loaded with loadCalibrations; see defaults.
+"""
+import os
+import json
+import numpy as np
+
+#engineering column -> (decoded column, divisor to engineering units)
+#pressures in bar, temperatures in C, battery in V
+units = {'2023': {'time': ('logtime', None),
+                  'ambient': ('tuBackground', None),
+                  'backscatter': ('tuBackscatter', None),
+                  'waterPressure': ('waterPressure', 1E5),
+                  'waterTemp': ('waterTemp', 10),
+                  'airPressureAnomaly': ('baroAnomaly', 1E5),
+                  'airTemp': ('airTemp', 10),
+                  'batteryVoltage': ('batteryVoltage', 10)},
+         'legacy': {'time': ('time', None),
+                    'ambient': ('ambient', None),
+                    'backscatter': ('backscatter', None),
+                    'waterPressure': ('pressure', 1E3),
+                    'waterTemp': ('temp', 1),
+                    'batteryVoltage': ('battV', 1)},
+         'legacyPacket': {'time': ('UnixTime', None),
+                          'ambient': ('Ambient', None),
+                          'backscatter': ('Backscatter', None),
+                          'waterPressure': ('Pressure', 1E4),
+                          'waterTemp': ('WaterTemp', 100),
+                          'batteryVoltage': ('battery', None)}}
+
+#calibration constants, overridden per serial
+defaults = {'waterPressureOffset': 0.0,   #bar, added to the sensor reading
+            'waterTempOffset': 0.0,       #C
+            'airPressure': 1.0,           #bar, reference the anomaly is relative to
+            'density': None,              #kg/m3, None to use the Tanaka formula
+            'gravity': 9.80665,           #m/s2
+            'depthOffset': 0.0}           #m, e.g. height of the sensor above the bed
+
+offsets = {'waterPressure': 'waterPressureOffset', 'waterTemp': 'waterTempOffset'}
+
+calibrations = {}
+
+#name -> function(dataset, calibration) returning the whole column
+derivations = {}
+
+
+def derivation(name):
+    def register(func):
+        derivations[name] = func
+        return func
+    return register
+
+
+def loadCalibrations(fileName):
+    """Read {serial: {constant: value}} into calibrations, if the file exists."""
+    if fileName and os.path.exists(fileName):
+        with open(fileName) as file:
+            calibrations.update({str(k): v for k, v in json.load(file).items()})
+    return calibrations
+
+
+def calibrationFor(sn, overrides=None):
+    return dict(defaults, **calibrations.get(str(sn), {}), **(overrides or {}))
+
+
+@derivation('airPressure')
+def _airPressure(d, c):
+    #the legacy loggers have no barometer, assume the reference pressure
+    if 'airPressureAnomaly' in d:
+        return c['airPressure'] + d['airPressureAnomaly']
+    return np.full(len(d['waterPressure']), c['airPressure'])
+
+
+"""
+turns out this is pretty complicated, depends on atmospheric pressure,
+dissolved gasses, isotopes, salinity, yadda yadda. Temperature is most
+important within normal ranges.
+formula taken from here:
+Tanaka, M., et al. "Recommended table for the density of water between 0 C
+and 40 C based on recent experimental reports." Metrologia 38.4 (2001): 301.
+"""
+@derivation('density')
+def _density(d, c):
+    if c['density'] is not None:
+        return np.full(len(d['waterTemp']), float(c['density']))
+    t = d['waterTemp']
+    a1 = -3.98305
+    a2 = 301.797
+    a3 = 522528.9
+    a4 = 69.34881
+    a5 = 999.974950
+    return a5*(1-((t+a1)**2*(t+a2))/(a3*(t+a4)))
+
+
+@derivation('waterDepth')
+def _waterDepth(d, c):
+    return 1E5*(d['waterPressure']-d['airPressure'])/(d['density']*c['gravity']) + c['depthOffset']
+
+
+class Dataset:
+    def __init__(self, columns, fmt='2023', sn=None, calibration=None):
+        self.columns = columns
+        self.units = units[fmt]
+        self.calibration = calibrationFor(sn, calibration)
+        self.cache = {}
+
+    def __contains__(self, name):
+        if name in self.units:
+            return self.units[name][0] in self.columns
+        return name in derivations
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            if name in self.units:
+                source, divisor = self.units[name]
+                v = np.asarray(self.columns[source])
+                if divisor is not None:
+                    v = v/divisor
+                if name in offsets:
+                    v = v + self.calibration[offsets[name]]
+            elif name in derivations:
+                v = derivations[name](self, self.calibration)
+            else:
+                raise KeyError(name)
+            self.cache[name] = v
+        return self.cache[name]
+
+    def get(self, names, fill=None):
+        """Columns by name. Columns a format can't provide are filled with fill, if given."""
+        if fill is None:
+            return {n: self[n] for n in names}
+        size = len(self['time'])
+        return {n: self[n] if n in self else np.full(size, fill) for n in names}
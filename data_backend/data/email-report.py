@@ -1,206 +1,187 @@
 #!/usr/bin/python3.10
 
-import glob
-import csv
-import re
-import numpy as np
-import matplotlib.pyplot as plt
-from datetime import datetime
+import os
+import sys
+from datetime import datetime, timedelta
 import smtplib
 from email.message import EmailMessage
 from email.utils import make_msgid
-
-# You will have to update these details if you want to send emails. This is really not a good way to do this, but it is quick.
+import obsData
+import derived
+import transmissionCatalog
+import statusSnapshot
+import momsnLedger
+import qcFlags
+import plotRender
+import metrics
+
+#OBS_PROFILE=<dir> profiles the run, see metrics.py
+metrics.profile()
+metrics.runTimer('report')
+
+# You will have to set these details if you want to send emails. They come from the environment so no password lives in the script.
 # For security purposes, I recommend setting up a new gmail account and then getting an app-specific password for this script.
-send_from = 
-send_pass = 
-send_to = 
-
-assetDir = "/var/www/html/assets"
+send_from = os.environ.get('OBS_REPORT_FROM', '')
+send_pass = os.environ.get('OBS_REPORT_PASS', '')
+send_to = os.environ.get('OBS_REPORT_TO', '')
+#point these at a local stand-in (scripts/smtpSink.py) to test without sending anything
+smtpHost = os.environ.get('OBS_SMTP_HOST', 'smtp.gmail.com')
+smtpPort = int(os.environ.get('OBS_SMTP_PORT', '465'))
+smtpSsl = os.environ.get('OBS_SMTP_SSL', '1') != '0'
+
+#recipient -> serials in their digest, None for all of them
+digests = {send_to: None}
+
+#written by the endpoint as each transmission comes in, and built from the
+#catalog (and the archive under dataDir) on the first run
+statusDir = "/srv/data/status"
+catalogFile = "/srv/data/catalog.sqlite"
+dataDir = "/srv/data"
+#MOMSNs received per modem, kept by the endpoint too (momsnLedger.py)
+ledgerDir = "/srv/data/ledger"
+#per-serial calibration constants, see derived.py
+calibrationFile = "/srv/data/calibration.json"
+reportDays = 7
 
 nameDict = {209175: "Tanana Lakes",
             210571: "Sam Charley",
             211590: "Jonas\' house"}
 
-class OBS:
-    def __init__(self,sn,lat,lon):
-        self.sn = sn
-        self.lat = lat
-        self.lon = lon
-        self.time = []
-        self.timeString = []
-        self.pressure = []
-        self.depth = []
-        self.ambient = []
-        self.backscatter = []
-        self.temp = []
-        self.battV = []
-        self.lastTransmission = ""
-        self.lastBattV = 0
-        
-    def addData(self, dataRow):        
-        time = datetime.utcfromtimestamp(dataRow[0])
-        timeString = time.strftime('%Y-%m-%d %H:%M:%S')
-        depth = (dataRow[1]/1E4 - 1) * 10.1972 #rough conversion from bar*10^-4 to water depth
-        
-        
-        self.time = np.append(self.time,time)
-        self.timeString = np.append(self.timeString,timeString)
-        self.pressure = np.append(self.pressure,dataRow[1]/10)
-        self.depth = np.append(self.depth,depth)
-        self.ambient = np.append(self.ambient,dataRow[2])
-        self.backscatter = np.append(self.backscatter,dataRow[3])
-        self.temp = np.append(self.temp,dataRow[4]/100)  
-        self.battV = np.append(self.battV,dataRow[5])
-        self.lastTransmission = max(self.time).strftime('%Y-%m-%d %H:%M:%S')
-        
-    def __repr__(self):
-        outString = f"Serial Number:\t{self.sn}\n"
-        outString += f"Last transmission: {self.lastTransmission}\n"
-        outString += f"Battery Voltage:\t{self.battV[-1]:.2f}V\n"
-        outString += "time\t\t\t\t\tdepth\tambient\tbackscatter\ttemp\n"
-        for i in range(-3,0):
-            outString += f"{self.timeString[i]}\t\t{self.depth[i]:.2f}m\t" 
-            outString += f"{self.ambient[i]}\t\t{self.backscatter[i]}\t\t{self.temp[i]:.2f}C\n"
-        return outString
-    
-    def filterStartDate(self,startDate):
-        mask = [t>=startDate for t in self.time]
-        self.time = self.time[mask]
-        self.timeString = self.timeString[mask]
-        self.pressure = self.pressure[mask]
-        self.depth = self.depth[mask]
-        self.ambient = self.ambient[mask]
-        self.backscatter = self.backscatter[mask]
-        self.temp = self.temp[mask]
-        self.battV = self.battV[mask]
-    
-    
-    def plot(self,depthMin,scatterMax):
-        mask = [d>depthMin for d in self.depth]
-        depthAxis = plt.subplot(4,1,1)
-        depthAxis.plot(self.time[mask],self.depth[mask],'r.')
-        plt.ylabel("Appx. water\ndepth (m)")
-        depthAxis.get_xaxis().set_ticks([])
-         
+class OBS(obsData.OBS):
+    __slots__ = ()
+
+    def reportJob(self,qc):
         if self.sn in nameDict:
-            plt.title(f"Data from {nameDict[self.sn]}.")
+            title = f"Data from {nameDict[self.sn]}."
         else:
-            plt.title(f"Data from Iridium SN: {self.sn}.")
-
-        mask = [b<scatterMax for b in self.backscatter]
-        turbAxis = plt.subplot(4,1,2)
-        turbAxis.plot(self.time[mask],self.backscatter[mask],'b.')
-        plt.ylabel("Backscatter")
-        turbAxis.get_xaxis().set_ticks([])
-        
-        tempAxis = plt.subplot(4,1,3)
-        tempAxis.plot(self.time,self.temp,'k.')
-        plt.ylabel("Temp (C)")
-        tempAxis.get_xaxis().set_ticks([])
-
-
-        battAxis = plt.subplot(4,1,4)
-        battAxis.plot(self.time,self.battV,'k.')
-        plt.ylabel("Battery\nVoltage")
-               
-        fig = plt.gcf()
-        fig.set_size_inches(4, 6)
-        fig.autofmt_xdate()
-        plt.tight_layout()
-        fig.savefig(f'{assetDir}/{self.sn}.png', dpi=300)
-    
-        return [depthAxis,turbAxis,battAxis]
-        
-
-fileList = glob.glob('/srv/data/*/*.csv')
-loggers = list()
-
-transmission_count = 0
-for singleFile in fileList:
-    with open(singleFile) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        found_headers = False
-        for row in csv_reader: 
-            if "serial" in row[0]:
-                deviceSN = int(re.search("[0-9]+",row[0])[0])
-            elif "latitude" in row[0]:
-                lat = re.search("[-0-9.]+",row[0])[0]
-            elif "longitude" in row[0]:
-                lon = re.search("[-0-9.]+",row[0])[0]
-            elif "battery" in row[0]:
-                battString = re.search("[-0-9.]+",row[0])[0]
-                battV = round(float(battString),2)
-            elif "UnixTime" in row[0]:
-                found_headers = True #done with the headers
-                #now create or find the appropriate logger variable and add the data
-                snMatch = [l.sn==deviceSN for l in loggers]
-                if any(snMatch):
-                    snIdx = int(np.linspace(0,len(snMatch)-1,len(snMatch))[snMatch])
-                else:
-                    loggers.append(OBS(deviceSN,lat,lon))
-                    snIdx = len(loggers)-1
-            elif found_headers:
-                dataRow = [int(r) for r in row]
-                dataRow.append(battV)
-                loggers[snIdx].addData(dataRow)
-    transmission_count += 1
-    
-print(f'Processed {transmission_count} transmissions.')
-
-#write the data out to a text file
-for obs in loggers:
-    obs.filterStartDate(datetime(2022,10,3))
-    with open(f"{assetDir}/{obs.sn}.csv","w",newline="") as file:
-        file.write(f"serial number: {obs.sn}\n")
-        file.write(f"lat: {obs.lat}\n")
-        file.write(f"lon: {obs.lon}\n")
-        file.write("time,pressure (mbar),approximate depth (m),ambient,backscatter," +
-                    "temp (C),battery (V)")
-        for i in range(0,len(obs.time)):
-            file.write(f"\n{obs.timeString[i]},{obs.pressure[i]},{obs.depth[i]},"+
-                        f"{obs.ambient[i]},{obs.backscatter[i]},{obs.temp[i]},{obs.battV[i]}")
-
-    plt.close("all")
-    obs.plot(0.1,10000)
+            title = f"Data from Iridium SN: {self.sn}."
+
+        depthMask = qcFlags.good(qc,'waterDepth')
+        scatterMask = qcFlags.good(qc,'backscatter')
+        tempMask = qcFlags.good(qc,'waterTemp')
+        battMask = qcFlags.good(qc,'batteryVoltage')
+        #small figure for the email body, rendered in memory
+        return {'fileName': None,
+                'title': title,
+                'sharex': False,
+                'hideXTicks': True,
+                'size': (4, 5),
+                'dpi': 100,
+                'panels': [{'ylabel': "Appx. water\ndepth (m)",
+                            'series': [{'x': self.time[depthMask], 'y': self.depth[depthMask], 'fmt': 'r.'}]},
+                           {'ylabel': "Backscatter",
+                            'series': [{'x': self.time[scatterMask], 'y': self.backscatter[scatterMask], 'fmt': 'b.'}]},
+                           {'ylabel': "Temp (C)",
+                            'series': [{'x': self.time[tempMask], 'y': self.temp[tempMask], 'fmt': 'k.'}]},
+                           {'ylabel': "Battery\nVoltage",
+                            'series': [{'x': self.time[battMask], 'y': self.battV[battMask], 'fmt': 'k.'}]}]}
+
+
+derived.loadCalibrations(calibrationFile)
+startDate = datetime.now() - timedelta(days=reportDays)
+
+#a new deployment has no snapshots or ledgers yet, only the archive; both
+#merge, so whatever the endpoint wrote meanwhile is kept
+builtMarker = os.path.join(statusDir, '.fromCatalog')
+if not os.path.exists(builtMarker):
+    catalog = transmissionCatalog.TransmissionCatalog(catalogFile)
+    catalog.indexArchive(dataDir)
+    t0 = datetime.now() - timedelta(days=statusSnapshot.keepDays+1)
+    print(f'Built {statusSnapshot.fromCatalog(catalog, statusDir, t0)} status snapshots from the catalog.')
+    momsnLedger.fromCatalog(catalog, ledgerDir)
+    catalog.close()
+    os.makedirs(statusDir, exist_ok=True)
+    open(builtMarker, 'w').close()
+loggers = dict()
+#a logger that went quiet has nothing in the window, and is the one the
+#report most needs to show, so it keeps its last records and is marked stale
+stale = set()
+for sn, snap in statusSnapshot.load(statusDir).items():
+    obs = statusSnapshot.toObs(snap, OBS)
+    obs.filterStartDate(startDate)
+    if not len(obs):
+        obs = statusSnapshot.toObs(snap, OBS)
+        stale.add(sn)
+    loggers[sn] = obs
+
+print(f'Loaded {len(loggers)} status snapshots, {len(stale)} stale.')
+
+#delivery over the report window, from the MOMSN ledgers
+firstDay = startDate.strftime('%Y%m%d')
+delivery = {sn: ledger.summary(firstDay) for sn, ledger in momsnLedger.bySerial(ledgerDir).items()}
+
+
+def deliveryText(sn):
+    d = delivery.get(sn)
+    if d is None or d['percent'] is None:
+        return "unknown"
+    gaps = ", ".join(str(f) if f == l else f"{f}-{l}" for f, l in d['missing'][:10])
+    if len(d['missing']) > 10:
+        gaps += ", ..."
+    return f"{d['percent']:0.1f}% of {d['sent']} messages" + (f" (missing MOMSN {gaps})" if gaps else "")
+
+#QC flags per logger (qcFlags.py); flagged values stay out of the figures
+flags = {sn: obs.qc() for sn, obs in loggers.items()}
+
+#one figure per logger, however many digests it goes in
+figures = {sn: plotRender.renderBytes(obs.reportJob(flags[sn])) for sn, obs in loggers.items()}
+
+
+def flagText(sn):
+    n = qcFlags.counts(flags[sn])
+    if not n:
+        return "none"
+    #a drooping battery is worth a look before the logger goes quiet
+    text = ", ".join(f"{v} {name}" for name, v in n.items())
+    return ("BATTERY DROOP, " if 'droop' in n else "") + text
+
+
+def lastText(values, unit):
+    return f"{values[-1]:0.2f} {unit}" if len(values) else "unknown"
+
+
+def staleText(sn):
+    return f" (STALE, nothing in the last {reportDays} days)" if sn in stale else ""
 
 
 dateString = datetime.now().strftime("%B %d, %Y")
 timeString = datetime.now().strftime("%B %d, %Y  %H:%M")
-plotPaths = glob.glob(f'{assetDir}/*.png')
-
-lastReportText = ""
-cidText = ""
-obs_cid = list()
-for l in loggers:
-    obs_cid.append(make_msgid())
-    lastReportText += f"""
-    Serial Number: {l.sn} 
-    Last transmission: {l.lastTransmission}
-    Battery Voltage: {l.battV[l.time==max(l.time)][0]:0.2f} V
-    Appx. Depth: {l.depth[l.time == max(l.time)][0]:0.2f} m
+
+def buildMessage(recipient, serials):
+    lastReportText = ""
+    cidText = ""
+    images = []
+    for sn in serials:
+        l = loggers[sn]
+        #each image gets its cid in the same step as its own text, so they can't get mixed up
+        cid = make_msgid()
+        images.append((figures[sn], cid))
+        lastReportText += f"""
+    Serial Number: {l.sn}
+    Last transmission: {l.lastTransmission or "unknown"}{staleText(sn)}
+    Battery Voltage: {lastText(l.battV, "V")}
+    Appx. Depth: {lastText(l.depth, "m")}
+    Delivered: {deliveryText(sn)}
+    QC flags: {flagText(sn)}
     """
-    cidText += f"<img src=\"cid:{obs_cid[-1][1:-1]}\" />"
-    
-
-msg = EmailMessage()
-msg['Subject'] = 'Live From The Tanana: '+dateString
-msg['From'] = send_from
-msg['To'] = send_to
-msg.set_content(f"""\
+        cidText += f"<img src=\"cid:{cid[1:-1]}\" />"
+
+    msg = EmailMessage()
+    msg['Subject'] = 'Live From The Tanana: '+dateString
+    msg['From'] = send_from
+    msg['To'] = recipient
+    msg.set_content(f"""\
 Iridium logger report {timeString}
 
 {lastReportText}
 
 """)
 
-# Add the html version.  This converts the message into a multipart/alternative
-# container, with the original text message as the first part and the new html
-# message as the second part.
-htmlLastReport = lastReportText.replace("\n","<br />")
-
-asparagus_cid = make_msgid()
-msg.add_alternative(f"""\
+    # Add the html version.  This converts the message into a multipart/alternative
+    # container, with the original text message as the first part and the new html
+    # message as the second part.
+    htmlLastReport = lastReportText.replace("\n","<br />")
+    msg.add_alternative(f"""\
 <html>
   <head>Iridium logger report {timeString}</head>
   <body>
@@ -211,25 +192,35 @@ msg.add_alternative(f"""\
   </body>
 </html>
 """, subtype='html')
-# <img src="cid:{asparagus_cid[1:-1]}" />
-# note that we needed to peel the <> off the msgid for use in the html.
-
-# Now add the related image to the html part.
-for [path,cid] in zip(plotPaths,obs_cid):
-    with open(path, 'rb') as img:
-        msg.get_payload()[1].add_related(img.read(), 'image', 'jpeg',
-                                         cid=cid)
-    
-try:
-    server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-    server.ehlo()
-    server.login(send_from, send_pass)
-    server.send_message(msg)
-    server.close()
+    # note that we needed to peel the <> off the msgid for use in the html.
 
-    print('Email sent!')
-except:
-    print('Something went wrong...')
-   
+    # Now add the related images to the html part.
+    for png, cid in images:
+        msg.get_payload()[1].add_related(png, 'image', 'png', cid=cid)
+    return msg
 
+messages = []
+for recipient, serials in digests.items():
+    serials = [sn for sn in (loggers if serials is None else serials) if sn in loggers]
+    if recipient and serials:
+        messages.append(buildMessage(recipient, serials))
 
+if not messages:
+    print('Nothing to send.')
+    sys.exit(0)
+
+#one connection for every digest
+try:
+    if smtpSsl:
+        server = smtplib.SMTP_SSL(smtpHost, smtpPort)
+    else:
+        server = smtplib.SMTP(smtpHost, smtpPort)
+    with server:
+        server.ehlo()
+        if send_pass:
+            server.login(send_from, send_pass)
+        for msg in messages:
+            server.send_message(msg)
+            print(f"Email sent to {msg['To']}!")
+except (smtplib.SMTPException, OSError) as e:
+    print(f'Something went wrong... {e}')
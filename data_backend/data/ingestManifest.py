@@ -0,0 +1,138 @@
+#!/usr/bin/python3.10
+"""
+Persistent record of which raw transmissions have already been unpacked.
+
+Raw files live in rawDir/<sn>/<time>.csv and are written once, so a serial
+directory only needs to be listed again when its mtime changes. The manifest
+keeps:
+
+    manifestDir/manifest.json   {sn: directory mtime (ns)} watermark
+    manifestDir/<sn>.json       {file name: [size, mtime (ns)]} already done
+    manifestDir/wal.json        {sn: {seq, segment}} transmission log cursor
+
+A run with nothing new only lists rawDir and stats each serial directory,
+and stats the newest segment of each serial's transmission log.
+Only stdlib is imported here so callers can bail out before pulling in
+numpy/matplotlib.
+"""
+import os
+import json
+import time
+import fcntl
+import transmissionLog
+
+#don't trust a directory mtime this close to now, a file could still land
+#in the same clock tick after we listed it.
+settleNs = 2 * 10**9
+
+
+def runLock(unpackedDir):
+    """
+    Take the lock that keeps update-data-2023.py and backfill-2023.py from
+    running at the same time. Held until the returned file is closed or the
+    process exits. It sits next to unpackedDir rather than in its manifest,
+    since a backfill swaps the whole directory.
+    """
+    fileName = os.path.normpath(unpackedDir) + '.lock'
+    os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    lock = open(fileName, 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def _load(fileName):
+    try:
+        with open(fileName) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _dump(obj, fileName):
+    tmp = fileName + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(obj, file)
+    os.replace(tmp, fileName)
+
+
+class IngestManifest:
+    def __init__(self, rawDir, manifestDir):
+        self.rawDir = rawDir
+        self.manifestDir = manifestDir
+        self.manifestFile = os.path.join(manifestDir, 'manifest.json')
+        self.dirMtimes = _load(self.manifestFile)
+        self.done = {}           #sn -> {name: [size, mtime]}, loaded lazily
+        self.pendingDirs = {}    #sn -> dir mtime to record after a commit
+        self.walFile = os.path.join(manifestDir, 'wal.json')
+        self.walCursors = _load(self.walFile)
+        self.pendingWal = {}
+
+    def _doneFor(self, sn):
+        if sn not in self.done:
+            self.done[sn] = _load(os.path.join(self.manifestDir, sn + '.json'))
+        return self.done[sn]
+
+    def newEntries(self, serials=None):
+        """
+        Return [(sn, fileName, size, mtime)] for raw files that are new or
+        changed since they were last unpacked, of only serials if given.
+        """
+        entries = []
+        now = time.time_ns()
+        try:
+            serialDirs = [d for d in os.scandir(self.rawDir) if d.is_dir()
+                          and (serials is None or d.name in serials)]
+        except FileNotFoundError:
+            return entries
+
+        for d in serialDirs:
+            dirMtime = d.stat().st_mtime_ns
+            if self.dirMtimes.get(d.name) == dirMtime:
+                continue #nothing added to this serial
+            done = self._doneFor(d.name)
+            for f in os.scandir(d.path):
+                if not f.name.endswith('.csv') or not f.is_file():
+                    continue
+                st = f.stat()
+                if done.get(f.name) != [st.st_size, st.st_mtime_ns]:
+                    entries.append((d.name, f.name, st.st_size, st.st_mtime_ns))
+            if now - dirMtime > settleNs:
+                self.pendingDirs[d.name] = dirMtime
+        return entries
+
+    def newWalMessages(self, walDir, serials=None):
+        """
+        Return [(sn, seq, fields)] for transmission log records past the
+        cursor of each serial (of only serials if given).
+        """
+        out = []
+        for sn in transmissionLog.listSerials(walDir):
+            if serials is not None and sn not in serials:
+                continue
+            cursor = self.walCursors.get(sn, {'seq': 0, 'segment': None})
+            segment = transmissionLog.lastSegment(walDir, sn)
+            if segment == cursor['segment']:
+                continue
+            lastSeq = cursor['seq']
+            for seq, fields in transmissionLog.replayMessages(walDir, sn, lastSeq+1):
+                out.append((sn, seq, fields))
+                lastSeq = seq
+            self.pendingWal[sn] = {'seq': lastSeq, 'segment': segment}
+        return out
+
+    def markDone(self, entries):
+        for sn, name, size, mtime in entries:
+            self._doneFor(sn)[name] = [size, mtime]
+
+    def commit(self):
+        """Write the per-serial lists first, then the directory watermarks."""
+        os.makedirs(self.manifestDir, exist_ok=True)
+        for sn, done in self.done.items():
+            _dump(done, os.path.join(self.manifestDir, sn + '.json'))
+        self.dirMtimes.update(self.pendingDirs)
+        self.pendingDirs = {}
+        _dump(self.dirMtimes, self.manifestFile)
+        if self.pendingWal:
+            self.walCursors.update(self.pendingWal)
+            self.pendingWal = {}
+            _dump(self.walCursors, self.walFile)
@@ -0,0 +1,206 @@
+#!/usr/bin/python3.10
+"""
+Timings and counts from every stage of the pipeline, as a Prometheus text
+file (for node_exporter's textfile collector, or served by
+rockblockService.py at /metrics).
+
+Each process collects into memory and flush() merges that into
+<textFile>.json under a lock, then rewrites textFile, so the CGI script,
+the service, the cron scripts and their pool workers all add to the same
+totals. Counters and histograms add up, gauges keep the last value.
+
+    with metrics.timer('obs_decode_seconds', stage='update'):
+        ...
+    metrics.inc('obs_records_total', len(t), stage='update')
+    metrics.flush()
+
+OBS_METRICS_FILE moves the file. Metrics never stop the pipeline: if the
+file can't be written the values are dropped.
+
+OBS_PROFILE=<dir> runs any script that calls profile() under cProfile and
+leaves <dir>/<script>-<time>.prof for pstats or snakeviz.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import atexit
+import threading
+from contextlib import contextmanager
+
+textFile = os.environ.get('OBS_METRICS_FILE', '/srv/data/metrics/openobs.prom')
+
+#seconds, for request latency up to a full backfill chunk
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+#name -> (type, help)
+described = {
+    'obs_ingest_seconds': ('histogram', "RockBLOCK delivery handling time"),
+    'obs_ingest_total': ('counter', "RockBLOCK deliveries by outcome"),
+    'obs_decode_seconds': ('histogram', "Time to decode and derive one batch of transmissions"),
+    'obs_transmissions_total': ('counter', "Transmissions decoded, by payload format"),
+    'obs_records_total': ('counter', "Records appended to the series store"),
+    'obs_records_per_second': ('gauge', "Records decoded per second in the last batch"),
+    'obs_backlog_transmissions': ('gauge', "Transmissions waiting when the last run started"),
+    'obs_plot_seconds': ('histogram', "Plot render time"),
+    'obs_bytes_written_total': ('counter', "Bytes written, by kind of file"),
+    'obs_update_seconds': ('histogram', "Time for the endpoint's worker to update the serials that got data"),
+    'obs_publish_seconds': ('histogram', "Time from acknowledging a delivery to its serial's products being updated"),
+    'obs_qc_seconds': ('histogram', "Time to QC one serial's new records"),
+    'obs_qc_flagged_total': ('counter', "Records flagged by QC, by check"),
+    'obs_run_seconds': ('histogram', "Wall time of a whole pipeline run"),
+    'obs_last_run_timestamp': ('gauge', "Unix time the last run finished"),
+}
+
+#(name, sorted label items) -> value, or [bucket counts..., sum, count]
+_values = {}
+#the service records from several request threads
+_lock = threading.Lock()
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, n=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + n
+
+
+def gauge(name, value, **labels):
+    with _lock:
+        _values[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        h = _values.setdefault(key, [0] * (len(buckets) + 2))
+        for i, b in enumerate(buckets):
+            if value <= b:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def fileBytes(fileName):
+    try:
+        return os.path.getsize(fileName)
+    except (OSError, TypeError):
+        return 0
+
+
+def _merge(state, values):
+    for (name, labels), value in values.items():
+        kind = described.get(name, ('gauge',))[0]
+        series = state.setdefault(name, {})
+        labelKey = json.dumps(labels)
+        old = series.get(labelKey)
+        if kind == 'counter' and old is not None:
+            value = old + value
+        elif kind == 'histogram' and old is not None:
+            value = [a + b for a, b in zip(old, value)]
+        series[labelKey] = value
+
+
+def _labelText(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+def render(state):
+    lines = []
+    for name in sorted(state):
+        kind, helpText = described.get(name, ('gauge', name))
+        lines.append(f"# HELP {name} {helpText}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labelKey, value in sorted(state[name].items()):
+            labels = [tuple(item) for item in json.loads(labelKey)]
+            if kind == 'histogram':
+                for b, n in zip(buckets + ['+Inf'], value[:-2] + [value[-1]]):
+                    lines.append(f"{name}_bucket{_labelText(labels, [('le', b)])} {n}")
+                lines.append(f"{name}_sum{_labelText(labels)} {value[-2]:.6f}")
+                lines.append(f"{name}_count{_labelText(labels)} {value[-1]}")
+            else:
+                lines.append(f"{name}{_labelText(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def flush(fileName=None):
+    """Add what this process collected to the shared file and start over."""
+    fileName = fileName or textFile
+    with _lock:
+        values = dict(_values)
+        _values.clear()
+    if not values:
+        return
+    try:
+        os.makedirs(os.path.dirname(fileName) or '.', exist_ok=True)
+        with open(fileName + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(fileName + '.json') as file:
+                    state = json.load(file)
+            except (FileNotFoundError, ValueError):
+                state = {}
+            _merge(state, values)
+            for name, text in [(fileName + '.json', json.dumps(state)), (fileName, render(state))]:
+                with open(name + '.tmp', 'w') as file:
+                    file.write(text)
+                os.replace(name + '.tmp', name)
+    except OSError:
+        pass
+
+
+def read(fileName=None):
+    """The current text file, for serving at /metrics."""
+    try:
+        with open(fileName or textFile) as file:
+            return file.read()
+    except FileNotFoundError:
+        return ''
+
+
+def profile():
+    """Profile the rest of this run if OBS_PROFILE names a directory."""
+    outDir = os.environ.get('OBS_PROFILE')
+    if not outDir:
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+    outFile = os.path.join(outDir, f"{script}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}.prof")
+
+    def dump():
+        profiler.disable()
+        os.makedirs(outDir, exist_ok=True)
+        profiler.dump_stats(outFile)
+
+    atexit.register(dump)
+    profiler.enable()
+    return profiler
+
+
+def runTimer(stage):
+    """Record obs_run_seconds and the finish time for this run at exit, then flush."""
+    start = time.perf_counter()
+
+    def done():
+        observe('obs_run_seconds', time.perf_counter() - start, stage=stage)
+        gauge('obs_last_run_timestamp', int(time.time()), stage=stage)
+        flush()
+
+    atexit.register(done)
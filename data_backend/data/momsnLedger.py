@@ -0,0 +1,229 @@
+#!/usr/bin/python3.10
+"""
+Ledger of the MOMSNs received from each IMEI, to see which messages never
+arrived without opening every transmission.
+
+The modem numbers every message it sends (MOMSN), so the gaps in what we
+received are the lost messages. A ledger keeps those numbers as sorted
+runs of consecutive MOMSNs, a handful of [first, last] pairs however many
+messages came in, plus the highest MOMSN received on each day (server
+time), in ledgerDir/<imei>.json:
+
+    {"imei": ..., "serial": ..., "runs": [[1, 480], [483, 1020]],
+     "days": {"20230101": 24, ...}}
+
+The endpoint adds each delivery as it is processed. Queries are a few
+binary searches over the runs:
+
+    missing(lo, hi)   gaps [first, last] between lo and hi
+    delivered()       per day (day, received, sent, percent)
+
+A day is charged with the MOMSNs above the previous days' highest up to
+its own, so messages that only arrive later still count for the day they
+were sent in, and a gap across a quiet night is charged to the morning.
+The modem's counter wraps at 65535; a wrap shows up as a new run and the
+days after it report nothing sent until the counter passes its old
+highest, so start a new ledger file if a modem ever gets that far.
+
+To build ledgers for an archive from the transmission catalog:
+    python momsnLedger.py build <catalog.sqlite> <ledgerDir>
+and to list the lost messages of one modem:
+    python momsnLedger.py missing <ledgerDir> <imei> [lo hi]
+"""
+import os
+import sys
+import json
+import fcntl
+import bisect
+import numpy as np
+
+
+def ledgerFile(ledgerDir, imei):
+    return os.path.join(ledgerDir, f"{imei}.json")
+
+
+class Ledger:
+    def __init__(self, imei, serial=None, runs=None, days=None):
+        self.imei = str(imei)
+        self.serial = serial
+        self.runs = runs or []
+        self.days = days or {}
+        self._arrays = None
+
+    def add(self, momsn, received=None):
+        """Record one MOMSN (received YYYYmmddHHMMSS). False if it was already there."""
+        momsn = int(momsn)
+        starts = [r[0] for r in self.runs]
+        i = bisect.bisect_right(starts, momsn)
+        if i and self.runs[i-1][1] >= momsn:
+            return False
+        joinLeft = i and self.runs[i-1][1] == momsn - 1
+        joinRight = i < len(self.runs) and self.runs[i][0] == momsn + 1
+        if joinLeft and joinRight:
+            self.runs[i-1][1] = self.runs.pop(i)[1]
+        elif joinLeft:
+            self.runs[i-1][1] = momsn
+        elif joinRight:
+            self.runs[i][0] = momsn
+        else:
+            self.runs.insert(i, [momsn, momsn])
+        if received:
+            day = str(received)[:8]
+            self.days[day] = max(self.days.get(day, momsn), momsn)
+        self._arrays = None
+        return True
+
+    def _cover(self):
+        #run starts, ends and the number of MOMSNs received up to each run's end
+        if self._arrays is None:
+            runs = np.array(self.runs, dtype=np.int64).reshape(-1, 2)
+            self._arrays = runs[:, 0], runs[:, 1], np.cumsum(runs[:, 1] - runs[:, 0] + 1)
+        return self._arrays
+
+    def count(self, upTo):
+        """How many MOMSNs <= upTo were received (upTo may be an array)."""
+        starts, ends, cum = self._cover()
+        upTo = np.asarray(upTo, dtype=np.int64)
+        k = np.searchsorted(starts, upTo, side='right') - 1
+        safe = np.maximum(k, 0)
+        n = cum[safe] - np.maximum(ends[safe] - upTo, 0) if len(starts) else np.zeros_like(upTo)
+        return np.where(k >= 0, n, 0)
+
+    def __contains__(self, momsn):
+        starts, ends, cum = self._cover()
+        k = np.searchsorted(starts, momsn, side='right') - 1
+        return bool(k >= 0 and ends[k] >= momsn)
+
+    def __len__(self):
+        return int(self._cover()[2][-1]) if self.runs else 0
+
+    def missing(self, lo=None, hi=None):
+        """Gaps [first, last] between lo and hi, by default between the first and last received."""
+        if not self.runs:
+            return [] if lo is None or hi is None else [[int(lo), int(hi)]]
+        starts, ends, cum = self._cover()
+        lo = int(starts[0] if lo is None else lo)
+        hi = int(ends[-1] if hi is None else hi)
+        #runs touching [lo, hi], then the spaces around them
+        a = np.searchsorted(ends, lo)
+        b = np.searchsorted(starts, hi, side='right')
+        edges = np.concatenate([[lo - 1], np.stack([starts[a:b], ends[a:b]], axis=1).ravel(), [hi + 1]])
+        first, last = edges[0::2] + 1, edges[1::2] - 1
+        keep = first <= last
+        return [[int(f), int(l)] for f, l in zip(first[keep], last[keep])]
+
+    def delivered(self, firstDay=None):
+        """(day, received, sent, percent) per day since firstDay (YYYYmmdd), oldest first."""
+        if not self.days or not self.runs:
+            return []
+        days = sorted(self.days)
+        highest = np.maximum.accumulate([self.days[d] for d in days])
+        before = np.concatenate([[self._cover()[0][0] - 1], highest[:-1]])
+        sent = highest - before
+        received = self.count(highest) - self.count(before)
+        out = []
+        for day, r, s in zip(days, received, sent):
+            if (firstDay is None or day >= firstDay) and s > 0:
+                out.append((day, int(r), int(s), float(100 * r / s)))
+        return out
+
+    def summary(self, firstDay=None):
+        """Totals since firstDay, for the report and status page."""
+        days = self.delivered(firstDay)
+        received = sum(d[1] for d in days)
+        sent = sum(d[2] for d in days)
+        gaps = []
+        if days:
+            #the MOMSNs charged to the first reported day start above the days before it
+            older = [v for d, v in self.days.items() if d < days[0][0]]
+            lo = max(older) + 1 if older else self.runs[0][0]
+            gaps = self.missing(lo, self.runs[-1][1])
+        return {'imei': self.imei, 'serial': self.serial,
+                'lastMomsn': self.runs[-1][1] if self.runs else None,
+                'received': received, 'sent': sent,
+                'percent': 100 * received / sent if sent else None,
+                'missing': gaps,
+                'days': [{'day': d, 'received': r, 'sent': s, 'percent': round(p, 1)}
+                         for d, r, s, p in days]}
+
+    def toJson(self):
+        return {'imei': self.imei, 'serial': self.serial, 'runs': self.runs, 'days': self.days}
+
+
+def read(ledgerDir, imei):
+    try:
+        with open(ledgerFile(ledgerDir, imei)) as file:
+            d = json.load(file)
+    except FileNotFoundError:
+        return Ledger(imei)
+    return Ledger(d['imei'], d.get('serial'), d['runs'], d['days'])
+
+
+def loadAll(ledgerDir):
+    """Every ledger in ledgerDir, keyed by imei."""
+    if not os.path.isdir(ledgerDir):
+        return {}
+    return {name[:-5]: read(ledgerDir, name[:-5])
+            for name in sorted(os.listdir(ledgerDir)) if name.endswith('.json')}
+
+
+def bySerial(ledgerDir):
+    """Every ledger with a serial, keyed by the serial as an int."""
+    out = {}
+    for ledger in loadAll(ledgerDir).values():
+        if ledger.serial is not None:
+            out[int(ledger.serial)] = ledger
+    return out
+
+
+def addMany(ledgerDir, imei, entries, serial=None):
+    """
+    Add (momsn, received) pairs to the ledger of imei under its lock.
+    Returns how many were new.
+    """
+    os.makedirs(ledgerDir, exist_ok=True)
+    fileName = ledgerFile(ledgerDir, imei)
+    #the CGI endpoint runs one process per delivery, so lock across processes
+    with open(fileName + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        ledger = read(ledgerDir, imei)
+        added = sum(ledger.add(momsn, received) for momsn, received in entries)
+        if serial not in (None, ''):
+            ledger.serial = int(serial)
+        if added or serial not in (None, ''):
+            tmp = fileName + '.tmp'
+            with open(tmp, 'w') as file:
+                json.dump(ledger.toJson(), file, separators=(',', ':'))
+            os.replace(tmp, fileName)
+    return added
+
+
+def add(ledgerDir, imei, momsn, received=None, serial=None):
+    """Add one delivery. False if its MOMSN was already in the ledger."""
+    return addMany(ledgerDir, imei, [(momsn, received)], serial) == 1
+
+
+def fromCatalog(catalog, ledgerDir):
+    """Add every cataloged transmission with an imei and MOMSN. Returns the number added."""
+    entries, serials = {}, {}
+    for t in catalog.window():
+        if t['imei'] and t['momsn'] is not None:
+            entries.setdefault(t['imei'], []).append((t['momsn'], t['received']))
+            serials[t['imei']] = t['serial']
+    return sum(addMany(ledgerDir, imei, e, serials[imei]) for imei, e in entries.items())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'build':
+        import transmissionCatalog
+        catalog = transmissionCatalog.TransmissionCatalog(sys.argv[2])
+        print(f"added {fromCatalog(catalog, sys.argv[3])} MOMSNs")
+    elif len(sys.argv) in (4, 6) and sys.argv[1] == 'missing':
+        ledger = read(sys.argv[2], sys.argv[3])
+        lo, hi = (int(sys.argv[4]), int(sys.argv[5])) if len(sys.argv) == 6 else (None, None)
+        gaps = ledger.missing(lo, hi)
+        for first, last in gaps:
+            print(first if first == last else f"{first}-{last}")
+        print(f"{sum(l - f + 1 for f, l in gaps)} missing, {len(ledger)} received")
+    else:
+        sys.exit(__doc__)
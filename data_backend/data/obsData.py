@@ -0,0 +1,163 @@
+#!/usr/bin/python3.10
+"""
+Columnar container for the legacy OpenOBS data (the "<2L2Hh" records that
+rockblock.py writes to /srv/data/<serial>/*.csv), shared by update-data.py
+and email-report.py.
+
+Rows go into preallocated arrays that double in size when full, so adding n
+rows costs O(n) overall instead of one np.append copy per row per column.
+Time is kept as datetime64[s] and only turned into strings on export.
+Depth comes from derived.py, computed on first use with the serial's
+calibration and kept until rows are added or dropped. It replaced a fixed
+* 10.1972 m/bar, i.e. a density of 1000 kg/m3, so depths now read deeper
+by the temperature's density deficit: under 0.03% from 0 to 10 C, about
+0.18% at 20 C and 0.3% at 25 C. qc() flags the rows
+with qcFlags.py, over the whole set at once since there is no store.
+"""
+import os
+from datetime import timedelta
+import numpy as np
+import derived
+import qcFlags
+
+columns = ('time', 'pressure', 'ambient', 'backscatter', 'temp', 'battV')
+
+
+def filesSince(fileList, startDate):
+    """
+    Drop transmission files received before startDate. rockblock.py names
+    them by receive time (YYYYmmddHHMMSS...), and a record can't be logged
+    after it was received, so those files hold nothing on or after
+    startDate. The receive time is server local time while records are UTC,
+    so we keep a day of margin. Files with other names are kept.
+    """
+    day = (startDate - timedelta(days=1)).strftime('%Y%m%d')
+    keep = []
+    for f in fileList:
+        name = os.path.basename(f)
+        if not (name[:8].isdigit() and name[:8] < day):
+            keep.append(f)
+    return keep
+
+
+class OBS:
+    __slots__ = ('sn', 'lat', 'lon', 'size', '_cols', '_derived')
+
+    def __init__(self, sn, lat, lon, capacity=256):
+        self.sn = sn
+        self.lat = lat
+        self.lon = lon
+        self.size = 0
+        self._cols = {c: np.empty(capacity, 'datetime64[s]' if c == 'time' else float)
+                      for c in columns}
+        self._derived = None
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, n):
+        capacity = len(self._cols['time'])
+        if self.size + n <= capacity:
+            return
+        while capacity < self.size + n:
+            capacity = max(2*capacity, 1)
+        for c, v in self._cols.items():
+            grown = np.empty(capacity, v.dtype)
+            grown[:self.size] = v[:self.size]
+            self._cols[c] = grown
+
+    def addRows(self, rows):
+        """
+        Add a block of rows [UnixTime, Pressure, Ambient, Backscatter,
+        WaterTemp, battery]. Pressure is bar*1E-4, temp is C*1E-2.
+        """
+        rows = np.asarray(rows, dtype=float).reshape(-1, 6)
+        n = len(rows)
+        self._reserve(n)
+        s = slice(self.size, self.size + n)
+        self._cols['time'][s] = rows[:, 0].astype(np.int64).astype('datetime64[s]')
+        self._cols['pressure'][s] = rows[:, 1]/10
+        self._cols['ambient'][s] = rows[:, 2]
+        self._cols['backscatter'][s] = rows[:, 3]
+        self._cols['temp'][s] = rows[:, 4]/100
+        self._cols['battV'][s] = rows[:, 5]
+        self.size += n
+        self._derived = None
+
+    def addData(self, dataRow):
+        self.addRows([dataRow])
+
+    @property
+    def time(self):
+        return self._cols['time'][:self.size]
+
+    @property
+    def pressure(self):
+        return self._cols['pressure'][:self.size]
+
+    def dataset(self):
+        if self._derived is None:
+            self._derived = derived.Dataset({c: self._cols[c][:self.size] for c in columns},
+                                            'legacy', self.sn)
+        return self._derived
+
+    @property
+    def depth(self):
+        return self.dataset()['waterDepth']
+
+    @property
+    def ambient(self):
+        return self._cols['ambient'][:self.size]
+
+    @property
+    def backscatter(self):
+        return self._cols['backscatter'][:self.size]
+
+    @property
+    def temp(self):
+        return self._cols['temp'][:self.size]
+
+    @property
+    def battV(self):
+        return self._cols['battV'][:self.size]
+
+    def qc(self):
+        """qcFlags.py flags of the rows, which must be sorted by time."""
+        t = self.time.astype(np.int64)
+        cols = {'time': t, 'waterDepth': self.depth, 'backscatter': self.backscatter,
+                'waterTemp': self.temp, 'batteryVoltage': self.battV}
+        return qcFlags.timeFlags(t) | qcFlags.check(cols, None, derived.calibrationFor(self.sn).get('qc'))
+
+    @property
+    def timeString(self):
+        return np.char.replace(np.datetime_as_string(self.time, unit='s'), 'T', ' ')
+
+    @property
+    def lastTransmission(self):
+        if self.size == 0:
+            return ""
+        return str(self.time.max()).replace('T', ' ')
+
+    def applySubset(self, mask):
+        """Keep the rows selected by a boolean mask or an index array."""
+        for c in columns:
+            self._cols[c] = self._cols[c][:self.size][mask]
+        self.size = len(self._cols['time'])
+        self._derived = None
+
+    def sortByTime(self):
+        self.applySubset(np.argsort(self.time, kind='stable'))
+
+    def filterStartDate(self, startDate):
+        self.applySubset(self.time >= np.datetime64(startDate, 's'))
+
+    def __repr__(self):
+        timeString = self.timeString
+        outString = f"Serial Number:\t{self.sn}\n"
+        outString += f"Last transmission: {self.lastTransmission}\n"
+        outString += f"Battery Voltage:\t{self.battV[-1]:.2f}V\n"
+        outString += "time\t\t\t\t\tdepth\tambient\tbackscatter\ttemp\n"
+        for i in range(-3, 0):
+            outString += f"{timeString[i]}\t\t{self.depth[i]:.2f}m\t"
+            outString += f"{self.ambient[i]}\t\t{self.backscatter[i]}\t\t{self.temp[i]:.2f}C\n"
+        return outString
@@ -0,0 +1,80 @@
+#!/usr/bin/python3.10
+"""
+Vectorized decoder for the 2023 Iridium packet format.
+
+Each SBD message is a union of single_record_t structs from the bank logger
+firmware (bank_logger/firmware/OpenOBS_logger/OpenOBS_logger.ino). Every record
+is 16 bytes, i.e. four little endian uint32 words:
+
+    word 0: logtime                       (32 bits)
+    word 1: tuBackground | tuBackscatter  (16 | 16)
+    word 2: waterPressure | waterTemp     (21 | 11, temp is signed)
+    word 3: baroAnomaly | airTemp | batteryVoltage (14 | 10 | 8, first two signed)
+
+Instead of building a ctypes union per message we view a whole batch of
+payloads as one uint32 array and pull every field out with shifts and masks.
+"""
+import numpy as np
+
+recordBytes = 16
+nBytes = 48
+nRecords = nBytes // recordBytes
+
+#(name, word, bit offset, bit width, signed). Same order as the ctypes struct.
+fields = [("logtime", 0, 0, 32, False),
+          ("tuBackground", 1, 0, 16, False),
+          ("tuBackscatter", 1, 16, 16, False),
+          ("waterPressure", 2, 0, 21, False),
+          ("waterTemp", 2, 21, 11, True),
+          ("baroAnomaly", 3, 0, 14, True),
+          ("airTemp", 3, 14, 10, True),
+          ("batteryVoltage", 3, 24, 8, False)]
+labels = [f[0] for f in fields]
+
+
+def extractField(words, offset, width, signed):
+    #words is uint32, so the shift and mask never see a sign bit
+    v = (words >> np.uint32(offset)) & np.uint32((1 << width) - 1)
+    if not signed:
+        return v
+    v = v.astype(np.int32)
+    signBit = np.int32(1 << (width - 1))
+    return (v ^ signBit) - signBit
+
+
+def payloadArray(payloads, packetBytes=nBytes):
+    """
+    Turn a batch of payloads into a (nPackets, packetBytes) uint8 array.
+    Accepts hex strings, bytes, or an array/buffer that is already packed.
+    """
+    if isinstance(payloads, np.ndarray):
+        return payloads.reshape(-1, packetBytes).view(np.uint8)
+    if isinstance(payloads, (bytes, bytearray, memoryview)):
+        return np.frombuffer(payloads, dtype=np.uint8).reshape(-1, packetBytes)
+
+    buf = bytearray()
+    for p in payloads:
+        if isinstance(p, str):
+            p = bytes.fromhex(p.strip())
+        if len(p) != packetBytes:
+            raise ValueError(f"payload is {len(p)} bytes, expected {packetBytes}")
+        buf += p
+    return np.frombuffer(bytes(buf), dtype=np.uint8).reshape(-1, packetBytes)
+
+
+def decodePackets(payloads, packetBytes=nBytes):
+    """
+    Decode many raw payloads at once. Returns a dict of 1D arrays, one entry
+    per record, in packet order. 'packet' holds the index of the source
+    payload for each record.
+    """
+    raw = payloadArray(payloads, packetBytes)
+    recPerPacket = packetBytes // recordBytes
+    words = np.ascontiguousarray(raw[:, :recPerPacket*recordBytes])
+    words = words.view('<u4').reshape(-1, 4).astype(np.uint32, copy=False)
+
+    out = {}
+    for name, word, offset, width, signed in fields:
+        out[name] = extractField(words[:, word], offset, width, signed)
+    out["packet"] = np.repeat(np.arange(raw.shape[0]), recPerPacket)
+    return out
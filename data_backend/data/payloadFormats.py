@@ -0,0 +1,166 @@
+#!/usr/bin/python3.10
+"""
+Registry of the on-the-wire payload formats in the archive, so one pass can
+decode a mix of them.
+
+Formats are tried in registration order. A format claims a payload by its
+length and, for formats that carry one, by a header check; payloads of the
+same length are checked and decoded together as one array, so a whole
+history goes through each vectorized decoder in a few large batches.
+Anything no format claims, or that its format fails to decode (a decoder
+raises ValueError), is counted as unrecognized.
+
+Registered:
+    2023-v1        48 bytes, 3 bit-packed single_record_t (packetDecode.py)
+    legacy-v1      14k+2 bytes (k >= 3), "<2L2Hh" records as rockblock.py
+                   unpacks them: battery ADC count over the first two bytes
+                   (and so over the first time), two bytes of padding at the end
+    2023-delta-v1  50 bytes starting with version byte 0xD1, a variable
+                   number of 2023 records delta coded (deltaCodec.py)
+
+The first two carry no header, so their checks pass everything and the
+length alone tells them apart. Each format names the derived.py units that
+turn its columns into engineering units.
+"""
+import numpy as np
+import packetDecode
+import deltaCodec
+
+#name -> {'units', 'columns', 'labels', 'lengthOk', 'check', 'decode'}
+formats = {}
+
+
+def register(name, units, columns, labels, lengthOk, decode, check=None):
+    """
+    lengthOk(nBytes) -> bool, check(raw) -> bool mask over the rows of a
+    (nPackets, nBytes) uint8 array, decode(raw) -> dict of per-record
+    columns plus 'packet', the row each record came from.
+    """
+    formats[name] = {'name': name, 'units': units, 'columns': columns, 'labels': labels,
+                     'lengthOk': lengthOk, 'decode': decode,
+                     'check': check or (lambda raw: np.ones(len(raw), bool))}
+
+
+def _decode2023(raw):
+    return packetDecode.decodePackets(raw, raw.shape[1])
+
+
+legacyDtype = np.dtype([('UnixTime', '<u4'), ('Pressure', '<u4'), ('Ambient', '<u2'),
+                        ('Backscatter', '<u2'), ('WaterTemp', '<i2')])
+legacyLabels = ["UnixTime", "Pressure[bar_1E-4]", "Ambient[DN]", "Backscatter[DN]",
+                "WaterTemp[C_1E-2]", "battery[V]"]
+
+
+def _legacyLength(n):
+    return n >= 3*legacyDtype.itemsize + 2 and (n - 2) % legacyDtype.itemsize == 0
+
+
+def _decodeLegacy(raw):
+    nPackets, n = raw.shape
+    k = (n - 2) // legacyDtype.itemsize
+    battery = (raw[:, 1].astype(np.uint16) << 8 | raw[:, 0]) / 1023 * 5
+    records = np.ascontiguousarray(raw[:, :n-2]).view(legacyDtype).reshape(nPackets, k)
+
+    out = {c: records[c].ravel() for c in legacyDtype.names}
+    #first time is corrupted by the battery bytes, infer it from the second and third
+    t = records['UnixTime'].astype(np.int64)
+    t[:, 0] = t[:, 1] - (t[:, 2] - t[:, 1])
+    out['UnixTime'] = t.ravel()
+    out['battery'] = np.repeat(battery, k)
+    out['packet'] = np.repeat(np.arange(nPackets), k)
+    return out
+
+
+register('2023-v1', '2023', packetDecode.labels, packetDecode.labels,
+         lambda n: n == packetDecode.nBytes, _decode2023)
+register('legacy-v1', 'legacyPacket', list(legacyDtype.names) + ['battery'], legacyLabels,
+         _legacyLength, _decodeLegacy)
+register('2023-delta-v1', '2023', packetDecode.labels, packetDecode.labels,
+         lambda n: n == deltaCodec.nBytes, deltaCodec.decodePackets,
+         lambda raw: raw[:, 0] == deltaCodec.version)
+
+
+def detect(payload):
+    """Name of the format that claims one payload (bytes), or None."""
+    raw = np.frombuffer(payload, dtype=np.uint8).reshape(1, -1)
+    for fmt in formats.values():
+        if fmt['lengthOk'](len(payload)) and fmt['check'](raw)[0]:
+            return fmt['name']
+    return None
+
+
+def _decodes(fmt, row):
+    try:
+        fmt['decode'](row)
+    except ValueError:
+        return False
+    return True
+
+
+def decodeArray(raw):
+    """
+    Decode a (nPackets, nBytes) uint8 array of payloads that all have the
+    same length, e.g. a memmap over rawArchive.py. The formats take views of
+    it, so nothing is copied before the decoders. Returns (groups, counts)
+    as decodeBatch with 'packet' indexing the rows of raw.
+    """
+    nPackets, n = raw.shape
+    groups = []
+    counts = dict.fromkeys(formats, 0)
+    counts['unrecognized'] = 0
+    left = np.ones(nPackets, bool)
+    for fmt in formats.values():
+        if not fmt['lengthOk'](n):
+            continue
+        claimed = left & fmt['check'](raw)
+        if not claimed.any():
+            continue
+        #every row claimed is the usual case, and needs no fancy indexing copy
+        rows = np.flatnonzero(claimed)
+        try:
+            cols = fmt['decode'](raw if len(rows) == nPackets else raw[rows])
+        except ValueError:
+            #a corrupt payload among them: keep the rows that decode on their own
+            rows = np.array([r for r in rows if _decodes(fmt, raw[r:r+1])], dtype=np.int64)
+            claimed[:] = False
+            claimed[rows] = True
+            if not len(rows):
+                continue
+            cols = fmt['decode'](raw[rows])
+        cols['packet'] = rows[cols['packet']]
+        groups.append((fmt['name'], cols))
+        counts[fmt['name']] += len(rows)
+        left &= ~claimed
+    counts['unrecognized'] += int(left.sum())
+    return groups, counts
+
+
+def addCounts(total, counts):
+    for name, n in counts.items():
+        total[name] = total.get(name, 0) + n
+    return total
+
+
+def decodeBatch(payloads):
+    """
+    Decode a list of payloads (bytes) of any mix of formats. Returns
+    (groups, counts): groups is a list of (format name, columns) where
+    columns['packet'] indexes into payloads, and counts maps each format
+    name and 'unrecognized' to a number of payloads.
+    """
+    byLength = {}
+    for i, p in enumerate(payloads):
+        byLength.setdefault(len(p), []).append(i)
+
+    groups = []
+    counts = dict.fromkeys(formats, 0)
+    counts['unrecognized'] = 0
+    for n, idx in sorted(byLength.items()):
+        idx = np.array(idx)
+        raw = np.frombuffer(b''.join(payloads[i] for i in idx), dtype=np.uint8).reshape(len(idx), n)
+        lengthGroups, lengthCounts = decodeArray(raw)
+        for name, cols in lengthGroups:
+            cols['packet'] = idx[cols['packet']]
+            groups.append((name, cols))
+        addCounts(counts, lengthCounts)
+    return groups, counts
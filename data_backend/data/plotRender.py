@@ -0,0 +1,147 @@
+#!/usr/bin/python3.10
+"""
+Station plots rendered with the object oriented matplotlib API, spread over
+a process pool, and skipped when nothing they depend on has changed.
+
+A plot is described by a plain dict (a "job") so it can be pickled to a
+worker:
+
+    {'fileName': '/var/www/html/assets/209175.png',
+     'title': 'Iridium SN: 209175.',
+     'xlim': [t0, t1] or None,
+     'sharex': True,          #panels share the time axis
+     'hideXTicks': False,     #blank the time ticks on all but the last panel
+     'size': (4, 6), 'dpi': 300,
+     'decimate': True,        #min/max per pixel column before drawing
+     'panels': [{'ylabel': 'Backscatter', 'ylim': [3000, 10000] or None,
+                 'legend': 'upper left' or None,
+                 'series': [{'x': times, 'y': values, 'fmt': 'b.', 'label': None}]}]}
+
+The sha1 of the job (arrays included) is written next to the PNG as
+<fileName>.sha1. If it matches on the next run the PNG is left alone.
+renderBytes draws a job into memory instead, for figures nobody keeps.
+"""
+import io
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import decimate
+import metrics
+
+os.environ.setdefault('MPLCONFIGDIR', "/tmp/")
+
+
+def jobHash(job):
+    h = hashlib.sha1()
+
+    def walk(obj):
+        if isinstance(obj, np.ndarray):
+            h.update(str(obj.dtype).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, dict):
+            for k in sorted(obj):
+                h.update(k.encode())
+                walk(obj[k])
+        elif isinstance(obj, (list, tuple)):
+            for v in obj:
+                walk(v)
+        else:
+            h.update(json.dumps(obj, default=str).encode())
+
+    walk(job)
+    return h.hexdigest()
+
+
+def hashFile(job):
+    return job['fileName'] + '.sha1'
+
+
+def isCurrent(job, digest):
+    try:
+        with open(hashFile(job)) as file:
+            return file.read().strip() == digest and os.path.exists(job['fileName'])
+    except FileNotFoundError:
+        return False
+
+
+def renderFigure(job):
+    #imported here so a run where every plot is current never loads matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=job.get('size', (4, 6)))
+    FigureCanvasAgg(fig)
+    panels = job['panels']
+    axes = []
+    for i, p in enumerate(panels):
+        share = axes[0] if (axes and job.get('sharex', True)) else None
+        ax = fig.add_subplot(len(panels), 1, i+1, sharex=share)
+        for s in p['series']:
+            ax.plot(s['x'], s['y'], s.get('fmt', 'k.'), label=s.get('label'))
+        ax.set_ylabel(p['ylabel'])
+        if p.get('ylim') is not None:
+            ax.set_ylim(p['ylim'])
+        if p.get('legend'):
+            ax.legend(loc=p['legend'])
+        if job.get('hideXTicks') and i < len(panels)-1:
+            ax.get_xaxis().set_ticks([])
+        axes.append(ax)
+
+    if job.get('xlim') is not None:
+        axes[0].set_xlim(job['xlim'])
+    axes[0].set_title(job['title'])
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    fig.savefig(job['fileName'], dpi=job.get('dpi', 300))
+    return job['fileName']
+
+
+def renderBytes(job):
+    """Render a job straight to PNG bytes (e.g. for email). fileName is ignored."""
+    if job.get('decimate', True):
+        decimate.decimateJob(job)
+    buffer = io.BytesIO()
+    renderFigure(dict(job, fileName=buffer))
+    return buffer.getvalue()
+
+
+def _render(job, digest):
+    start = time.perf_counter()
+    renderFigure(job)
+    with open(hashFile(job), 'w') as file:
+        file.write(digest)
+    return job['fileName'], time.perf_counter() - start
+
+
+def renderAll(jobs, processes=None):
+    """
+    Render every job whose hash changed, in parallel. Returns the list of
+    files that were (re)written. Render time per plot goes to metrics.py.
+    """
+    todo = []
+    for job in jobs:
+        if job.get('decimate', True):
+            decimate.decimateJob(job)
+        digest = jobHash(job)
+        if not isCurrent(job, digest):
+            todo.append((job, digest))
+
+    if len(todo) <= 1 or processes == 1:
+        done = [_render(job, digest) for job, digest in todo]
+    else:
+        #fork, not the spawn default on macOS: spawned workers re-run the calling
+        #script, which has no main guard and would wait on its run lock
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = [pool.submit(_render, job, digest) for job, digest in todo]
+            done = [f.result() for f in futures]
+
+    for fileName, seconds in done:
+        #plots are named after their serial
+        plot = os.path.splitext(os.path.basename(fileName))[0]
+        metrics.observe('obs_plot_seconds', seconds, plot=plot)
+        metrics.inc('obs_bytes_written_total', metrics.fileBytes(fileName), kind='png')
+    return [fileName for fileName, seconds in done]
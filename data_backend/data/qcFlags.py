@@ -0,0 +1,288 @@
+#!/usr/bin/python3.10
+"""
+Quality control of decoded records, kept as one bitmask column 'qc' in the
+series store next to the values it describes, so outliers stay in the data
+but drop out of the plots, rollups and tiles.
+
+Checks per variable (the ones rollups.py summarises):
+
+    range   outside limits[var]
+    spike   further from the median of the spikeWindow records before it
+            than spikeMads scaled median absolute deviations, and at least
+            spikeMin[var]
+    stuck   the stuckRun[var]-th identical value in a row, or later
+
+and per record:
+
+    time    logged before timeMin or more than timeAhead seconds after now,
+            or not after the record before it in the same packet
+    droop   battery more than droopVolts under the median of the
+            droopWindow records before it; an alert, the values are kept
+
+Bit 3*i + j holds check j of variables[i], time and droop are the two bits
+above those. good(qc, var) is False where var or the record's time is
+flagged. limits can be overridden per serial with a "qc" entry in the
+calibration file (derived.py), e.g. {"209175": {"qc": {"waterDepth": [0.1, 5]}}}.
+
+The checks only look back, never more than window records, so records are
+checked as they come in: update() takes the serial's last window records
+from stateDir/<sn>.json, or from the store for a batch older than that,
+and moves the state along. A late packet doesn't re-check the records
+already stored after it.
+
+Stores written before the qc column existed read as all zeros. flagStore()
+checks every record already stored in one pass and starts the state from
+them; update-data-2023.py runs it once per serial, and stateDir/<sn>.checked
+records that it has. A serial whose first records come through update()
+needs no pass.
+"""
+import os
+import json
+import time
+import warnings
+import numpy as np
+import derived
+import seriesStore
+
+variables = ['waterDepth', 'backscatter', 'waterTemp', 'airTemp', 'batteryVoltage']
+checks = ['range', 'spike', 'stuck']
+
+limits = {'waterDepth': (0.0, 30.0),        #m, below 0 the sensor is out of the water
+          'backscatter': (1, 65534),        #counts, 0 and 65535 are the ends of the ADC
+          'waterTemp': (-2.0, 40.0),        #C
+          'airTemp': (-55.0, 45.0),         #C
+          'batteryVoltage': (2.5, 16.0)}    #V, legacy loggers report ~4 V, 2023 ones ~13 V
+spikeWindow = 9
+spikeMads = 6
+spikeMin = {'waterDepth': 0.5, 'backscatter': 2000, 'waterTemp': 3.0, 'airTemp': 15.0,
+            'batteryVoltage': 1.0}
+#None to skip, temperatures sit at 0.0 C under ice for months
+stuckRun = {'waterDepth': 12, 'backscatter': 12, 'waterTemp': None, 'airTemp': None,
+            'batteryVoltage': None}
+timeMin = 1577836800 #2020-01-01
+timeAhead = 2*86400
+droopWindow = 36
+droopVolts = 0.5
+window = max(spikeWindow, droopWindow, *(n for n in stuckRun.values() if n))
+#how far back to look in the store for the records before a late batch
+lookback = 30*86400
+
+TIME = 1 << 3*len(variables)
+DROOP = TIME << 1
+
+
+def bit(var, check):
+    return 1 << (3*variables.index(var) + checks.index(check))
+
+
+def varBits(var):
+    return bit(var, 'range') | bit(var, 'spike') | bit(var, 'stuck') | TIME
+
+
+def good(qc, var):
+    """True where neither var nor the record's time is flagged."""
+    return (np.asarray(qc, dtype=np.uint32) & np.uint32(varBits(var))) == 0
+
+
+def counts(qc):
+    """{'<var> <check>' / 'time' / 'droop': number of records flagged}, non-zero only."""
+    qc = np.asarray(qc, dtype=np.uint32)
+    out = {}
+    for var in variables:
+        for check in checks:
+            n = int(np.count_nonzero(qc & np.uint32(bit(var, check))))
+            if n:
+                out[f"{var} {check}"] = n
+    for name, b in (('time', TIME), ('droop', DROOP)):
+        n = int(np.count_nonzero(qc & np.uint32(b)))
+        if n:
+            out[name] = n
+    return out
+
+
+def timeFlags(t, packet=None, now=None):
+    """TIME where t (unix seconds) is out of range or, given packet, goes backwards within a packet."""
+    t = np.asarray(t, dtype=np.int64)
+    now = time.time() if now is None else now
+    bad = (t < timeMin) | (t > now + timeAhead)
+    if packet is not None and len(t) > 1:
+        packet = np.asarray(packet)
+        bad[1:] |= (packet[1:] == packet[:-1]) & (t[1:] <= t[:-1])
+    return np.where(bad, TIME, 0).astype(np.uint32)
+
+
+def _before(full, h, w):
+    #(n, w) the w values before each of full[h:], NaN before the start
+    padded = np.concatenate([np.full(w, np.nan), full])
+    return np.lib.stride_tricks.sliding_window_view(padded[:-1], w)[h:]
+
+
+def check(cols, history=None, qcLimits=None):
+    """
+    Flags (uint32) for records cols, sorted by time, following history (the
+    records before them, sorted, at most window of them). Both map names to
+    arrays; variables a format doesn't have can be missing or NaN.
+    """
+    history = history or {}
+    lim = dict(limits, **{k: tuple(v) for k, v in (qcLimits or {}).items()})
+    n = len(cols['time'])
+    qc = np.zeros(n, np.uint32)
+    if not n:
+        return qc
+    with warnings.catch_warnings():
+        #windows of nothing but NaN, at the start of a serial
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for var in variables:
+            if var not in cols:
+                continue
+            v = np.asarray(cols[var], dtype=float)
+            past = np.asarray(history.get(var, []), dtype=float)[-window:]
+            h = len(past)
+            full = np.concatenate([past, v])
+
+            lo, hi = lim[var]
+            flag = np.where((v < lo) | (v > hi), bit(var, 'range'), 0)
+
+            prev = _before(full, h, spikeWindow)
+            med = np.nanmedian(prev, axis=1)
+            mad = 1.4826*np.nanmedian(np.abs(prev - med[:, None]), axis=1)
+            enough = np.count_nonzero(~np.isnan(prev), axis=1) > spikeWindow // 2
+            spike = enough & (np.abs(v - med) > np.maximum(spikeMads*mad, spikeMin[var]))
+            flag |= np.where(spike, bit(var, 'spike'), 0)
+
+            if stuckRun[var]:
+                #length of the run of equal values ending at each record
+                k = np.arange(len(full))
+                reset = np.concatenate([[True], full[1:] != full[:-1]])
+                run = k - np.maximum.accumulate(np.where(reset, k, 0)) + 1
+                flag |= np.where(run[h:] >= stuckRun[var], bit(var, 'stuck'), 0)
+
+            if var == 'batteryVoltage':
+                base = np.nanmedian(_before(full, h, droopWindow), axis=1)
+                flag |= np.where(v < base - droopVolts, DROOP, 0)
+            qc |= flag.astype(np.uint32)
+    return qc
+
+
+def stateFile(stateDir, sn):
+    return os.path.join(stateDir, f"{sn}.json")
+
+
+def _readState(stateDir, sn):
+    try:
+        with open(stateFile(stateDir, sn)) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return None
+    return {k: np.array(v, dtype=np.int64 if k == 'time' else float) for k, v in state.items()}
+
+
+def checkedFile(stateDir, sn):
+    return os.path.join(stateDir, f"{sn}.checked")
+
+
+def _writeState(stateDir, sn, cols):
+    #the newest window records of cols
+    last = np.argsort(cols['time'], kind='stable')[-window:]
+    os.makedirs(stateDir, exist_ok=True)
+    tmp = stateFile(stateDir, sn) + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump({k: v[last].tolist() if k == 'time' else np.where(np.isnan(v[last]), None, v[last]).tolist()
+                   for k, v in cols.items()}, file)
+    os.replace(tmp, stateFile(stateDir, sn))
+
+
+def _markChecked(stateDir, sn):
+    os.makedirs(stateDir, exist_ok=True)
+    open(checkedFile(stateDir, sn), 'w').close()
+
+
+def _hasRecords(storeDir, sn):
+    return sn in seriesStore.listSerials(storeDir) and seriesStore.SeriesStore(storeDir, sn).rows > 0
+
+
+def unchecked(stateDir, storeDir):
+    """Serials with records stored before their qc was worked out."""
+    out = []
+    for sn in seriesStore.listSerials(storeDir):
+        if os.path.exists(checkedFile(stateDir, sn)):
+            continue
+        if _hasRecords(storeDir, sn):
+            out.append(sn)
+        else:
+            #nothing stored yet, checked from its first record on
+            _markChecked(stateDir, sn)
+    return out
+
+
+def flagStore(stateDir, storeDir, sn):
+    """
+    Check every record stored for serial sn, as if they had come in in time
+    order, OR the flags into the qc column and start the state from them.
+    Returns the times of the records whose flags changed, for the rollups
+    and tiles to refresh.
+    """
+    sn = str(sn)
+    store = seriesStore.SeriesStore(storeDir, sn)
+    names = ['time', 'qc'] + [v for v in variables if v in store.columns]
+    cols = store.stored(names)
+    t = cols['time'].astype(np.int64)
+    order = np.argsort(t, kind='stable')
+    new = {k: cols[k][order].astype(float) for k in names[2:]}
+    new['time'] = t[order]
+
+    old = cols['qc'].astype(np.uint32)
+    qc = old | timeFlags(t)
+    qc[order] |= check(new, None, derived.calibrationFor(sn).get('qc'))
+    changed = qc != old
+    if changed.any():
+        store.rewriteColumn('qc', qc)
+    _writeState(stateDir, sn, new)
+    _markChecked(stateDir, sn)
+    return t[changed]
+
+
+def _fromStore(storeDir, sn, t0):
+    if sn not in seriesStore.listSerials(storeDir):
+        return {}
+    store = seriesStore.SeriesStore(storeDir, sn)
+    d = store.query(t0 - lookback, t0 - 1, ['time'] + [v for v in variables if v in store.columns])
+    return {k: (v.astype(np.int64) if k == 'time' else v.astype(float))[-window:] for k, v in d.items()}
+
+
+def update(stateDir, storeDir, sn, cols):
+    """
+    Flags for a batch of new records of serial sn, in cols' own order, ORed
+    with any cols['qc'] already holds (timeFlags). Call before the batch is
+    appended to the store.
+    """
+    sn = str(sn)
+    t = np.asarray(cols['time'], dtype=np.int64)
+    if len(t) == 0:
+        return np.zeros(0, np.uint32)
+    order = np.argsort(t, kind='stable')
+    new = {k: np.asarray(cols[k])[order] for k in ['time'] + variables if k in cols}
+    new['time'] = t[order]
+
+    if not os.path.exists(checkedFile(stateDir, sn)) and not _hasRecords(storeDir, sn):
+        #a new serial, checked from its first record on
+        _markChecked(stateDir, sn)
+    state = _readState(stateDir, sn)
+    if state is not None and len(state['time']) and state['time'][-1] < new['time'][0]:
+        history = state
+    else:
+        #first batch, or one from before the state: the store has its past
+        history = _fromStore(storeDir, sn, int(new['time'][0]))
+    qcLimits = derived.calibrationFor(sn).get('qc')
+
+    qc = np.empty(len(t), np.uint32)
+    qc[order] = check(new, history, qcLimits)
+    if 'qc' in cols:
+        qc |= np.asarray(cols['qc'], dtype=np.uint32)
+
+    #the state is the newest window records seen so far
+    old = state or {}
+    size = len(old.get('time', []))
+    merged = {k: np.concatenate([old.get(k, np.full(size, np.nan)), v]) for k, v in new.items()}
+    _writeState(stateDir, sn, merged)
+    return qc
@@ -0,0 +1,190 @@
+#!/usr/bin/python3.10
+"""
+Binary archive of raw payloads, one pair of fixed-record files per serial
+and payload length:
+
+    archiveDir/<sn>/<n>.bin     payloads of n bytes, in arrival order
+    archiveDir/<sn>/<n>.meta    one metaDtype record per payload
+
+Both files are plain arrays, so packets(n) is an np.memmap of shape
+(rows, n) that payloadFormats.decodeArray reads in place, without a hex
+parse or a copy per packet, and metadata(n) is a structured memmap of
+the same rows.
+
+An append writes the payloads first and the metadata second, and the row
+count is taken from the .meta file. A crash between the two leaves extra
+payload bytes, which the next append cuts off.
+
+committed.json holds the row count of each length as of the caller's last
+commit(), after update-data-2023.py committed its manifest. Rows past it
+can only be from a run that stopped before its commit, so that is all a
+rerun has to check for names it already archived.
+
+update-data-2023.py appends every transmission it accepts. To start the
+archive from an existing raw archive and transmission log (once, into an
+empty archiveDir):
+    python rawArchive.py import <rawDir> <archiveDir> [walDir]
+"""
+import os
+import sys
+import json
+from datetime import datetime
+import numpy as np
+
+metaDtype = np.dtype([('received', '<i8'),   #unix seconds, server time
+                      ('momsn', '<i8'),      #-1 when the raw file had none
+                      ('lat', '<f4'),
+                      ('lon', '<f4'),
+                      ('name', 'S40')])      #unpacked file name within the serial
+
+
+def receivedSeconds(timeString):
+    #YYYYmmddHHMMSS, as rockblockIngest.newTimeString and the raw file names
+    try:
+        return int(datetime.strptime(str(timeString)[:14], '%Y%m%d%H%M%S').timestamp())
+    except ValueError:
+        return 0
+
+
+def metaRecord(name, received, momsn=None, lat=None, lon=None):
+    def number(v, cast, missing):
+        try:
+            return cast(v)
+        except (TypeError, ValueError):
+            return missing
+    return (receivedSeconds(received), number(momsn, int, -1), number(lat, float, np.nan),
+            number(lon, float, np.nan), os.path.basename(name).encode()[:40])
+
+
+def listSerials(archiveDir):
+    if not os.path.isdir(archiveDir):
+        return []
+    return sorted(d for d in os.listdir(archiveDir) if os.path.isdir(os.path.join(archiveDir, d)))
+
+
+class RawArchive:
+    def __init__(self, archiveDir, sn):
+        self.sn = str(sn)
+        self.path = os.path.join(archiveDir, self.sn)
+
+    def _file(self, n, ext):
+        return os.path.join(self.path, f"{n}.{ext}")
+
+    def lengths(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(int(f[:-5]) for f in names if f.endswith('.meta'))
+
+    def rows(self, n):
+        try:
+            return os.path.getsize(self._file(n, 'meta')) // metaDtype.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def _map(self, fileName, dtype, shape, start, stop):
+        rows = shape[0]
+        stop = rows if stop is None else min(stop, rows)
+        if rows == 0 or start >= stop:
+            return np.zeros((0,) + shape[1:], dtype)
+        return np.memmap(fileName, dtype=dtype, mode='r', shape=shape)[start:stop]
+
+    def packets(self, n, start=0, stop=None):
+        """(rows, n) uint8 memmap of the payloads of length n."""
+        return self._map(self._file(n, 'bin'), np.uint8, (self.rows(n), n), start, stop)
+
+    def metadata(self, n, start=0, stop=None):
+        return self._map(self._file(n, 'meta'), metaDtype, (self.rows(n),), start, stop)
+
+    def committed(self, n):
+        """Rows of length n as of the last commit(), 0 before the first."""
+        try:
+            with open(os.path.join(self.path, 'committed.json')) as file:
+                rows = json.load(file).get(str(n), 0)
+        except FileNotFoundError:
+            return 0
+        return min(rows, self.rows(n))
+
+    def commit(self):
+        """Mark every row archived so far as committed."""
+        if not os.path.isdir(self.path):
+            return
+        fileName = os.path.join(self.path, 'committed.json')
+        tmp = fileName + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump({str(n): self.rows(n) for n in self.lengths()}, file)
+        os.replace(tmp, fileName)
+
+    def append(self, payloads, meta):
+        """
+        Append payloads (bytes) with their metaRecord tuples. Returns
+        {n: (first row, stop row)} for each payload length written.
+        """
+        byLength = {}
+        for p, m in zip(payloads, meta):
+            byLength.setdefault(len(p), []).append((p, m))
+        os.makedirs(self.path, exist_ok=True)
+        written = {}
+        for n, items in sorted(byLength.items()):
+            start = self.rows(n)
+            with open(self._file(n, 'bin'), 'ab') as file:
+                #drop payload bytes left by an append that never got its metadata
+                file.truncate(start * n)
+                file.write(b''.join(p for p, m in items))
+            with open(self._file(n, 'meta'), 'ab') as file:
+                file.write(np.array([m for p, m in items], dtype=metaDtype).tobytes())
+            written[n] = (start, start + len(items))
+        return written
+
+
+def importArchive(rawDir, archiveDir, walDir=None):
+    import unpackBatch
+    import transmissionLog
+    import dedupeIndex
+
+    if listSerials(archiveDir):
+        sys.exit(f"{archiveDir} is not empty")
+    seen = set()
+    total = 0
+    serials = sorted(set(os.listdir(rawDir) if os.path.isdir(rawDir) else []) |
+                     set(transmissionLog.listSerials(walDir) if walDir else []))
+    for sn in serials:
+        payloads = []
+        meta = []
+
+        def add(fields, dataString, name, received):
+            key = dedupeIndex.messageKey(fields.get('imei') or sn, fields.get('momsn'), dataString)
+            try:
+                payload = bytes.fromhex(dataString)
+            except ValueError:
+                return
+            if key in seen or not payload:
+                return
+            seen.add(key)
+            payloads.append(payload)
+            meta.append(metaRecord(name, received, fields.get('momsn'),
+                                   fields.get('latitude', fields.get('iridium_latitude')),
+                                   fields.get('longitude', fields.get('iridium_longitude'))))
+
+        serialDir = os.path.join(rawDir, sn)
+        if os.path.isdir(serialDir):
+            for name in sorted(f for f in os.listdir(serialDir) if f.endswith('.csv')):
+                fields, dataString = unpackBatch.readRaw(os.path.join(serialDir, name))
+                add(fields, dataString, name, name)
+        if walDir:
+            for seq, fields in transmissionLog.replayMessages(walDir, sn, 1):
+                add(fields, (fields.get('data') or '').strip(), unpackBatch.walName(fields),
+                    fields.get('received'))
+        archive = RawArchive(archiveDir, sn)
+        archive.append(payloads, meta)
+        archive.commit()
+        total += len(payloads)
+        print(f"{sn}: {len(payloads)} payloads")
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5) or sys.argv[1] != 'import':
+        sys.exit(__doc__)
+    importArchive(*sys.argv[2:])
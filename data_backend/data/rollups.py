@@ -0,0 +1,125 @@
+#!/usr/bin/python3.10
+"""
+Hourly and daily min/mean/max/count rollups per serial, kept up to date as
+packets are decoded.
+
+When records land in the series store we recompute just the hours they fall
+in, straight from the store (which only opens the partitions overlapping
+those hours), and then the days those hours belong to from the hourly rows.
+Values qcFlags.py flagged are left out. Records are de-duplicated on their
+log time before aggregating, so the
+rollups come out the same no matter in which order packets arrive or how
+often a packet is ingested again.
+
+Stored in SQLite as (serial, res, var, bucket start) -> n, min, max, sum;
+mean is sum/n.
+"""
+import sqlite3
+import numpy as np
+import seriesStore
+import qcFlags
+
+variables = ['waterDepth', 'backscatter', 'waterTemp', 'airTemp', 'batteryVoltage']
+resolutions = {'hour': 3600, 'day': 86400}
+
+schemaSql = """
+CREATE TABLE IF NOT EXISTS rollup (
+    serial TEXT, res TEXT, var TEXT, bucket INTEGER,
+    n INTEGER, min REAL, max REAL, sum REAL,
+    PRIMARY KEY (serial, res, var, bucket)
+) WITHOUT ROWID;
+"""
+
+
+def connect(dbFile):
+    db = sqlite3.connect(dbFile)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(schemaSql)
+    return db
+
+
+def aggregate(bucket, values):
+    """Per bucket (start, n, min, max, sum) of values, ignoring NaN. bucket is sorted."""
+    ok = ~np.isnan(values)
+    bucket, values = bucket[ok], values[ok]
+    if len(values) == 0:
+        return []
+    keys, start, n = np.unique(bucket, return_index=True, return_counts=True)
+    return zip(keys, n, np.minimum.reduceat(values, start),
+               np.maximum.reduceat(values, start), np.add.reduceat(values, start))
+
+
+def update(dbFile, storeDir, sn, times):
+    """
+    Recompute the hours (and their days) touched by records with the given
+    log times (unix seconds). Call after the records are in the store.
+    """
+    hour, day = resolutions['hour'], resolutions['day']
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return
+    hours = np.unique(times // hour * hour)
+    sn = str(sn)
+    d = seriesStore.query(storeDir, sn, int(hours[0]), int(hours[-1]) + hour - 1,
+                          ['time', 'qc'] + variables)
+    #query sorts by time, so the first copy of each log time is kept and
+    #re-ingested records drop out
+    t = d['time'].astype(np.int64)
+    _, keep = np.unique(t, return_index=True)
+    hourOf = t[keep] // hour * hour
+    keep = keep[np.isin(hourOf, hours)]
+    hourOf = t[keep] // hour * hour
+
+    db = connect(dbFile)
+    with db:
+        rows = []
+        for var in variables:
+            values = d[var][keep].astype(float)
+            values[~qcFlags.good(d['qc'][keep], var)] = np.nan
+            for b, n, lo, hi, s in aggregate(hourOf, values):
+                rows.append((sn, 'hour', var, int(b), int(n), float(lo), float(hi), float(s)))
+        #an hour that lost all its records (can't happen with an append-only
+        #store, but keep the table exact) is cleared first
+        db.executemany("DELETE FROM rollup WHERE serial=? AND res='hour' AND bucket=?",
+                       [(sn, int(h)) for h in hours])
+        db.executemany("INSERT OR REPLACE INTO rollup VALUES (?,?,?,?,?,?,?,?)", rows)
+
+        #days are exact combinations of their hours
+        for d0 in np.unique(hours // day * day):
+            db.execute("DELETE FROM rollup WHERE serial=? AND res='day' AND bucket=?",
+                       (sn, int(d0)))
+            db.execute("""INSERT INTO rollup
+                          SELECT serial, 'day', var, ?, SUM(n), MIN(min), MAX(max), SUM(sum)
+                          FROM rollup WHERE serial=? AND res='hour' AND bucket>=? AND bucket<?
+                          GROUP BY serial, var""",
+                       (int(d0), sn, int(d0), int(d0) + day))
+    db.close()
+
+
+def read(dbFile, sn, res='hour', t0=None, t1=None, var=None):
+    """
+    Rollup rows for a serial as {var: {'time','n','min','mean','max'}} with
+    time as datetime64[s] bucket starts. t0/t1 are unix seconds or datetimes.
+    """
+    where = ["serial=?", "res=?"]
+    args = [str(sn), res]
+    if t0 is not None:
+        where.append("bucket>=?")
+        args.append(seriesStore._seconds(t0))
+    if t1 is not None:
+        where.append("bucket<=?")
+        args.append(seriesStore._seconds(t1))
+    if var is not None:
+        where.append("var=?")
+        args.append(var)
+    db = connect(dbFile)
+    rows = db.execute("SELECT var, bucket, n, min, max, sum FROM rollup WHERE " +
+                      " AND ".join(where) + " ORDER BY var, bucket", args).fetchall()
+    db.close()
+    out = {}
+    for v in sorted({r[0] for r in rows}):
+        r = np.array([x[1:] for x in rows if x[0] == v], dtype=float)
+        out[v] = {'time': r[:, 0].astype(np.int64).astype('datetime64[s]'),
+                  'n': r[:, 1].astype(np.int64), 'min': r[:, 2],
+                  'mean': r[:, 4]/r[:, 1], 'max': r[:, 3]}
+    return out
@@ -0,0 +1,301 @@
+#!/usr/bin/python3.10
+"""
+Append-only columnar store, one per serial number, partitioned by time.
+
+Layout on disk:
+
+    storeDir/<sn>/index.json                footer index: schema and segment list
+    storeDir/<sn>/<segment>/<col>.bin       raw little endian column data
+
+Records are routed by their time into a partition (a calendar month by
+default, or a day), and each partition is made of one or more segments named
+<partition>-<n>, e.g. 2023-05-000. Every segment in the index carries its row
+count and min/max time, so a query for a time window only opens the segments
+that overlap it.
+
+Each column of a segment is a flat binary file, so appending a batch of
+records is one write per column and loading a column is a single
+np.fromfile with no parsing. Segments are rolled over after segmentRows
+records so no single file grows forever. The index is only rewritten after
+the column data is on disk; anything past the row count in the index is
+left over from an interrupted append and is ignored/overwritten.
+
+A column added to schema later (e.g. qc, see qcFlags.py) reads as zeros for
+the segments written before it, and its file is zero-filled up to the
+segment's row count on the next append.
+
+compact() drops records whose time repeats an earlier one (transmissions
+stored twice before dedupeIndex.py existed). A duplicate always lands in the
+same partition as its first copy, so only the time column is read to find
+them, and only partitions that have any are rewritten. Segments from before
+the store was partitioned (no 'partition' in the index, any times) are
+checked together with the partitions they overlap, and their survivors are
+rewritten into partitions.
+
+Usage from the shell to export the public CSV on demand, or to compact:
+    python seriesStore.py <storeDir> <sn> <out.csv>
+    python seriesStore.py compact <storeDir> [sn]
+"""
+import os
+import sys
+import json
+import csv
+import shutil
+import numpy as np
+
+segmentRows = 1 << 16
+
+#column name -> dtype for the 2023 "friendly" record. time is unix seconds.
+schema = {'time': '<i8',
+          'ambient': '<u2',
+          'backscatter': '<u2',
+          'waterPressure': '<f8',
+          'waterTemp': '<f8',
+          'airPressure': '<f8',
+          'airTemp': '<f8',
+          'batteryVoltage': '<f8',
+          'waterDepth': '<f8',
+          'qc': '<u4'}
+
+partitionUnits = {'month': 'M', 'day': 'D'}
+
+
+def listSerials(storeDir):
+    if not os.path.isdir(storeDir):
+        return []
+    return sorted(d for d in os.listdir(storeDir)
+                  if os.path.exists(os.path.join(storeDir, d, 'index.json')))
+
+
+def _seconds(t):
+    #datetime, datetime64 or unix seconds -> unix seconds
+    if t is None:
+        return None
+    if isinstance(t, (int, np.integer)):
+        return int(t)
+    return int(np.datetime64(t, 's').astype(np.int64))
+
+
+class SeriesStore:
+    def __init__(self, storeDir, sn, columns=None, partitionBy='month'):
+        self.sn = str(sn)
+        self.path = os.path.join(storeDir, self.sn)
+        self.indexFile = os.path.join(self.path, 'index.json')
+        if os.path.exists(self.indexFile):
+            with open(self.indexFile) as file:
+                self.index = json.load(file)
+            if columns is None:
+                for c, dt in schema.items():
+                    self.index['columns'].setdefault(c, dt)
+        else:
+            self.index = {'columns': dict(columns or schema), 'segments': []}
+        self.index.setdefault('partitionBy', partitionBy)
+
+    @property
+    def columns(self):
+        return list(self.index['columns'])
+
+    @property
+    def recordBytes(self):
+        return sum(np.dtype(dt).itemsize for dt in self.index['columns'].values())
+
+    @property
+    def rows(self):
+        return sum(s['rows'] for s in self.index['segments'])
+
+    def _writeIndex(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.indexFile + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp, self.indexFile)
+
+    def _partitionKeys(self, t):
+        unit = partitionUnits[self.index['partitionBy']]
+        return np.datetime_as_string(t.astype('datetime64[s]').astype(f'datetime64[{unit}]'))
+
+    def _newSegment(self, partition):
+        #first free name, compact() can leave gaps
+        n = 0
+        names = {s['name'] for s in self.index['segments']}
+        while f"{partition}-{n:03d}" in names or os.path.exists(os.path.join(self.path, f"{partition}-{n:03d}")):
+            n += 1
+        seg = {'name': f"{partition}-{n:03d}", 'partition': partition,
+               'rows': 0, 'tmin': None, 'tmax': None}
+        os.makedirs(os.path.join(self.path, seg['name']), exist_ok=True)
+        return seg
+
+    def _openSegment(self, partition):
+        #the newest segment of a partition takes appends until it is full
+        segs = [s for s in self.index['segments'] if s.get('partition') == partition]
+        if segs and segs[-1]['rows'] < segmentRows:
+            return segs[-1]
+        seg = self._newSegment(partition)
+        self.index['segments'].append(seg)
+        return seg
+
+    def _appendSegment(self, seg, cols, sel):
+        segDir = os.path.join(self.path, seg['name'])
+        for c, dt in self.index['columns'].items():
+            with open(os.path.join(segDir, c + '.bin'), 'ab') as file:
+                #drop any partial tail from an interrupted append
+                file.truncate(seg['rows'] * np.dtype(dt).itemsize)
+                file.write(cols[c][sel].tobytes())
+        t = cols['time'][sel]
+        seg['tmin'] = int(t.min()) if seg['tmin'] is None else min(seg['tmin'], int(t.min()))
+        seg['tmax'] = int(t.max()) if seg['tmax'] is None else max(seg['tmax'], int(t.max()))
+        seg['rows'] += len(t)
+
+    def append(self, data):
+        """
+        Append a batch of records. data maps every column name to an array of
+        equal length; values are cast to the stored dtype. Records may arrive
+        in any time order.
+        """
+        cols = {c: np.asarray(data[c]).astype(dt, copy=False)
+                for c, dt in self.index['columns'].items()}
+        if len(cols['time']) == 0:
+            return
+        keys = self._partitionKeys(cols['time'])
+        for partition in np.unique(keys):
+            idx = np.flatnonzero(keys == partition)
+            start = 0
+            while start < len(idx):
+                seg = self._openSegment(str(partition))
+                stop = min(len(idx), start + segmentRows - seg['rows'])
+                self._appendSegment(seg, cols, idx[start:stop])
+                start = stop
+        self._writeIndex()
+
+    def _readColumn(self, seg, c):
+        dt = np.dtype(self.index['columns'][c])
+        fileName = os.path.join(self.path, seg['name'], c + '.bin')
+        if not os.path.exists(fileName):
+            return np.zeros(seg['rows'], dt)
+        v = np.fromfile(fileName, dtype=dt, count=seg['rows'])
+        #a column the segment was written without, zero-filled on a later append
+        return np.concatenate([v, np.zeros(seg['rows'] - len(v), dt)]) if len(v) < seg['rows'] else v
+
+    def stored(self, columns):
+        """Columns of every record in storage order, segment by segment, not sorted."""
+        out = {}
+        for c in columns:
+            parts = [self._readColumn(s, c) for s in self.index['segments']]
+            out[c] = np.concatenate(parts) if parts else np.empty(0, np.dtype(self.index['columns'][c]))
+        return out
+
+    def rewriteColumn(self, c, values):
+        """Replace column c of every record, values in the order stored() returns them."""
+        dt = np.dtype(self.index['columns'][c])
+        start = 0
+        for seg in self.index['segments']:
+            fileName = os.path.join(self.path, seg['name'], c + '.bin')
+            np.asarray(values[start:start + seg['rows']]).astype(dt).tofile(fileName + '.tmp')
+            os.replace(fileName + '.tmp', fileName)
+            start += seg['rows']
+
+    def segmentsBetween(self, t0=None, t1=None):
+        """Index entries of the segments that can hold records in [t0, t1]."""
+        t0, t1 = _seconds(t0), _seconds(t1)
+        return [s for s in self.index['segments'] if s['rows'] and
+                (t0 is None or s['tmax'] >= t0) and (t1 is None or s['tmin'] <= t1)]
+
+    def query(self, t0=None, t1=None, columns=None):
+        """
+        Records with t0 <= time <= t1 (either end may be None), sorted by
+        time. Only segments overlapping the window are read. time is
+        returned as datetime64[s].
+        """
+        columns = list(columns or self.columns)
+        readCols = columns if 'time' in columns else ['time'] + columns
+        segs = self.segmentsBetween(t0, t1)
+        out = {}
+        for c in readCols:
+            parts = [self._readColumn(s, c) for s in segs]
+            dt = np.dtype(self.index['columns'][c])
+            out[c] = np.concatenate(parts) if parts else np.empty(0, dt)
+
+        t = out['time']
+        keep = np.ones(len(t), bool)
+        if t0 is not None:
+            keep &= t >= _seconds(t0)
+        if t1 is not None:
+            keep &= t <= _seconds(t1)
+        order = np.flatnonzero(keep)
+        order = order[np.argsort(t[order], kind='stable')]
+        out = {c: out[c][order] for c in columns}
+        if 'time' in out:
+            out['time'] = out['time'].astype('datetime64[s]')
+        return out
+
+    def _compactGroups(self):
+        #sets of segments a duplicate can be spread over: one partition's, and
+        #segments from before partitioning (no 'partition', any times) with
+        #every partition their time range overlaps
+        groups = {}
+        for s in self.index['segments']:
+            groups.setdefault(s.get('partition'), []).append(s)
+        old = [s for s in groups.pop(None, []) if s['rows']]
+        if old:
+            lo, hi = min(s['tmin'] for s in old), max(s['tmax'] for s in old)
+            for partition in list(groups):
+                if any(s['rows'] and s['tmax'] >= lo and s['tmin'] <= hi for s in groups[partition]):
+                    old += groups.pop(partition)
+            groups[None] = old
+        return [groups[k] for k in sorted(groups, key=lambda k: k or '')]
+
+    def compact(self):
+        """Drop repeated times, keeping the first copy. Returns the number removed."""
+        removed = 0
+        for segs in self._compactGroups():
+            t = np.concatenate([self._readColumn(s, 'time') for s in segs])
+            _, first = np.unique(t, return_index=True)
+            if len(first) == len(t):
+                continue
+            keep = np.sort(first)
+            cols = {c: np.concatenate([self._readColumn(s, c) for s in segs])[keep]
+                    for c in self.index['columns']}
+
+            #write the survivors to new segments of their partitions, then
+            #switch the index over
+            newSegs = []
+            keys = self._partitionKeys(cols['time'])
+            for partition in np.unique(keys):
+                idx = np.flatnonzero(keys == partition)
+                for start in range(0, len(idx), segmentRows):
+                    seg = self._newSegment(str(partition))
+                    self._appendSegment(seg, cols, idx[start:start + segmentRows])
+                    newSegs.append(seg)
+            self.index['segments'] = [s for s in self.index['segments'] if s not in segs] + newSegs
+            self._writeIndex()
+            for s in segs:
+                shutil.rmtree(os.path.join(self.path, s['name']))
+            removed += len(t) - len(keep)
+        return removed
+
+    def load(self, columns=None):
+        """Load the requested columns (default all) for the whole history."""
+        return self.query(None, None, columns)
+
+    def exportCsv(self, fileName):
+        d = self.load()
+        d['time'] = np.char.replace(np.datetime_as_string(d['time']), 'T', ' ')
+        with open(fileName, 'w', newline='') as file:
+            write = csv.writer(file)
+            write.writerow(self.columns)
+            write.writerows(zip(*[d[c].tolist() for c in self.columns]))
+
+
+def query(storeDir, sn, t0=None, t1=None, columns=None):
+    """Records of serial sn between t0 and t1, opening only overlapping partitions."""
+    return SeriesStore(storeDir, sn).query(t0, t1, columns)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'compact':
+        for sn in sys.argv[3:] or listSerials(sys.argv[2]):
+            print(f"{sn}: removed {SeriesStore(sys.argv[2], sn).compact()} duplicate records")
+    elif len(sys.argv) == 4:
+        SeriesStore(sys.argv[1], sys.argv[2]).exportCsv(sys.argv[3])
+    else:
+        sys.exit(__doc__)
@@ -0,0 +1,118 @@
+#!/usr/bin/python3.10
+"""
+Compact per-serial status snapshot for the legacy loggers, so the email
+report doesn't have to re-read the whole archive.
+
+The endpoint updates statusDir/<serial>.json as each transmission is
+decoded. A snapshot holds the latest position, receive time and battery,
+plus the records of the last keepDays days (de-duplicated on log time), in
+the same row layout obsData.OBS.addRows takes:
+
+    [UnixTime, Pressure, Ambient, Backscatter, WaterTemp, battery]
+
+To build snapshots for an archive from before the endpoint wrote them:
+    python statusSnapshot.py <catalog.sqlite> <statusDir>
+"""
+import os
+import sys
+import json
+import fcntl
+import numpy as np
+import obsData
+
+keepDays = 14
+columns = ["UnixTime", "Pressure[bar_1E-4]", "Ambient[DN]", "Backscatter[DN]",
+           "WaterTemp[C_1E-2]", "battery[V]"]
+
+
+def snapshotFile(statusDir, sn):
+    return os.path.join(statusDir, f"{sn}.json")
+
+
+def _read(fileName):
+    try:
+        with open(fileName) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _number(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def update(statusDir, sn, rows, lat=None, lon=None, received=None, battery=None):
+    """
+    Merge rows into the snapshot of serial sn. lat/lon/battery are taken
+    from the newest transmission by received (YYYYmmddHHMMSS), so a late
+    delivery doesn't roll them back.
+    """
+    os.makedirs(statusDir, exist_ok=True)
+    fileName = snapshotFile(statusDir, sn)
+    #the CGI endpoint runs one process per delivery, so lock across processes
+    with open(fileName + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        snap = _read(fileName) or {'sn': sn, 'columns': columns, 'rows': []}
+        if received is not None and str(received) >= str(snap.get('received') or ''):
+            snap.update(received=str(received), lat=_number(lat), lon=_number(lon),
+                        battery=_number(battery))
+
+        #newest copy of a log time wins, keep the last keepDays before the newest record
+        merged = {int(r[0]): list(r) for r in snap['rows']}
+        merged.update((int(r[0]), list(r)) for r in rows)
+        if merged:
+            newest = max(merged)
+            merged = {t: r for t, r in merged.items() if t > newest - keepDays*86400}
+        snap['rows'] = [merged[t] for t in sorted(merged)]
+
+        tmp = fileName + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(snap, file)
+        os.replace(tmp, fileName)
+
+
+def load(statusDir):
+    """Every snapshot in statusDir, keyed by serial."""
+    snaps = {}
+    if not os.path.isdir(statusDir):
+        return snaps
+    for name in sorted(os.listdir(statusDir)):
+        if name.endswith('.json'):
+            snap = _read(os.path.join(statusDir, name))
+            snaps[snap['sn']] = snap
+    return snaps
+
+
+def toObs(snap, cls=obsData.OBS):
+    obs = cls(snap['sn'], snap.get('lat'), snap.get('lon'), max(len(snap['rows']), 1))
+    if snap['rows']:
+        obs.addRows(np.array(snap['rows'], dtype=float))
+    return obs
+
+
+def fromCatalog(catalog, statusDir, t0=None):
+    """Rebuild snapshots from the cataloged legacy CSVs received since t0. Returns the serial count."""
+    import transmissionCatalog
+    rows, latest = {}, {}
+    for t in catalog.window(t0=t0):
+        if not t['location'].endswith('.csv'):
+            continue
+        battV = t['battery'] if t['battery'] is not None else np.nan
+        rows.setdefault(t['serial'], []).extend(
+            r+[battV] for r in transmissionCatalog.readRecords(t['location']))
+        latest[t['serial']] = t #window is oldest first
+    for sn, t in latest.items():
+        update(statusDir, sn, rows[sn], t['latitude'], t['longitude'],
+               t['received'], t['battery'])
+    return len(latest)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    import transmissionCatalog
+    catalog = transmissionCatalog.TransmissionCatalog(sys.argv[1])
+    print(f"updated {fromCatalog(catalog, sys.argv[2])} snapshots")
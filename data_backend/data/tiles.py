@@ -0,0 +1,146 @@
+#!/usr/bin/python3.10
+"""
+Pyramid of precomputed JSON time-series tiles per serial and variable, so
+a browser chart fetches only what its current view needs instead of the
+whole-history CSV.
+
+    tileDir/<sn>/index.json                     levels, variables, extent
+    tileDir/<sn>/<var>/<level>/<index>.json     one tile
+
+A tile of a level covers [index*tileSeconds, (index+1)*tileSeconds) in
+unix seconds, so a client works out which tiles it needs from its x range
+alone. Each level is drawn from what already exists:
+
+    raw   1 day tiles     every record, from the series store
+    hour  32 day tiles    hourly n/min/mean/max, from rollups.py
+    day   512 day tiles   daily n/min/mean/max, from rollups.py
+
+so any view is at most a few tiles of a few hundred points (pick the
+finest level whose tile count for the view is small), and the work per
+update only depends on how much new data came in. Tile contents are
+
+    raw:          {"time": [...], "value": [...]}
+    hour and day: {"time": [...], "n": [...], "min": [...], "mean": [...], "max": [...]}
+
+with time as unix seconds (bucket starts for hour/day) and null for
+missing or flagged (qcFlags.py) values. update() rewrites only the tiles
+holding new records, and leaves a file alone when its contents didn't
+change, so caches and ETags stay valid.
+"""
+import os
+import json
+import numpy as np
+import seriesStore
+import rollups
+import qcFlags
+
+#name -> (tile seconds, rollup resolution or None for the records themselves)
+levels = {'raw': (86400, None),
+          'hour': (32 * 86400, 'hour'),
+          'day': (512 * 86400, 'day')}
+variables = rollups.variables
+digits = 4
+
+
+def _values(v):
+    v = np.round(np.asarray(v, dtype=float), digits).astype(object)
+    v[np.isnan(v.astype(float))] = None
+    return v.tolist()
+
+
+def _write(fileName, obj):
+    """Write obj as JSON unless the file already holds it. Returns bytes written."""
+    text = json.dumps(obj, separators=(',', ':'))
+    try:
+        with open(fileName) as file:
+            if file.read() == text:
+                return 0
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    tmp = fileName + '.tmp'
+    with open(tmp, 'w') as file:
+        file.write(text)
+    os.replace(tmp, fileName)
+    return len(text)
+
+
+def _runs(indexes):
+    #consecutive tile indexes, so a run is one read of the store or rollups
+    splits = np.flatnonzero(np.diff(indexes) != 1) + 1
+    return np.split(indexes, splits)
+
+
+def _tileName(tileDir, sn, var, level, index):
+    return os.path.join(tileDir, sn, var, level, f"{int(index)}.json")
+
+
+def _rawTiles(tileDir, storeDir, sn, run, tileSeconds):
+    t0, t1 = int(run[0]) * tileSeconds, (int(run[-1]) + 1) * tileSeconds
+    d = seriesStore.query(storeDir, sn, t0, t1 - 1, ['time', 'qc'] + variables)
+    t = d['time'].astype(np.int64)
+    #first copy of each log time, as rollups.py does
+    _, keep = np.unique(t, return_index=True)
+    t = t[keep]
+    written = 0
+    for index in run:
+        lo, hi = np.searchsorted(t, [int(index) * tileSeconds, (int(index) + 1) * tileSeconds])
+        if lo == hi:
+            continue
+        for var in variables:
+            #values qcFlags.py flagged go out as null
+            v = np.where(qcFlags.good(d['qc'][keep][lo:hi], var), d[var][keep][lo:hi], np.nan)
+            written += _write(_tileName(tileDir, sn, var, 'raw', index),
+                              {'time': t[lo:hi].tolist(), 'value': _values(v)})
+    return written
+
+
+def _rollupTiles(tileDir, rollupFile, sn, run, tileSeconds, level, res):
+    t0, t1 = int(run[0]) * tileSeconds, (int(run[-1]) + 1) * tileSeconds
+    rows = rollups.read(rollupFile, sn, res, t0, t1 - 1)
+    written = 0
+    for var, r in rows.items():
+        t = r['time'].astype(np.int64)
+        for index in run:
+            lo, hi = np.searchsorted(t, [int(index) * tileSeconds, (int(index) + 1) * tileSeconds])
+            if lo == hi:
+                continue
+            written += _write(_tileName(tileDir, sn, var, level, index),
+                              {'time': t[lo:hi].tolist(), 'n': r['n'][lo:hi].tolist(),
+                               'min': _values(r['min'][lo:hi]), 'mean': _values(r['mean'][lo:hi]),
+                               'max': _values(r['max'][lo:hi])})
+    return written
+
+
+def update(tileDir, storeDir, rollupFile, sn, times):
+    """
+    Rewrite every tile holding any of times (unix seconds of the records
+    just stored) and the serial's index.json. Call after rollups.update.
+    Returns the number of bytes written.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return 0
+    sn = str(sn)
+    written = 0
+    for level, (tileSeconds, res) in levels.items():
+        for run in _runs(np.unique(times // tileSeconds)):
+            if res is None:
+                written += _rawTiles(tileDir, storeDir, sn, run, tileSeconds)
+            else:
+                written += _rollupTiles(tileDir, rollupFile, sn, run, tileSeconds, level, res)
+
+    #extent of the data and of the tile indexes, for the client
+    indexFile = os.path.join(tileDir, sn, 'index.json')
+    try:
+        with open(indexFile) as file:
+            old = json.load(file)
+    except FileNotFoundError:
+        old = {}
+    tmin = min(int(times.min()), old.get('tmin', int(times.min())))
+    tmax = max(int(times.max()), old.get('tmax', int(times.max())))
+    written += _write(indexFile, {
+        'sn': sn, 'variables': variables, 'tmin': tmin, 'tmax': tmax,
+        'levels': [{'name': level, 'tileSeconds': tileSeconds,
+                    'first': tmin // tileSeconds, 'last': tmax // tileSeconds}
+                   for level, (tileSeconds, res) in levels.items()]})
+    return written
@@ -0,0 +1,207 @@
+#!/usr/bin/python3.10
+"""
+Indexed SQLite catalog with one row per received transmission.
+
+The endpoint adds a row as each delivery comes in, so the update and report
+scripts can ask "latest transmission per serial" or "transmissions of a
+serial in a window" with an index lookup instead of opening every CSV and
+regex-searching its header. The database runs in WAL mode so the endpoint
+can keep writing while a report reads.
+
+update-data.py and email-report.py catalog the archive written before the
+catalog existed on their first run (indexArchive). To do it by hand:
+    python transmissionCatalog.py <catalog.sqlite> <dataDir>
+"""
+import os
+import re
+import sys
+import glob
+import sqlite3
+import threading
+import itertools
+from datetime import datetime
+
+schemaSql = """
+CREATE TABLE IF NOT EXISTS transmissions (
+    id INTEGER PRIMARY KEY,
+    imei TEXT,
+    serial INTEGER,
+    momsn INTEGER,
+    transmit_time TEXT,
+    received TEXT,           -- YYYYmmddHHMMSS, server time
+    received_ts INTEGER,     -- same as unix seconds
+    latitude REAL,
+    longitude REAL,
+    cep REAL,
+    battery REAL,
+    location TEXT UNIQUE     -- CSV path, or wal:<serial>:<seq>
+);
+CREATE INDEX IF NOT EXISTS transmissions_serial_time ON transmissions(serial, received_ts);
+CREATE INDEX IF NOT EXISTS transmissions_time ON transmissions(received_ts);
+CREATE INDEX IF NOT EXISTS transmissions_imei_momsn ON transmissions(imei, momsn);
+"""
+
+columns = ['imei', 'serial', 'momsn', 'transmit_time', 'received', 'received_ts',
+           'latitude', 'longitude', 'cep', 'battery', 'location']
+
+
+def _number(v, kind=float):
+    try:
+        return kind(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _timestamp(received):
+    try:
+        return int(datetime.strptime(received[:14], '%Y%m%d%H%M%S').timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def _toTs(t):
+    if t is None or isinstance(t, (int, float)):
+        return t
+    return int(t.timestamp())
+
+
+class TransmissionCatalog:
+    def __init__(self, dbFile):
+        dbDir = os.path.dirname(dbFile)
+        if dbDir:
+            os.makedirs(dbDir, exist_ok=True)
+        self.dbFile = dbFile
+        self.db = sqlite3.connect(dbFile, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(schemaSql)
+        self.lock = threading.Lock()
+
+    def add(self, fields, location, received=None, battery=None):
+        """
+        Catalog one transmission. fields holds the RockBLOCK form values.
+        Returns False if location is already cataloged.
+        """
+        received = received or fields.get('received')
+        row = (fields.get('imei'), _number(fields.get('serial'), int),
+               _number(fields.get('momsn'), int), fields.get('transmit_time'),
+               received, _timestamp(received),
+               _number(fields.get('iridium_latitude')), _number(fields.get('iridium_longitude')),
+               _number(fields.get('iridium_cep')), _number(battery), location)
+        with self.lock, self.db:
+            cur = self.db.execute(
+                f"INSERT OR IGNORE INTO transmissions ({','.join(columns)}) "
+                f"VALUES ({','.join('?'*len(columns))})", row)
+        return cur.rowcount == 1
+
+    def serials(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                "SELECT DISTINCT serial FROM transmissions ORDER BY serial")]
+
+    def latestPerSerial(self):
+        """Newest transmission of every serial, one indexed lookup each."""
+        with self.lock:
+            return self.db.execute(
+                """SELECT t.* FROM (SELECT DISTINCT serial FROM transmissions) s
+                   JOIN transmissions t ON t.id = (
+                       SELECT id FROM transmissions WHERE serial = s.serial
+                       ORDER BY received_ts DESC, id DESC LIMIT 1)
+                   ORDER BY t.serial""").fetchall()
+
+    def window(self, serial=None, t0=None, t1=None):
+        """
+        Transmissions received between t0 and t1 (datetimes or unix
+        seconds, either may be None), for one serial or all, oldest first.
+        """
+        where, args = [], []
+        if serial is not None:
+            where.append("serial = ?")
+            args.append(int(serial))
+        if t0 is not None:
+            where.append("received_ts >= ?")
+            args.append(_toTs(t0))
+        if t1 is not None:
+            where.append("received_ts <= ?")
+            args.append(_toTs(t1))
+        sql = "SELECT * FROM transmissions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self.lock:
+            return self.db.execute(sql + " ORDER BY serial, received_ts, id", args).fetchall()
+
+    def indexFiles(self, fileList):
+        """
+        Catalog legacy CSVs (rockblock.py layout) by parsing their headers
+        once. Files already cataloged are skipped. Returns the number added.
+        """
+        with self.lock:
+            known = {r[0] for r in self.db.execute("SELECT location FROM transmissions")}
+        added = 0
+        for fileName in fileList:
+            if fileName in known:
+                continue
+            header = readHeader(fileName)
+            if header is None:
+                continue
+            fields, battery = header
+            received = os.path.basename(fileName)[:14]
+            if not received.isdigit():
+                mtime = datetime.fromtimestamp(os.path.getmtime(fileName))
+                received = mtime.strftime('%Y%m%d%H%M%S')
+            added += self.add(fields, fileName, received, battery)
+        return added
+
+    def indexArchive(self, dataDir):
+        """
+        indexFiles for every CSV under dataDir (<dataDir>/<serial>/*.csv),
+        once per catalog: a new deployment starts with an empty catalog
+        while the archive is already on disk. Returns the number added, or
+        None if the archive was indexed before.
+        """
+        marker = self.dbFile + '.archive'
+        if os.path.exists(marker):
+            return None
+        added = self.indexFiles(glob.glob(os.path.join(dataDir, '*', '*.csv')))
+        open(marker, 'w').close()
+        return added
+
+    def close(self):
+        self.db.close()
+
+
+headerKeys = {'imei': 'imei', 'serial': 'serial', 'transmit time': 'transmit_time',
+              'latitude': 'iridium_latitude', 'longitude': 'iridium_longitude',
+              'cep': 'iridium_cep', 'battery': 'battery'}
+
+
+def readHeader(fileName):
+    """(fields, battery) from the 'key: value' lines of a legacy CSV."""
+    fields = {}
+    with open(fileName) as file:
+        for line in itertools.islice(file, 8):
+            key, _, value = line.strip().strip('"').partition(':')
+            if key in headerKeys:
+                fields[headerKeys[key]] = value.strip()
+    if 'serial' not in fields:
+        return None
+    match = re.search("_([0-9]+)\\.csv$", os.path.basename(fileName))
+    if match:
+        fields['momsn'] = match.group(1)
+    return fields, fields.pop('battery', None)
+
+
+def readRecords(fileName, skip=8):
+    """Integer data rows of a legacy CSV, after its header lines."""
+    with open(fileName) as file:
+        return [[int(v) for v in line.split(',')]
+                for line in itertools.islice(file, skip, None) if line.strip()]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    catalog = TransmissionCatalog(sys.argv[1])
+    n = catalog.indexFiles(glob.glob(os.path.join(sys.argv[2], '*', '*.csv')))
+    print(f"cataloged {n} transmissions")
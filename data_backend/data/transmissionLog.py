@@ -0,0 +1,245 @@
+#!/usr/bin/python3.10
+"""
+Append-only, segmented log of received transmissions, one log per serial.
+
+    walDir/<serial>/<first seq>.log
+
+Each record is a 20 byte header followed by the payload:
+
+    magic 'OBSW' | payload length (u32) | crc32 of payload (u32) | seq (u64)
+
+Sequence numbers are per serial, start at 1 and never repeat, so they double
+as the watermark downstream readers keep. A segment is closed and a new one
+started once it passes segmentBytes.
+
+Durability uses group commit: every appender that asks for sync waits until
+its record has been fsynced, but while one thread is inside fsync the others
+keep appending and are all covered by the next fsync.
+
+Several processes may append to the same serial (CGI runs one per delivery,
+gunicorn several workers), so each append holds an flock on
+walDir/<serial>/.lock while it catches up with the records the others
+wrote, picks the next seq and writes its own. Under that lock a torn record
+at the end of the last segment can only be a crash mid write, and is cut
+off.
+"""
+import os
+import json
+import fcntl
+import struct
+import threading
+import zlib
+
+header = struct.Struct('<4sIIQ')
+magic = b'OBSW'
+segmentBytes = 4 << 20
+
+
+def _segments(serialDir):
+    try:
+        names = [n for n in os.listdir(serialDir) if n.endswith('.log')]
+    except FileNotFoundError:
+        return []
+    return sorted((int(n[:-4]), os.path.join(serialDir, n)) for n in names)
+
+
+def _scan(fileName, start=0):
+    """Yield (offset, seq, payload) for the valid records of one segment."""
+    with open(fileName, 'rb') as file:
+        file.seek(start)
+        offset = start
+        while True:
+            head = file.read(header.size)
+            if len(head) < header.size:
+                return
+            tag, length, crc, seq = header.unpack(head)
+            payload = file.read(length)
+            if tag != magic or len(payload) < length or zlib.crc32(payload) != crc:
+                return #torn or corrupt tail
+            yield offset, seq, payload
+            offset += header.size + length
+
+
+class _SerialLog:
+    def __init__(self, serialDir):
+        os.makedirs(serialDir, exist_ok=True)
+        self.serialDir = serialDir
+        self.cond = threading.Condition()
+        self.syncing = False
+        self.file = None
+        self.fileName = None
+        self.end = 0
+        self.lastSeq = 0
+        #other processes (CGI, gunicorn workers) append to the same serial
+        self.lockFile = open(os.path.join(serialDir, '.lock'), 'a')
+        with self.cond:
+            self._lock()
+            try:
+                self._catchUp()
+            finally:
+                self._unlock()
+        self.durableSeq = self.lastSeq
+
+    def _lock(self):
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+
+    def _catchUp(self):
+        #under the lock: move to the newest segment and past whatever other
+        #processes appended since we last held it
+        segs = _segments(self.serialDir)
+        if not segs:
+            return
+        firstSeq, fileName = segs[-1]
+        if fileName != self.fileName:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(fileName, 'r+b')
+            self.fileName = fileName
+            self.end = 0
+            self.lastSeq = firstSeq - 1
+        size = os.fstat(self.file.fileno()).st_size
+        if size != self.end:
+            for offset, seq, payload in _scan(fileName, self.end):
+                self.end = offset + header.size + len(payload)
+                self.lastSeq = seq
+            if self.end < size:
+                #every writer holds the lock until its record is written,
+                #so a torn tail is a crash mid write, not one in progress
+                self.file.truncate(self.end)
+        self.file.seek(self.end)
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.durableSeq = self.lastSeq
+        self.fileName = os.path.join(self.serialDir, f"{self.lastSeq + 1:016d}.log")
+        self.file = open(self.fileName, 'w+b')
+        self.end = 0
+
+    def append(self, payload):
+        with self.cond:
+            self._lock()
+            try:
+                self._catchUp()
+                if self.file is None or self.end >= segmentBytes:
+                    self._rotate()
+                self.lastSeq += 1
+                self.file.write(header.pack(magic, len(payload), zlib.crc32(payload), self.lastSeq))
+                self.file.write(payload)
+                #visible to the other processes before they get the lock
+                self.file.flush()
+                self.end = self.file.tell()
+            finally:
+                self._unlock()
+            return self.lastSeq
+
+    def sync(self, seq):
+        with self.cond:
+            while self.durableSeq < seq:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.syncing = True
+                target = self.lastSeq
+                #a copy of the descriptor, append may swap files meanwhile;
+                #any older segment was fsynced by whoever rotated it
+                fd = os.dup(self.file.fileno())
+                self.cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                    self.cond.acquire()
+                    self.syncing = False
+                self.durableSeq = max(self.durableSeq, target)
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+                self.fileName = None
+            self.lockFile.close()
+
+
+class TransmissionLog:
+    def __init__(self, walDir):
+        self.walDir = walDir
+        self.logs = {}
+        self.lock = threading.Lock()
+
+    def _log(self, serial):
+        serial = str(serial)
+        with self.lock:
+            if serial not in self.logs:
+                self.logs[serial] = _SerialLog(os.path.join(self.walDir, serial))
+            return self.logs[serial]
+
+    def append(self, serial, payload, sync=True):
+        """Append one record (bytes) and return its sequence number."""
+        log = self._log(serial)
+        seq = log.append(payload)
+        if sync:
+            log.sync(seq)
+        return seq
+
+    def appendMessage(self, fields, sync=True):
+        """Append a RockBLOCK form (dict of strings) as a JSON record."""
+        payload = json.dumps(fields, separators=(',', ':')).encode()
+        return self.append(fields['serial'], payload, sync)
+
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
+            self.logs = {}
+
+
+def listSerials(walDir):
+    try:
+        return sorted(d for d in os.listdir(walDir) if os.path.isdir(os.path.join(walDir, d)))
+    except FileNotFoundError:
+        return []
+
+
+def lastSegment(walDir, serial):
+    """(name, size) of the newest segment, a cheap 'has anything changed' check."""
+    segs = _segments(os.path.join(walDir, str(serial)))
+    if not segs:
+        return None
+    fileName = segs[-1][1]
+    return [os.path.basename(fileName), os.path.getsize(fileName)]
+
+
+def lastSeq(walDir, serial):
+    """Sequence number of the newest record of a serial, 0 if it has none."""
+    segs = _segments(os.path.join(walDir, str(serial)))
+    if not segs:
+        return 0
+    seq = segs[-1][0] - 1
+    for offset, seq, payload in _scan(segs[-1][1]):
+        pass
+    return seq
+
+
+def replay(walDir, serial, fromSeq=1):
+    """Yield (seq, payload) for every record of a serial with seq >= fromSeq."""
+    segs = _segments(os.path.join(walDir, str(serial)))
+    for i, (firstSeq, fileName) in enumerate(segs):
+        if i+1 < len(segs) and segs[i+1][0] <= fromSeq:
+            continue #everything in this segment is older
+        for offset, seq, payload in _scan(fileName):
+            if seq >= fromSeq:
+                yield seq, payload
+
+
+def replayMessages(walDir, serial, fromSeq=1):
+    for seq, payload in replay(walDir, serial, fromSeq):
+        yield seq, json.loads(payload)
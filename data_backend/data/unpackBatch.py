@@ -0,0 +1,201 @@
+#!/usr/bin/python3.10
+"""
+Turn a batch of transmissions into unpacked CSVs and store columns.
+
+Shared by update-data-2023.py (the new transmissions of each cron run) and
+backfill-2023.py (the whole archive, one chunk per worker process). A batch
+is either a list of (unpacked file, hex payload) candidates or rows of the
+binary rawArchive.py; payloads go through the payloadFormats registry and
+derived.py the same way in all cases.
+"""
+import os
+import csv
+import itertools
+import numpy as np
+import payloadFormats
+import derived
+import qcFlags
+import seriesStore
+import rawArchive
+
+
+def opener(path,flags):
+    return os.open(path,flags,0o775)
+
+
+def readRaw(rawFile):
+    """({header key: value}, hex payload) of a raw file. The payload is line 7."""
+    with open(rawFile) as file:
+        lines = list(itertools.islice(file,7))
+    fields = {}
+    for line in lines[:6]:
+        key, _, value = line.partition(':')
+        fields[key.strip()] = value.strip()
+    return fields, (lines[6].strip() if len(lines) > 6 else "")
+
+
+def walName(fields):
+    #unpacked name for a transmission log message, like the raw file names
+    return f"{fields.get('received')}_{fields.get('momsn')}.csv"
+
+
+def _bytes(dataString):
+    try:
+        return bytes.fromhex(dataString)
+    except ValueError:
+        return b''
+
+
+def archive(archiveDir, candidates):
+    """
+    Append [(unpacked file, hex payload, rawArchive.metaRecord)] to the raw
+    archive of each serial. Returns (slices, invalid): slices is
+    [(files, packets)] with packets a memmap over the archived rows, and
+    invalid counts empty or non-hex payloads, which aren't archived. A
+    payload whose file name is already archived past the last commit (a
+    rerun after a crash) is not appended again, its earlier row is used.
+    """
+    bySerial = {}
+    invalid = 0
+    for unpackedFile, dataString, meta in candidates:
+        dataBytes = _bytes(dataString)
+        if len(dataBytes) == 0:
+            invalid += 1
+            continue
+        sn = os.path.basename(os.path.dirname(unpackedFile))
+        bySerial.setdefault(sn, {}).setdefault(len(dataBytes), []).append((unpackedFile, dataBytes, meta))
+
+    slices = []
+    for sn, byLength in bySerial.items():
+        store = rawArchive.RawArchive(archiveDir, sn)
+        for n, items in sorted(byLength.items()):
+            names = np.array([os.path.basename(f).encode() for f, b, m in items], dtype='S40')
+            #only an uncommitted run can have archived these names already
+            first = store.committed(n)
+            archived = store.metadata(n, first)['name']
+            again = np.isin(names, archived)
+            if again.any():
+                hits = np.isin(archived, names)
+                rowOf = dict(zip(archived[hits], first + np.flatnonzero(hits)))
+                rows = [rowOf[name] for name in names[again]]
+                slices.append(([f for (f, b, m), a in zip(items, again) if a],
+                               store.packets(n)[rows]))
+                items = [item for item, a in zip(items, again) if not a]
+            if items:
+                start, stop = store.append([b for f, b, m in items], [m for f, b, m in items])[n]
+                slices.append(([f for f, b, m in items], store.packets(n, start, stop)))
+    return slices, invalid
+
+
+def decodeSlices(slices, invalid=0):
+    """
+    Decode [(files, (nPackets, n) uint8 array)], e.g. from archive(). Returns
+    (files, groups, counts) like decode().
+    """
+    files = []
+    groups = []
+    counts = payloadFormats.addCounts(dict.fromkeys(payloadFormats.formats, 0), {'unrecognized': invalid})
+    for sliceFiles, raw in slices:
+        sliceGroups, sliceCounts = payloadFormats.decodeArray(raw)
+        for name, cols in sliceGroups:
+            cols['packet'] = cols['packet'] + len(files)
+            groups.append((name, cols))
+        payloadFormats.addCounts(counts, sliceCounts)
+        files.extend(sliceFiles)
+    return files, groups, counts
+
+
+def decode(candidates):
+    """
+    Decode [(unpacked file, hex payload)]. Returns (files, groups, counts)
+    where groups/counts are as payloadFormats.decodeBatch and packet indexes
+    point into files. Empty or non-hex payloads count as unrecognized.
+    """
+    files = []
+    payloads = []
+    invalid = 0
+    for unpackedFile, dataString in candidates:
+        dataBytes = _bytes(dataString)
+        if len(dataBytes) == 0:
+            invalid += 1
+            continue
+        files.append(unpackedFile)
+        payloads.append(dataBytes)
+
+    groups, counts = payloadFormats.decodeBatch(payloads)
+    counts['unrecognized'] += invalid
+    return files, groups, counts
+
+
+def writeUnpacked(files, groups):
+    for name, decoded in groups:
+        fmt = payloadFormats.formats[name]
+        #records come out grouped by packet
+        packets, starts = np.unique(decoded['packet'], return_index=True)
+        for p, idx in zip(packets, np.split(np.arange(len(decoded['packet'])), starts[1:])):
+            records = [[decoded[c][i] for c in fmt['columns']] for i in idx]
+            unpackedFile = files[p]
+
+            #make a directory for the ROCKBLOCK SN if needed
+            sn_dir = os.path.split(unpackedFile)[0]
+            if not os.path.exists(sn_dir):
+                os.makedirs(sn_dir,mode=0o775,exist_ok=True)
+
+            #create the unpacked data file
+            with open(unpackedFile,'w',opener=opener,newline='') as file:
+                write = csv.writer(file)
+                write.writerow(fmt['labels'])
+                write.writerows(records)
+
+
+def friendly(files, groups, columns=None):
+    """
+    Store columns in engineering units, with each serial's calibration.
+    Returns [(sn, columns)], one per format group and serial. The serial is
+    the directory of the unpacked file. qc starts with the time checks that
+    need the records in packet order (qcFlags.timeFlags); qcFlags.update
+    adds the rest before the records are stored.
+    """
+    columns = list(columns or seriesStore.schema)
+    packetSerial = np.array([os.path.basename(os.path.dirname(f)) for f in files])
+    out = []
+    for name, decoded in groups:
+        fmt = payloadFormats.formats[name]
+        recordSerial = packetSerial[decoded['packet']]
+        for sn in np.unique(recordSerial):
+            mask = recordSerial == sn
+            d = derived.Dataset({k: v[mask] for k, v in decoded.items()},fmt['units'],sn)
+            #e.g. the legacy loggers have no air temperature
+            cols = d.get([c for c in columns if c != 'qc'],fill=np.nan)
+            if 'qc' in columns:
+                cols['qc'] = qcFlags.timeFlags(d['time'],decoded['packet'][mask])
+            out.append((str(sn), cols))
+    return out
+
+
+def runChunk(candidates, calibrationFile=None, write=True):
+    """
+    Backfill worker: decode one chunk, write its unpacked files (unless
+    write is False) and return (counts, {sn: columns sorted by time}).
+    """
+    return _finishChunk(*decode(candidates), calibrationFile, write)
+
+
+def runSlices(slices, calibrationFile=None, write=True):
+    """As runChunk, for [(files, packets)] slices of the raw archive."""
+    return _finishChunk(*decodeSlices(slices), calibrationFile, write)
+
+
+def _finishChunk(files, groups, counts, calibrationFile, write):
+    derived.loadCalibrations(calibrationFile)
+    if write:
+        writeUnpacked(files, groups)
+    bySerial = {}
+    for sn, cols in friendly(files, groups):
+        bySerial.setdefault(sn, []).append(cols)
+    out = {}
+    for sn, parts in bySerial.items():
+        cols = {c: np.concatenate([p[c] for p in parts]) for c in parts[0]}
+        order = np.argsort(cols['time'], kind='stable')
+        out[sn] = {c: v[order] for c, v in cols.items()}
+    return counts, out
@@ -1,165 +1,205 @@
 #!/usr/bin/python3.10
 
 import os
-import glob
-import csv
-import ctypes as ct
-os.environ['MPLCONFIGDIR'] = "/tmp/"
-import matplotlib.pyplot as plt
+import sys
+import time
 from datetime import datetime, timedelta
-import pandas as pd
+import ingestManifest
+import metrics
 
-nBytes = 48
+#numpy, matplotlib and the decoders are imported further down, once we know
+#there is new data. A cron run with nothing to do should exit right away.
 
 os.umask(0)
-def opener(path,flags):
-    return os.open(path,flags,0o775)
-
-"""
-turns out this is pretty complicated, depends on atmospheric pressure, 
-dissolved gasses, isotopes, salinity, yadda yadda. Temperature is most
-important within normal ranges.
-formula taken from here:
-Tanaka, M., et al. "Recommended table for the density of water between 0 C 
-and 40 C based on recent experimental reports." Metrologia 38.4 (2001): 301.
-"""
-def getDensity(t):
-    a1 = -3.98305
-    a2 = 301.797
-    a3 = 522528.9
-    a4 = 69.34881
-    a5 = 999.974950
-    return a5*(1-((t+a1)**2*(t+a2))/(a3*(t+a4)))
-
-#recreate the data structure from the Arduino data logger
-class single_record(ct.LittleEndianStructure):
-    _fields_ = [("logtime", ct.c_uint32, 32),
-                ("tuBackground", ct.c_uint32, 16),
-                ("tuBackscatter", ct.c_uint32, 16),
-                ("waterPressure", ct. c_uint32, 21),
-                ("waterTemp",ct.c_int32, 11),
-                ("baroAnomaly",ct.c_int32,14),
-                ("airTemp",ct.c_int32,10),
-                ("batteryVoltage",ct.c_uint32,8)]    
-    
-class transmission_packet(ct.Union):
-    _fields_ = [("record", single_record*3),
-                ("data", ct.c_ubyte*nBytes)]
-   
+#OBS_PROFILE=<dir> profiles the run, see metrics.py
+metrics.profile()
+metrics.runTimer('update')
 
 rawDir = '/Users/Ted/Documents/IridiumDump/raw'
 unpackedDir = '/Users/Ted/Documents/IridiumDump/unpacked'   
 assetDir = '/Users/Ted/Documents/IridiumDump/full-files'   
+storeDir = '/Users/Ted/Documents/IridiumDump/store'
+walDir = '/Users/Ted/Documents/IridiumDump/wal'
+archiveDir = '/Users/Ted/Documents/IridiumDump/archive'
 # rawDir = '/srv/data/IridiumDump/raw'
 # unpackedDir = '/srv/data/IridiumDump/unpacked'
 # assetDir = '/var/www/html/assets'
+# storeDir = '/srv/data/IridiumDump/store'
+# walDir = '/srv/data/wal'
+# archiveDir = '/srv/data/IridiumDump/archive'
+manifestDir = os.path.join(unpackedDir,'.manifest')
+#per-serial calibration constants, see derived.py
+calibrationFile = os.path.join(unpackedDir,'calibration.json')
+rollupFile = os.path.join(storeDir,'rollups.sqlite')
+#zoomable JSON tiles for the web charts, see tiles.py
+tileDir = os.path.join(assetDir,'tiles')
+#update-data.py writes <sn>.png and <sn>.csv to the same assets, so ours
+#carry a suffix instead of overwriting each other's every cron run
+assetSuffix = '_2023'
+#(imei, momsn) of every transmission already in the store
+dedupeFile = os.path.join(storeDir,'dedupe')
+#the last records of each serial the QC checks look back on, see qcFlags.py
+qcDir = os.path.join(storeDir,'qc')
 
-rawFiles = glob.glob(os.path.join(rawDir,'*/*.csv'))
-unpackedFiles = glob.glob(os.path.join(unpackedDir,'*/*.csv'))
+#the public long CSV is now only an export of the binary store.
+#set this to rewrite it whenever a serial gets new data, or run
+#seriesStore.py by hand to export one on demand.
+exportCsv = False
 
+#the endpoint's worker (ingestWorker.py) runs this with --serial <sn> ... to
+#update just the serials that got data, seconds after they did
+args = sys.argv[1:]
+serials = [args[i+1] for i in range(len(args)-1) if args[i] == '--serial'] or None
 
-for rawFile in rawFiles:
-    #check if a matching file already exists in the unpacked directory
-    unpackedFile = os.path.join(unpackedDir,os.path.relpath(rawFile,rawDir))
+#one run at a time, whether from cron, the worker or backfill-2023.py
+runLock = ingestManifest.runLock(unpackedDir)
+#a backfill that stopped halfway through swapping its directories in
+if os.path.exists(storeDir + '.backfill-swap.json'):
+    sys.exit(f"{storeDir}.backfill-swap.json exists, run backfill-2023.py to finish swapping in its rebuild")
+os.makedirs(manifestDir,exist_ok=True)
+
+manifest = ingestManifest.IngestManifest(rawDir,manifestDir)
+entries = manifest.newEntries(serials)
+walMessages = manifest.newWalMessages(walDir,serials)
+metrics.gauge('obs_backlog_transmissions',len(entries)+len(walMessages),stage='update')
+#serials stored before qcFlags.py existed, flagged once below (qcFlags.flagStore)
+unchecked = [sn for sn in (os.listdir(storeDir) if os.path.isdir(storeDir) else [])
+             if os.path.exists(os.path.join(storeDir,sn,'index.json'))
+             and not os.path.exists(os.path.join(qcDir,sn+'.checked'))]
+if not entries and not walMessages and not unchecked:
+    manifest.commit()
+    sys.exit(0)
+
+import unpackBatch
+import rawArchive
+import dedupeIndex
+import seriesStore
+import derived
+import rollups
+import tiles
+import qcFlags
+import plotRender
+
+derived.loadCalibrations(calibrationFile)
+for sn in qcFlags.unchecked(qcDir,storeDir):
+    changed = qcFlags.flagStore(qcDir,storeDir,sn)
+    print(f"{sn}: flagged {len(changed)} stored records")
+    rollups.update(rollupFile,storeDir,sn,changed)
+    metrics.inc('obs_bytes_written_total',tiles.update(tileDir,storeDir,rollupFile,sn,changed),kind='tiles')
+
+#(unpacked file, hex payload, archive metadata) for every new transmission
+candidates = []
+duplicates = 0
+dedupe = dedupeIndex.DedupeIndex(dedupeFile)
+for sn, name, size, mtime in entries:
+    rawFile = os.path.join(rawDir,sn,name)
+    #older archives were unpacked before the manifest existed
+    unpackedFile = os.path.join(unpackedDir,sn,name)
     if os.path.exists(unpackedFile):
         continue #to next raw file
-    
-    #read in raw data from line 7
-    with open(rawFile) as file:
-        for index, line in enumerate(iter(file)):
-            if index == 6:  
-                dataString = line
-    if len(dataString) == 0:
-        continue #could log this somewhere. For now just skip.
-    
-    dataBytes = bytes.fromhex(dataString)
-    
-    #make sure the data matches our structure
-    if len(dataBytes) != nBytes:
-        continue #could log this somewhere. For now just skip.
-      
-    #Create a packet object and put our data in as a byte array.
-    packet = transmission_packet()
-    packet.data = (ct.c_ubyte * nBytes)(*dataBytes)
-    
-    #make a directory for the ROCKBLOCK SN if needed
-    sn_dir = os.path.split(unpackedFile)[0]
-    if not os.path.exists(sn_dir):
-        os.makedirs(sn_dir,mode=0o775)
-    
-    #create the unpacked data file
-    labels = [f[0] for f in single_record._fields_]
-    with open(unpackedFile,'w',opener=opener,newline='') as file:
-        write = csv.writer(file)
-        write.writerow(labels)
-        for r in packet.record:
-            write.writerow([getattr(r,l) for l in labels])
-            
-    #Now we are going to make the data more friendly and merge them into one file
-    sn = os.path.split(sn_dir)[1]
-    longFile = os.path.join(assetDir,sn+'.csv')
-    
-    #make a new file headers if needed
-    if not os.path.exists(longFile):
-        with open(longFile,'w',opener=opener,newline='') as file:
-            write = csv.writer(file)
-            write.writerow(['time','ambient','backscatter','waterPressure',
-                            'waterTemp','airPressure','airTemp',
-                            'batteryVoltage','waterDepth'])
-    
-    #append friendly data to our big record
-    with open(longFile,'a',newline='') as file:
-        write = csv.writer(file)
-        for r in packet.record:
-            dt = datetime.utcfromtimestamp(r.logtime)
-            time = dt.strftime('%Y-%m-%d %H:%M:%S')
-            P_w = r.waterPressure/1E5
-            T_w = r.waterTemp/10
-            P_a = 1 + r.baroAnomaly/1E5
-            T_a = r.airTemp/10
-            bV = r.batteryVoltage/10
-            density = getDensity(T_w)
-            depth = 1E5*(P_w-P_a)/(density*9.80665)
-            write.writerow([time,r.tuBackground,r.tuBackscatter,
-                            P_w,T_w,P_a,T_a,bV,depth])
-            
-
-fullFiles = glob.glob(os.path.join(assetDir,'*.csv'))
-xRange = [datetime.now()-timedelta(weeks=1), datetime.now()]
-for p in fullFiles:
-    plt.close('all')
-    sn = os.path.basename(p)[0:-4]
-    d = pd.read_csv(p,parse_dates=['time'],)
-    depthAxis = plt.subplot(4,1,1)
-    depthAxis.plot(d.time,d.waterDepth,'r.')
-    plt.ylabel("Water\ndepth (m)")
-    plt.xlim(xRange)
+    header, dataString = unpackBatch.readRaw(rawFile)
+    key = dedupeIndex.messageKey(header.get('imei') or sn,header.get('momsn'),dataString)
+    if dedupe.isDuplicate(key,os.path.join(sn,name)):
+        duplicates += 1
+        continue #redelivered, the first copy is already in
+    meta = rawArchive.metaRecord(name,name,header.get('momsn'),header.get('latitude'),header.get('longitude'))
+    candidates.append((unpackedFile,dataString,meta))
+
+#transmissions the endpoint appended to the log, in sequence order
+for sn, seq, fields in walMessages:
+    dataString = (fields.get('data') or "").strip()
+    key = dedupeIndex.messageKey(fields.get('imei') or sn,fields.get('momsn'),dataString)
+    if dedupe.isDuplicate(key,f"wal:{sn}:{seq}"):
+        duplicates += 1
+        continue
+    name = unpackBatch.walName(fields)
+    meta = rawArchive.metaRecord(name,fields.get('received'),fields.get('momsn'),
+                                 fields.get('iridium_latitude'),fields.get('iridium_longitude'))
+    candidates.append((os.path.join(unpackedDir,sn,name),dataString,meta))
+dedupe.close()
+
+#payloads go into the binary archive and are decoded from memmaps over it.
+#the registry works out each payload's format and decodes each format in one
+#go, and derived.py turns it into engineering units
+slices, invalid = unpackBatch.archive(archiveDir,candidates)
+start = time.perf_counter()
+newFiles, groups, counts = unpackBatch.decodeSlices(slices,invalid)
+friendlies = unpackBatch.friendly(newFiles,groups)
+seconds = time.perf_counter() - start
+nRecords = sum(len(friendly['time']) for sn, friendly in friendlies)
+metrics.observe('obs_decode_seconds',seconds,stage='update')
+metrics.gauge('obs_records_per_second',round(nRecords/max(seconds,1e-9)),stage='update')
+for name, n in counts.items():
+    metrics.inc('obs_transmissions_total',n,format=name,stage='update')
+metrics.inc('obs_transmissions_total',duplicates,format='duplicate',stage='update')
+counts['duplicate'] = duplicates
+print(", ".join(f"{n} {name}" for name, n in counts.items()))
+unpackBatch.writeUnpacked(newFiles,groups)
+metrics.inc('obs_bytes_written_total',sum(metrics.fileBytes(f) for f in set(newFiles)),kind='unpacked')
+
+#Now flag and append the friendly data to the store
+touched = set()
+for sn, friendly in friendlies:
+    start = time.perf_counter()
+    friendly['qc'] = qcFlags.update(qcDir,storeDir,sn,friendly)
+    metrics.observe('obs_qc_seconds',time.perf_counter() - start,stage='update')
+    for name, n in qcFlags.counts(friendly['qc']).items():
+        metrics.inc('obs_qc_flagged_total',n,check=name)
+        print(f"{sn}: {n} {name}")
+    store = seriesStore.SeriesStore(storeDir,sn)
+    store.append(friendly)
+    metrics.inc('obs_records_total',len(friendly['time']),stage='update')
+    metrics.inc('obs_bytes_written_total',len(friendly['time'])*store.recordBytes,kind='store')
+    #refresh the hourly/daily summaries for the hours these records touch
+    rollups.update(rollupFile,storeDir,sn,friendly['time'])
+    metrics.inc('obs_bytes_written_total',tiles.update(tileDir,storeDir,rollupFile,sn,friendly['time']),kind='tiles')
+    touched.add(sn)
 
+if exportCsv:
+    for sn in sorted(touched):
+        fileName = os.path.join(assetDir,sn+assetSuffix+'.csv')
+        seriesStore.SeriesStore(storeDir,sn).exportCsv(fileName)
+        metrics.inc('obs_bytes_written_total',metrics.fileBytes(fileName),kind='export')
+
+#everything we looked at is done, including the files we had to skip
+manifest.markDone(entries)
+manifest.commit()
+#and a rerun only has to look past the rows archived so far
+for sn in {os.path.basename(os.path.dirname(f)) for f, d, m in candidates}:
+    rawArchive.RawArchive(archiveDir,sn).commit()
+
+
+#round the window to the hour so a plot with no new data keeps its hash
+now = datetime.now().replace(minute=0,second=0,microsecond=0) + timedelta(hours=1)
+xRange = [now-timedelta(weeks=1), now]
+plotColumns = ['time','waterDepth','backscatter','waterTemp','airTemp','batteryVoltage','qc']
+
+def series(d,var,fmt,**kw):
+    #flagged values are left out, so the axes fit what's left
+    ok = qcFlags.good(d['qc'],var)
+    return dict({'x': d['time'][ok], 'y': d[var][ok], 'fmt': fmt},**kw)
+
+jobs = []
+for sn in seriesStore.listSerials(storeDir):
+    if serials is not None and sn not in serials:
+        continue
+    #only the partitions overlapping the plot window are read
+    d = seriesStore.query(storeDir,sn,xRange[0],xRange[1],plotColumns)
     # if sn in nameDict:
-    #     plt.title(f"{nameDict[self.sn]}")
+    #     title = f"{nameDict[self.sn]}"
     # else:
-    plt.title(f"Iridium SN: {sn}.")
-
-    turbAxis = plt.subplot(4,1,2, sharex=depthAxis)
-    turbAxis.plot(d.time,d.backscatter,'b.')
-    plt.ylabel("Backscatter")
-    plt.ylim([3000,10000])
-   
-    tempAxis = plt.subplot(4,1,3, sharex=depthAxis)
-    tempAxis.plot(d.time,d.waterTemp,'b.',label='water')
-    tempAxis.plot(d.time,d.airTemp,'k.',label='air')
-    plt.legend(loc='upper left')
-    plt.ylabel("Temp (C)")
-
-    battAxis = plt.subplot(4,1,4, sharex=depthAxis)
-    battAxis.plot(d.time,d.batteryVoltage,'k.')
-    plt.ylabel("Battery\nVoltage")
-    plt.ylim([11.5,14.5])
-           
-    fig = plt.gcf()
-    fig.set_size_inches(4, 6)
-    fig.autofmt_xdate()
-    plt.tight_layout()
-    fig.savefig(f'{assetDir}/{sn}.png', dpi=300)
-    
-    
\ No newline at end of file
+    title = f"Iridium SN: {sn}."
+    jobs.append({'fileName': f'{assetDir}/{sn}{assetSuffix}.png',
+                 'title': title,
+                 'xlim': xRange,
+                 'panels': [{'ylabel': "Water\ndepth (m)",
+                             'series': [series(d,'waterDepth','r.')]},
+                            {'ylabel': "Backscatter",
+                             'series': [series(d,'backscatter','b.')]},
+                            {'ylabel': "Temp (C)", 'legend': 'upper left',
+                             'series': [series(d,'waterTemp','b.',label='water'),
+                                        series(d,'airTemp','k.',label='air')]},
+                            {'ylabel': "Battery\nVoltage",
+                             'series': [series(d,'batteryVoltage','k.')]}]})
+
+plotRender.renderAll(jobs)
@@ -1,134 +1,86 @@
 #!/usr/bin/python3.10
 
-import os
-import glob
-import csv
-import re
 import numpy as np
-os.environ['MPLCONFIGDIR'] = "/tmp/"
-import matplotlib.pyplot as plt
-from datetime import datetime
+from datetime import datetime, timedelta
+import obsData
+import derived
+import qcFlags
+import transmissionCatalog
+import plotRender
+import metrics
+
+#OBS_PROFILE=<dir> profiles the run, see metrics.py
+metrics.profile()
+metrics.runTimer('legacy')
 
 assetDir = '/var/www/html/assets'
+catalogFile = '/srv/data/catalog.sqlite'
+#per-serial calibration constants, see derived.py
+calibrationFile = '/srv/data/calibration.json'
+#CSVs from before the endpoint kept the catalog are cataloged on the first run
+dataDir = '/srv/data'
 
 nameDict = {209175: "Tanana Lakes",
             210571: "Sam Charley",
             211590: "Jonas house"}
 
-class OBS:
-    def __init__(self,sn,lat,lon):
-        self.sn = sn
-        self.lat = lat
-        self.lon = lon
-        self.time = []
-        self.timeString = []
-        self.pressure = []
-        self.depth = []
-        self.ambient = []
-        self.backscatter = []
-        self.temp = []
-        self.battV = []
-        
-    def addData(self, dataRow):        
-        time = datetime.utcfromtimestamp(dataRow[0])
-        timeString = time.strftime('%Y-%m-%d %H:%M:%S')
-        depth = (dataRow[1]/1E4 - 1) * 10.1972 #rough conversion from bar*10^-4 to water depth   
-        
-        self.time = np.append(self.time,time)
-        self.timeString = np.append(self.timeString,timeString)
-        self.pressure = np.append(self.pressure,dataRow[1]/10)
-        self.depth = np.append(self.depth,depth)
-        self.ambient = np.append(self.ambient,dataRow[2])
-        self.backscatter = np.append(self.backscatter,dataRow[3])
-        self.temp = np.append(self.temp,dataRow[4]/100)  
-        self.battV = np.append(self.battV,dataRow[5])
-        
-
-    def applySubset(self,mask):
-        self.time = self.time[mask]
-        self.timeString = self.timeString[mask]
-        self.pressure = self.pressure[mask]
-        self.depth = self.depth[mask]
-        self.ambient = self.ambient[mask]
-        self.backscatter = self.backscatter[mask]
-        self.temp = self.temp[mask]
-        self.battV = self.battV[mask]
-    
-    
-    def plotAndSave(self,xRange,depthMin,scatterMax):
-        mask = [d>depthMin for d in self.depth]
-        depthAxis = plt.subplot(4,1,1)
-        depthAxis.plot(self.time[mask],self.depth[mask],'r.')
-        plt.ylabel("Appx. water\ndepth (m)")
-        plt.xlim(xRange)
+class OBS(obsData.OBS):
+    __slots__ = ()
 
+    def plotJob(self,xRange):
         if self.sn in nameDict:
-            plt.title(f"{nameDict[self.sn]}")
+            title = f"{nameDict[self.sn]}"
         else:
-            plt.title(f"Iridium SN: {self.sn}.")
-
-        mask = [b<scatterMax for b in self.backscatter]
-        turbAxis = plt.subplot(4,1,2, sharex=depthAxis)
-        turbAxis.plot(self.time[mask],self.backscatter[mask],'b.')
-        #turbAxis.set_yscale("log")
-        plt.ylabel("Backscatter")
-       
-        tempAxis = plt.subplot(4,1,3, sharex=depthAxis)
-        tempAxis.plot(self.time,self.temp,'k.')
-        plt.ylabel("Temp (C)")
-
-        battAxis = plt.subplot(4,1,4, sharex=depthAxis)
-        battAxis.plot(self.time,self.battV,'k.')
-        plt.ylabel("Battery\nVoltage")
-               
-        fig = plt.gcf()
-        fig.set_size_inches(4, 6)
-        fig.autofmt_xdate()
-        plt.tight_layout()
-        fig.savefig(f'{assetDir}/{self.sn}.png', dpi=300)
-    
-        return [depthAxis,turbAxis,battAxis]
+            title = f"Iridium SN: {self.sn}."
+
+        #values qcFlags.py flags stay in the CSV but not in the plot
+        qc = self.qc()
+        depthMask = qcFlags.good(qc,'waterDepth')
+        scatterMask = qcFlags.good(qc,'backscatter')
+        tempMask = qcFlags.good(qc,'waterTemp')
+        battMask = qcFlags.good(qc,'batteryVoltage')
+        return {'fileName': f'{assetDir}/{self.sn}.png',
+                'title': title,
+                'xlim': xRange,
+                'panels': [{'ylabel': "Appx. water\ndepth (m)",
+                            'series': [{'x': self.time[depthMask], 'y': self.depth[depthMask], 'fmt': 'r.'}]},
+                           {'ylabel': "Backscatter",
+                            'series': [{'x': self.time[scatterMask], 'y': self.backscatter[scatterMask], 'fmt': 'b.'}]},
+                           {'ylabel': "Temp (C)",
+                            'series': [{'x': self.time[tempMask], 'y': self.temp[tempMask], 'fmt': 'k.'}]},
+                           {'ylabel': "Battery\nVoltage",
+                            'series': [{'x': self.time[battMask], 'y': self.battV[battMask], 'fmt': 'k.'}]}]}
         
 
-fileList = glob.glob('/srv/data/*/*.csv')
-loggers = list()
-
-for singleFile in fileList:
-    with open(singleFile) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        found_headers = False
-        for row in csv_reader: 
-            if "serial" in row[0]:
-                deviceSN = int(re.search("[0-9]+",row[0])[0])
-            elif "latitude" in row[0]:
-                lat = float(re.search("[-0-9.]+",row[0])[0])
-            elif "longitude" in row[0]:
-                lon = float(re.search("[-0-9.]+",row[0])[0])
-            elif "battery" in row[0]:
-                battString = re.search("[-0-9.]+",row[0])[0]
-                battV = round(float(battString),2)
-            elif "UnixTime" in row[0]:
-                found_headers = True #done with the headers
-                #now create or find the appropriate logger variable and add the data
-                snMatch = [l.sn==deviceSN for l in loggers]
-                if any(snMatch):
-                    snIdx = int(np.linspace(0,len(snMatch)-1,len(snMatch))[snMatch])
-                else:
-                    loggers.append(OBS(deviceSN,lat,lon))
-                    snIdx = len(loggers)-1
-            elif found_headers:
-                dataRow = [int(r) for r in row]
-                dataRow.append(battV)
-                loggers[snIdx].addData(dataRow)
+startDate = datetime(2022,10,3)
+derived.loadCalibrations(calibrationFile)
+catalog = transmissionCatalog.TransmissionCatalog(catalogFile)
+added = catalog.indexArchive(dataDir)
+if added is not None:
+    print(f'Cataloged {added} archived transmissions.')
+
+#received time is server local and records are UTC, keep a day of margin
+loggers = dict()
+for t in catalog.window(t0=startDate-timedelta(days=1)):
+    if not t['location'].endswith('.csv'):
+        continue #payload only in the transmission log, nothing decoded to read
+    if t['serial'] not in loggers:
+        loggers[t['serial']] = OBS(t['serial'],t['latitude'],t['longitude'])
+    battV = round(t['battery'],2) if t['battery'] is not None else np.nan
+    fileRows = transmissionCatalog.readRecords(t['location'])
+    if fileRows:
+        loggers[t['serial']].addRows([r+[battV] for r in fileRows])
 
 
 #write the data out to a text file
-xRange = [datetime(2022,10,3), datetime.now()]
-for obs in loggers:
-    sortIdx = obs.time.argsort()
-    obs.applySubset(sortIdx)
-    dateMask = [t>=xRange[0] for t in obs.time]    
-    obs.applySubset(dateMask)
+#round the end to the hour so a plot with no new data keeps its hash
+xRange = [startDate,
+          datetime.now().replace(minute=0,second=0,microsecond=0) + timedelta(hours=1)]
+plotJobs = []
+for obs in loggers.values():
+    obs.sortByTime()
+    obs.filterStartDate(xRange[0])
+    timeString = obs.timeString
     with open(f"{assetDir}/{obs.sn}.csv","w",newline="") as file:
         file.write(f"serial number: {obs.sn}\n")
         file.write(f"lat: {obs.lat:0.2f}\n")
@@ -136,12 +88,12 @@ for obs in loggers:
         file.write("time,pressure (mbar),approximate depth (m),ambient,backscatter," +
                     "temp (C),battery (V)")
         for i in range(0,len(obs.time)):
-            file.write(f"\n{obs.timeString[i]},{obs.pressure[i]},{obs.depth[i]:0.2f},"+
+            file.write(f"\n{timeString[i]},{obs.pressure[i]},{obs.depth[i]:0.2f},"+
                     f"{obs.ambient[i]},{obs.backscatter[i]},{obs.temp[i]},{obs.battV[i]}")
 
     lastReportText = f"""LAST TRANSMISSION
     Serial:       {obs.sn} 
-    Time (AKDT):  {obs.time[-1].strftime('%Y-%m-%d %H:%M:%S')}
+    Time (AKDT):  {timeString[-1]}
     Pressure:     {obs.pressure[-1]:0.1f} mbar
     Appx. Depth:  {obs.depth[-1]:0.2f} m
     Ambient:      {obs.ambient[-1]:0.0f}
@@ -152,7 +104,8 @@ for obs in loggers:
     with open(f"{assetDir}/{obs.sn}_status.txt","w",newline="") as file:
         file.write(lastReportText)
 
-    plt.close("all")
-    obs.plotAndSave(xRange,0,100000)
+    plotJobs.append(obs.plotJob(xRange))
+
+plotRender.renderAll(plotJobs)
 
 
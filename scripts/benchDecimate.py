@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Render time and peak memory of a station plot at full resolution vs. after
+min/max or LTTB decimation.
+
+    python benchDecimate.py [nPoints]
+
+Each mode runs in its own interpreter so the peak RSS numbers don't bleed
+into each other.
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+import tempfile
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..','data_backend','data'))
+import plotRender
+import decimate
+
+modes = ['full','minmax','lttb']
+
+
+def makeJob(n, fileName):
+    #a long deployment at 10 s sampling with some spikes
+    rng = np.random.default_rng(0)
+    t = (1683227186 + 10*np.arange(n)).astype('datetime64[s]')
+    depth = 1 + 0.5*np.sin(np.arange(n)/8640*2*np.pi) + rng.normal(0,0.02,n)
+    scatter = 5000 + rng.normal(0,200,n)
+    scatter[rng.integers(0,n,20)] = 9500
+    temp = 10 + 5*np.sin(np.arange(n)/86400*2*np.pi)
+    batt = 13 - np.arange(n)/n + rng.normal(0,0.05,n)
+    return {'fileName': fileName, 'title': 'benchmark', 'decimate': False,
+            'panels': [{'ylabel': 'depth', 'series': [{'x': t, 'y': depth, 'fmt': 'r.'}]},
+                       {'ylabel': 'scatter', 'series': [{'x': t, 'y': scatter, 'fmt': 'b.'}]},
+                       {'ylabel': 'temp', 'series': [{'x': t, 'y': temp, 'fmt': 'k.'}]},
+                       {'ylabel': 'battery', 'series': [{'x': t, 'y': batt, 'fmt': 'k.'}]}]}
+
+
+def runMode(mode, n):
+    fileName = os.path.join(tempfile.gettempdir(), f'benchDecimate_{mode}.png')
+    job = makeJob(n, fileName)
+    start = time.perf_counter()
+    if mode == 'minmax':
+        decimate.decimateJob(job)
+    elif mode == 'lttb':
+        for p in job['panels']:
+            for s in p['series']:
+                s['x'], s['y'] = decimate.lttb(s['x'], s['y'], 2400)
+    decimated = time.perf_counter()
+    plotRender.renderFigure(job)
+    done = time.perf_counter()
+    kept = sum(len(s['y']) for p in job['panels'] for s in p['series'])
+    #ru_maxrss is kB on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:<8s}{n:>10d}{kept:>10d}{decimated-start:>10.3f}{done-decimated:>10.3f}{rss:>10.1f}")
+    os.remove(fileName)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        runMode(sys.argv[2], int(sys.argv[1]))
+        sys.exit()
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    print(f"{'mode':<8s}{'points':>10s}{'drawn':>10s}{'decim s':>10s}{'render s':>10s}{'RSS MB':>10s}")
+    for mode in modes:
+        subprocess.run([sys.executable, __file__, str(n), mode], check=True)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark suite for the data backend, on synthetic data from
+syntheticArchive.py. Each benchmark runs in its own interpreter so the peak
+RSS reported is its own.
+
+    python benchmark.py [nRecords] [name ...]
+
+Reports records per second and peak RSS for decoding, aggregation, store
+and CSV writes, and plotting. First checks that the synthetic packets
+packRecords builds match the loggers' ctypes layout byte for byte.
+"""
+import os
+import sys
+import csv
+import time
+import resource
+import tempfile
+import shutil
+import subprocess
+import ctypes as ct
+from datetime import datetime
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(here,'..','data_backend','data'))
+import syntheticArchive
+import packetDecode
+import seriesStore
+import derived
+import obsData
+import plotRender
+
+
+def friendly(d):
+    #same derived columns as update-data-2023.py
+    return derived.Dataset(d).get(seriesStore.schema)
+
+
+def benchDecodeCtypes(n, workDir):
+    packets = syntheticArchive.packets2023(syntheticArchive.simulate(n))
+    class transmission_packet(ct.Union):
+        _fields_ = [("record", syntheticArchive.single_record*3),
+                    ("data", ct.c_ubyte*48)]
+    labels = [f[0] for f in syntheticArchive.single_record._fields_]
+    start = time.perf_counter()
+    for p in packets:
+        packet = transmission_packet()
+        packet.data = (ct.c_ubyte * 48)(*p)
+        rows = [[getattr(r,l) for l in labels] for r in packet.record]
+    return 3*len(packets), time.perf_counter() - start
+
+
+def benchDecodeNumpy(n, workDir):
+    packets = syntheticArchive.packets2023(syntheticArchive.simulate(n))
+    start = time.perf_counter()
+    packetDecode.decodePackets(packets)
+    return 3*len(packets), time.perf_counter() - start
+
+
+def benchAggregate(n, workDir):
+    rec = syntheticArchive.simulate(n)
+    rows = np.column_stack([rec['logtime'], rec['waterPressure']//10, rec['tuBackground'],
+                            rec['tuBackscatter'], rec['waterTemp']*10,
+                            np.full(n, 4.1)])[::-1]
+    start = time.perf_counter()
+    obs = obsData.OBS(1, 64.8, -147.7)
+    for i in range(0, n, 3):
+        obs.addRows(rows[i:i+3])
+    obs.sortByTime()
+    obs.filterStartDate(datetime(2023,3,1))
+    obs.timeString
+    return n, time.perf_counter() - start
+
+
+def benchLongCsv(n, workDir):
+    d = friendly(syntheticArchive.simulate(n))
+    start = time.perf_counter()
+    with open(os.path.join(workDir,'long.csv'),'a',newline='') as file:
+        write = csv.writer(file)
+        for i in range(n):
+            t = datetime.utcfromtimestamp(int(d['time'][i])).strftime('%Y-%m-%d %H:%M:%S')
+            write.writerow([t]+[d[c][i] for c in list(d)[1:]])
+    return n, time.perf_counter() - start
+
+
+def benchStoreAppend(n, workDir):
+    d = friendly(syntheticArchive.simulate(n))
+    start = time.perf_counter()
+    store = seriesStore.SeriesStore(workDir,'1')
+    for i in range(0, n, 300):
+        store.append({k: v[i:i+300] for k, v in d.items()})
+    return n, time.perf_counter() - start
+
+
+def benchStoreQuery(n, workDir):
+    d = friendly(syntheticArchive.simulate(n))
+    seriesStore.SeriesStore(workDir,'1').append(d)
+    t1 = int(d['time'][-1])
+    start = time.perf_counter()
+    q = seriesStore.query(workDir,'1',t1-7*86400,t1,['time','waterDepth'])
+    return len(q['time']), time.perf_counter() - start
+
+
+def benchCsvExport(n, workDir):
+    d = friendly(syntheticArchive.simulate(n))
+    store = seriesStore.SeriesStore(workDir,'1')
+    store.append(d)
+    start = time.perf_counter()
+    store.exportCsv(os.path.join(workDir,'export.csv'))
+    return n, time.perf_counter() - start
+
+
+def benchPlot(n, workDir):
+    d = friendly(syntheticArchive.simulate(n))
+    t = d['time'].astype('datetime64[s]')
+    job = {'fileName': os.path.join(workDir,'plot.png'), 'title': 'benchmark',
+           'panels': [{'ylabel': c, 'series': [{'x': t, 'y': d[c], 'fmt': 'k.'}]}
+                      for c in ['waterDepth','backscatter','waterTemp','batteryVoltage']]}
+    start = time.perf_counter()
+    plotRender.renderAll([job], processes=1)
+    return n, time.perf_counter() - start
+
+
+benchmarks = {'decode-ctypes': benchDecodeCtypes,
+              'decode-numpy': benchDecodeNumpy,
+              'aggregate-obs': benchAggregate,
+              'write-long-csv': benchLongCsv,
+              'store-append': benchStoreAppend,
+              'store-query-week': benchStoreQuery,
+              'export-csv': benchCsvExport,
+              'plot': benchPlot}
+
+
+def checkPacking(n=1000):
+    #the numpy packer the benchmarks use must match the loggers' ctypes layout
+    rec = syntheticArchive.simulate(n)
+    assert syntheticArchive.packRecords(rec) == syntheticArchive.packRecordsCtypes(rec), \
+        "syntheticArchive.packRecords disagrees with the ctypes single_record layout"
+
+
+def runOne(name, n):
+    workDir = tempfile.mkdtemp(prefix='obsbench_')
+    try:
+        records, seconds = benchmarks[name](n, workDir)
+    finally:
+        shutil.rmtree(workDir)
+    #ru_maxrss is kB on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:<18s}{records:>10d}{seconds:>10.3f}{records/max(seconds,1E-9):>14.0f}{rss:>10.1f}",
+          flush=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--one':
+        runOne(sys.argv[2], int(sys.argv[3]))
+        sys.exit()
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    names = sys.argv[2:] or list(benchmarks)
+    checkPacking()
+    print(f"{'benchmark':<18s}{'records':>10s}{'seconds':>10s}{'records/s':>14s}{'RSS MB':>10s}")
+    for name in names:
+        subprocess.run([sys.executable, __file__, '--one', name, str(n)], check=True)
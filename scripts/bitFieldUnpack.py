@@ -41,8 +41,19 @@ for r in packet.record:
         print('{:<20s}{}'.format(f[0],getattr(r,f[0])))
 
 # %%
-    
-    
+#check the vectorized decoder used by the backend against the ctypes union
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..','data_backend','data'))
+import packetDecode
+
+decoded = packetDecode.decodePackets([dataBytes],nBytes)
+for i, r in enumerate(packet.record):
+    for f in r._fields_:
+        assert decoded[f[0]][i] == getattr(r,f[0]), f"{f[0]} mismatch in record {i}"
+print('\nvectorized decoder matches ctypes.')
+
 
 """
 from Arduino to help verify.
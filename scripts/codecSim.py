@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Replay an archive of 2023 transmissions through the delta codec
+(data_backend/data/deltaCodec.py) and compare it with the fixed 48 byte
+messages the loggers send now.
+
+    python codecSim.py <rawDir>                 raw text archive
+    python codecSim.py --archive <archiveDir>   rawArchive.py binary archive
+    python codecSim.py --synthetic [nRecords] [interval]
+
+Per serial it reports records per 50 byte message (one Iridium credit) for
+both, the credits saved, the mean bits each field costs per record, and
+checks that every record decodes back exactly. Encode and decode
+throughput are for the whole archive.
+"""
+import os
+import sys
+import time
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(here,'..','data_backend','data'))
+import packetDecode
+import payloadFormats
+import deltaCodec
+import unpackBatch
+import rawArchive
+import syntheticArchive
+
+
+def recordsFrom(raw):
+    #records in log time order, each logged time once (redeliveries, overlaps)
+    rec = packetDecode.decodePackets(raw)
+    _, keep = np.unique(rec['logtime'], return_index=True)
+    return {name: rec[name][keep] for name in packetDecode.labels}
+
+
+def loadRaw(rawDir):
+    out = {}
+    for sn in sorted(os.listdir(rawDir)):
+        payloads = []
+        for name in sorted(os.listdir(os.path.join(rawDir,sn))):
+            header, dataString = unpackBatch.readRaw(os.path.join(rawDir,sn,name))
+            try:
+                payload = bytes.fromhex(dataString)
+            except ValueError:
+                continue
+            if len(payload) == packetDecode.nBytes:
+                payloads.append(payload)
+        if payloads:
+            out[sn] = recordsFrom(np.frombuffer(b''.join(payloads),np.uint8).reshape(-1,packetDecode.nBytes))
+    return out
+
+
+def loadArchive(archiveDir):
+    out = {}
+    for sn in rawArchive.listSerials(archiveDir):
+        raw = rawArchive.RawArchive(archiveDir,sn).packets(packetDecode.nBytes)
+        if len(raw):
+            out[sn] = recordsFrom(np.asarray(raw))
+    return out
+
+
+def fieldBits(messages):
+    #residual bits per record, per field, over a set of messages
+    bits = np.zeros(len(deltaCodec.names))
+    records = 0
+    for m in messages:
+        n, low, modes, widths, pos = deltaCodec.readHeader(m)
+        bits += np.array(widths)*(n-1)
+        records += n
+    return bits/max(records,1)
+
+
+def simulate(serials):
+    allFixed = []
+    allDelta = []
+    nRecords = 0
+    encodeSeconds = 0
+    print(f"{'serial':>14} {'records':>8} {'fixed/msg':>9} {'delta/msg':>9} {'saved':>6}  bits per record by field")
+    for sn, rec in serials.items():
+        n = len(rec['logtime'])
+        start = time.perf_counter()
+        messages = deltaCodec.encodeAll(rec)
+        encodeSeconds += time.perf_counter() - start
+
+        raw = np.frombuffer(b''.join(messages),np.uint8).reshape(-1,deltaCodec.nBytes)
+        back = deltaCodec.decodePackets(raw)
+        for name in deltaCodec.names:
+            if not np.array_equal(back[name].astype(np.int64),rec[name].astype(np.int64)):
+                sys.exit(f"{sn}: {name} didn't decode back exactly")
+
+        fixed = -(-n // packetDecode.nRecords)
+        bits = fieldBits(messages)
+        print(f"{sn:>14} {n:>8} {n/fixed:>9.2f} {n/len(messages):>9.2f} {1-len(messages)/fixed:>6.0%}  " +
+              " ".join(f"{name}={b:.1f}" for name, b in zip(deltaCodec.names,bits)))
+        allDelta += messages
+        allFixed += syntheticArchive.packets2023(rec)
+        nRecords += n
+
+    #decode through the registry, as update-data-2023.py does
+    start = time.perf_counter()
+    payloadFormats.decodeBatch(allFixed)
+    fixedSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    groups, counts = payloadFormats.decodeBatch(allDelta)
+    deltaSeconds = time.perf_counter() - start
+    assert counts['2023-delta-v1'] == len(allDelta)
+
+    print(f"\n{nRecords} records: {len(allFixed)} fixed messages, {len(allDelta)} delta messages")
+    print(f"encode delta:  {nRecords/encodeSeconds:12,.0f} records/s")
+    print(f"decode fixed:  {nRecords/fixedSeconds:12,.0f} records/s")
+    print(f"decode delta:  {nRecords/deltaSeconds:12,.0f} records/s")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        sys.exit(__doc__)
+    if args[0] == '--synthetic':
+        n = int(args[1]) if len(args) > 1 else 10000
+        interval = int(args[2]) if len(args) > 2 else 600
+        serials = {'synthetic': syntheticArchive.simulate(n,interval)}
+    elif args[0] == '--archive':
+        serials = loadArchive(args[1])
+    else:
+        serials = loadRaw(args[0])
+    simulate(serials)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for the RockBLOCK endpoint. Starts a throwaway instance on a
+temporary data directory, posts RockBLOCK style deliveries (form encoded
+imei/serial/momsn/.../data, legacy payloads from syntheticArchive.py) at it
+from concurrent clients, and reports what came out.
+
+    python loadTest.py [messages] [rate per s, 0 = flat out] [concurrency] [--cgi]
+                       [--keep=<dir>] [--url=<url>]
+
+The instance is rockblockService.py, or with --cgi rockblock.py run once
+per request like Apache runs it. --keep leaves its data directory in <dir>.
+--url posts to an endpoint that is already running instead, and skips the
+checks of its files.
+
+Like RockBLOCK, a request that fails or takes longer than timeout is sent
+again, up to retries times, and a fraction redeliver of the messages is
+delivered twice anyway. Reports:
+
+  - latency percentiles per request and how far behind schedule the clients fell
+  - the error rate (non-200 answers and timeouts)
+  - messages acknowledged but missing from the transmission log (lost), and
+    messages in it more than once (duplicates), once the service's worker
+    has caught up
+  - the files and bytes the endpoint wrote, per kind
+"""
+import os
+import sys
+import time
+import random
+import socket
+import shutil
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+cgiDir = os.path.join(here,'..','data_backend','cgi-bin')
+sys.path.insert(0,os.path.join(here,'..','data_backend','data'))
+import syntheticArchive
+import transmissionLog
+
+nSerials = 4
+redeliver = 0.02
+retries = 3
+timeout = 10.0
+#how long to wait for the service's worker to catch up after the last request
+drainSeconds = 120
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def buildMessages(n):
+    """n deliveries [(momsn key, form body)], the serials' messages interleaved in MOMSN order."""
+    perSerial = -(-n // nSerials)
+    bySerial = []
+    for k, sn in enumerate(syntheticArchive.serialNumbers(nSerials)):
+        rec = syntheticArchive.simulate(perSerial*syntheticArchive.legacyRecords, seed=k)
+        packets = syntheticArchive.packetsLegacy(rec)
+        times = syntheticArchive.receiveStrings(rec['logtime'][syntheticArchive.legacyRecords-1::syntheticArchive.legacyRecords])
+        bySerial.append([((str(sn), momsn), urlencode({
+            'imei': sn, 'serial': sn, 'momsn': momsn,
+            'transmit_time': f"{t[2:4]}-{t[4:6]}-{t[6:8]} {t[8:10]}:{t[10:12]}:{t[12:14]}",
+            'iridium_latitude': 64.8, 'iridium_longitude': -147.7, 'iridium_cep': 3,
+            'data': p.hex()}).encode()) for momsn, (p, t) in enumerate(zip(packets, times))])
+    messages = [m for group in zip(*bySerial) for m in group][:n]
+
+    #RockBLOCK's own redeliveries, a little after the first copy
+    rng = random.Random(0)
+    for i in sorted(rng.sample(range(n), int(n*redeliver)), reverse=True):
+        messages.insert(min(len(messages), i + rng.randint(1, 20)), messages[i])
+    return messages
+
+
+def instanceEnv(dataPath):
+    #everything the endpoint writes goes under dataPath, and no
+    #update-data-2023.py runs, this measures the endpoint
+    return dict(os.environ, OBS_DATA_PATH=dataPath, OBS_UPDATE_SCRIPT='',
+                OBS_METRICS_FILE=os.path.join(dataPath, 'metrics', 'openobs.prom'))
+
+
+def cgiServer(port, dataPath):
+    """Run rockblock.py per POST the way a CGI web server does."""
+    script = os.path.join(cgiDir, 'rockblock.py')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            env = dict(instanceEnv(dataPath), REQUEST_METHOD='POST', CONTENT_LENGTH=str(length),
+                       CONTENT_TYPE=self.headers.get('Content-Type', ''), QUERY_STRING='')
+            out = subprocess.run([sys.executable, script], input=self.rfile.read(length),
+                                 capture_output=True, env=env, cwd=cgiDir).stdout
+            #the script prints its own header block
+            head, _, body = out.partition(b'\n\n')
+            self.send_response(200 if b'Content-Type' in head else 500)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def waitForPort(port, seconds=30):
+    end = time.time() + seconds
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit(f"nothing listening on port {port}")
+
+
+def deliver(url, body, due):
+    """Post one delivery, retrying like RockBLOCK. Returns (lag, [latencies], errors, acked)."""
+    delay = due - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+    lag = time.perf_counter() - due
+    latencies = []
+    errors = 0
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, body), timeout=timeout) as r:
+                r.read()
+                ok = r.status == 200
+        except OSError:
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        if ok:
+            return lag, latencies, errors, True
+        errors += 1
+    return lag, latencies, errors, False
+
+
+def walKeys(walDir):
+    counts = {}
+    for sn in transmissionLog.listSerials(walDir):
+        for seq, fields in transmissionLog.replayMessages(walDir, sn):
+            key = (fields.get('imei'), int(fields.get('momsn')))
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def catalogRows(catalogFile):
+    try:
+        db = sqlite3.connect(f"file:{catalogFile}?mode=ro", uri=True)
+        n = db.execute("SELECT COUNT(*) FROM transmissions").fetchone()[0]
+        db.close()
+        return n
+    except sqlite3.Error:
+        return 0
+
+
+def filesWritten(dataPath):
+    """{kind: (files, bytes)}, serial directories of CSVs and each database's files counted together."""
+    out = {}
+    for entry in sorted(os.listdir(dataPath)):
+        path = os.path.join(dataPath, entry)
+        kind = 'csv' if entry.isdigit() else entry.split('.')[0]
+        files = [os.path.join(d, f) for d, _, names in os.walk(path) for f in names] if os.path.isdir(path) else [path]
+        n, size = out.get(kind, (0, 0))
+        out[kind] = (n + len(files), size + sum(os.path.getsize(f) for f in files))
+    return out
+
+
+def run(nMessages, rate, concurrency, cgi=False, keep=None, url=None):
+    messages = buildMessages(nMessages)
+    dataPath = None
+    process = server = None
+    if url is None:
+        dataPath = keep or tempfile.mkdtemp(prefix='loadTest')
+        os.makedirs(dataPath, exist_ok=True)
+        port = freePort()
+        url = f"http://127.0.0.1:{port}/"
+        if cgi:
+            server = cgiServer(port, dataPath)
+        else:
+            process = subprocess.Popen([sys.executable, 'rockblockService.py', str(port), dataPath],
+                                       cwd=cgiDir, env=instanceEnv(dataPath))
+        waitForPort(port)
+
+    print(f"{len(messages)} deliveries ({nMessages} messages) to {url}, "
+          f"{'flat out' if not rate else f'{rate:g}/s'}, {concurrency} clients")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(deliver, url, body, start + (i/rate if rate else 0))
+                   for i, (key, body) in enumerate(messages)]
+        results = [f.result() for f in futures]
+    seconds = time.perf_counter() - start
+
+    lags = np.array([r[0] for r in results])
+    latencies = np.array([l for r in results for l in r[1]])
+    errors = sum(r[2] for r in results)
+    acked = {key for (key, body), r in zip(messages, results) if r[3]}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1E3
+    print(f"requests:   {len(latencies)} in {seconds:.1f} s ({len(latencies)/seconds:.0f}/s)")
+    print(f"latency ms: p50 {p50:.1f}  p95 {p95:.1f}  p99 {p99:.1f}  max {latencies.max()*1E3:.1f}")
+    print(f"behind schedule ms: p50 {np.percentile(lags, 50)*1E3:.1f}  p99 {np.percentile(lags, 99)*1E3:.1f}")
+    print(f"errors:     {errors} ({errors/len(latencies):.2%}), "
+          f"{nMessages - len(acked)} messages never acknowledged")
+
+    if dataPath is not None:
+        #the service answers before its worker writes the CSV and catalog row
+        walDir = os.path.join(dataPath, 'wal')
+        drainStart = time.perf_counter()
+        while time.perf_counter() - drainStart < drainSeconds:
+            if catalogRows(os.path.join(dataPath, 'catalog.sqlite')) >= len(walKeys(walDir)):
+                break
+            time.sleep(0.2)
+        print(f"caught up {time.perf_counter() - drainStart:.1f} s after the last request")
+
+        logged = walKeys(walDir)
+        lost = len(acked - set(logged))
+        duplicates = sum(n - 1 for n in logged.values())
+        print(f"logged:     {len(logged)} messages, {lost} acknowledged but lost, {duplicates} duplicates")
+        print(f"cataloged:  {catalogRows(os.path.join(dataPath, 'catalog.sqlite'))}")
+        for kind, (n, size) in filesWritten(dataPath).items():
+            print(f"  {kind:<22s}{n:>8d} files {size/1E6:>10.2f} MB")
+
+    if process is not None:
+        process.terminate()
+        process.wait()
+    if server is not None:
+        server.shutdown()
+    if dataPath is not None and keep is None:
+        shutil.rmtree(dataPath)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = dict(a[2:].split('=', 1) for a in args if a.startswith('--') and '=' in a)
+    args = [a for a in args if not a.startswith('--')]
+    run(int(args[0]) if len(args) > 0 else 2000,
+        float(args[1]) if len(args) > 1 else 0,
+        int(args[2]) if len(args) > 2 else 16,
+        '--cgi' in sys.argv, options.get('keep'), options.get('url'))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Local SMTP stand-in for testing email-report.py without sending anything.
+Accepts every message (no TLS, any or no login) and writes it to
+<outDir>/<n>.eml.
+
+    python smtpSink.py [outDir] [port]
+    OBS_SMTP_HOST=localhost OBS_SMTP_PORT=8025 OBS_SMTP_SSL=0 OBS_REPORT_TO=me@example.com \
+        python ../data_backend/data/email-report.py
+"""
+import os
+import sys
+import itertools
+import socketserver
+
+counter = itertools.count(1)
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    outDir = '.'
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 smtpSink ready')
+        for line in self.rfile:
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply('250-smtpSink')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'AUTH':
+                self.reply('235 ok')
+            elif verb == 'DATA':
+                self.reply('354 end with <CRLF>.<CRLF>')
+                lines = []
+                for dataLine in self.rfile:
+                    if dataLine.rstrip(b'\r\n') == b'.':
+                        break
+                    #undo dot stuffing
+                    lines.append(dataLine[1:] if dataLine.startswith(b'..') else dataLine)
+                fileName = os.path.join(self.outDir, f"{next(counter)}.eml")
+                with open(fileName, 'wb') as file:
+                    file.writelines(lines)
+                print(f"received {fileName}", flush=True)
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                #HELO, MAIL, RCPT, RSET, NOOP...
+                self.reply('250 ok')
+
+
+class SinkServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    SinkHandler.outDir = sys.argv[1] if len(sys.argv) > 1 else '.'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8025
+    os.makedirs(SinkHandler.outDir, exist_ok=True)
+    with SinkServer(('localhost', port), SinkHandler) as server:
+        server.serve_forever()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic transmission archives for benchmarks and offline testing.
+
+Records are bit-packed exactly like the loggers do it:
+  - 2023 format: single_record_t from
+    bank_logger/firmware/OpenOBS_logger/OpenOBS_logger.ino, 16 bytes per
+    record, N_RECORDS = 50/16 = 3 records per 48 byte message.
+  - legacy format: "<2L2Hh" records as unpacked by
+    data_backend/cgi-bin/rockblock.py, with the battery word written over the
+    first two bytes and two trailing bytes that the backend drops.
+
+and written in the on-disk shapes the backend scripts read:
+  - 2023: rawDir/<sn>/<YYYYmmddHHMMSS>.csv with the hex payload on line 7
+  - legacy: dataDir/<sn>/<YYYYmmddHHMMSS>_<momsn>.csv as rockblock.py writes
+
+usage:
+    python syntheticArchive.py 2023 <rawDir> [nSerials] [days] [interval s]
+    python syntheticArchive.py legacy <dataDir> [nSerials] [days] [interval s]
+"""
+import os
+import sys
+import csv
+import struct
+import ctypes as ct
+from datetime import datetime, timezone
+import numpy as np
+
+nRecords = 3
+legacyRecords = 3
+legacyDtype = np.dtype([('time','<u4'),('pressure','<u4'),('ambient','<u2'),
+                        ('backscatter','<u2'),('temp','<i2')])
+startTime = 1672531200 #2023-01-01
+
+
+def simulate(n, interval=600, t0=startTime, seed=0):
+    """
+    n records of plausible sensor values, in the decoded 2023 field units
+    (waterPressure Pa, waterTemp/airTemp 0.1 C, baroAnomaly Pa,
+    batteryVoltage 0.1 V).
+    """
+    rng = np.random.default_rng(seed)
+    day = np.arange(n)*interval/86400
+    jitter = rng.integers(-2, 3, n)
+    logtime = t0 + np.arange(n)*interval + jitter
+    stage = 1.5 + 0.8*np.sin(2*np.pi*day/365) + 0.1*np.sin(2*np.pi*day/0.52)
+    baro = np.round(1500*np.sin(2*np.pi*day/4.3) + rng.normal(0, 30, n))
+    waterTemp = np.round(80 + 70*np.sin(2*np.pi*(day-100)/365) + rng.normal(0, 2, n))
+    airTemp = np.round(waterTemp + 60*np.sin(2*np.pi*day) + rng.normal(0, 10, n))
+    waterPressure = np.round(1E5 + baro + stage*9806.65)
+    background = rng.integers(5, 60, n)
+    backscatter = np.clip(np.round(4000 + 1500*rng.gamma(1.5, 1, n)), 0, 65535)
+    battery = np.round(135 - 15*((day % 60)/60) + rng.normal(0, 1, n))
+    return {'logtime': logtime.astype(np.uint32),
+            'tuBackground': background.astype(np.uint32),
+            'tuBackscatter': backscatter.astype(np.uint32),
+            'waterPressure': np.clip(waterPressure, 0, (1<<21)-1).astype(np.uint32),
+            'waterTemp': np.clip(waterTemp, -1024, 1023).astype(np.int32),
+            'baroAnomaly': np.clip(baro, -8192, 8191).astype(np.int32),
+            'airTemp': np.clip(airTemp, -512, 511).astype(np.int32),
+            'batteryVoltage': np.clip(battery, 0, 255).astype(np.uint32)}
+
+
+def packRecords(rec):
+    """Bit-pack records into single_record_t layout, 16 bytes each."""
+    def bits(v, width):
+        return np.asarray(v).astype(np.int64).astype(np.uint32) & np.uint32((1 << width) - 1)
+    n = len(rec['logtime'])
+    words = np.empty((n, 4), dtype='<u4')
+    words[:, 0] = rec['logtime']
+    words[:, 1] = bits(rec['tuBackground'], 16) | bits(rec['tuBackscatter'], 16) << np.uint32(16)
+    words[:, 2] = bits(rec['waterPressure'], 21) | bits(rec['waterTemp'], 11) << np.uint32(21)
+    words[:, 3] = (bits(rec['baroAnomaly'], 14) | bits(rec['airTemp'], 10) << np.uint32(14)
+                   | bits(rec['batteryVoltage'], 8) << np.uint32(24))
+    return words.tobytes()
+
+
+class single_record(ct.LittleEndianStructure):
+    #same ctypes layout as scripts/bitFieldUnpack.py, used to check packRecords
+    _fields_ = [("logtime", ct.c_uint32, 32),
+                ("tuBackground", ct.c_uint32, 16),
+                ("tuBackscatter", ct.c_uint32, 16),
+                ("waterPressure", ct. c_uint32, 21),
+                ("waterTemp",ct.c_int32, 11),
+                ("baroAnomaly",ct.c_int32,14),
+                ("airTemp",ct.c_int32,10),
+                ("batteryVoltage",ct.c_uint32,8)]
+
+
+def packRecordsCtypes(rec):
+    out = bytearray()
+    for i in range(len(rec['logtime'])):
+        r = single_record()
+        for f in single_record._fields_:
+            setattr(r, f[0], int(rec[f[0]][i]))
+        out += bytes(r)
+    return bytes(out)
+
+
+def packets2023(rec):
+    """Split packed records into 48 byte messages (drops a partial tail)."""
+    n = len(rec['logtime']) // nRecords * nRecords
+    raw = packRecords({k: v[:n] for k, v in rec.items()})
+    size = 16*nRecords
+    return [raw[i:i+size] for i in range(0, len(raw), size)]
+
+
+def packetsLegacy(rec):
+    """
+    Legacy messages: legacyRecords "<2L2Hh" records, the battery ADC count
+    over the first two bytes and two bytes of padding at the end.
+    """
+    n = len(rec['logtime']) // legacyRecords * legacyRecords
+    legacy = np.empty(n, legacyDtype)
+    legacy['time'] = rec['logtime'][:n]
+    legacy['pressure'] = rec['waterPressure'][:n] // 10      #bar*1E-4
+    legacy['ambient'] = rec['tuBackground'][:n]
+    legacy['backscatter'] = rec['tuBackscatter'][:n]
+    legacy['temp'] = rec['waterTemp'][:n] * 10               #C*1E-2
+    #the legacy loggers reported a ~4 V cell through a 5 V, 10 bit ADC
+    battery = np.round(rec['batteryVoltage'][:n:legacyRecords]/10*0.3/5*1023).astype('<u2')
+    size = legacyDtype.itemsize*legacyRecords
+    raw = legacy.tobytes()
+    out = []
+    for k, i in enumerate(range(0, len(raw), size)):
+        out.append(battery[k].tobytes() + raw[i+2:i+size] + b'\x00\x00')
+    return out
+
+
+def receiveStrings(packetTimes, delay=120):
+    return [datetime.fromtimestamp(int(t)+delay, timezone.utc).strftime('%Y%m%d%H%M%S')
+            for t in packetTimes]
+
+
+def serialNumbers(nSerials):
+    return [300434060000 + 1000*i for i in range(nSerials)]
+
+
+def write2023(rawDir, nSerials=3, days=365, interval=600):
+    nFiles = 0
+    for k, sn in enumerate(serialNumbers(nSerials)):
+        rec = simulate(int(days*86400/interval), interval, seed=k)
+        packets = packets2023(rec)
+        names = receiveStrings(rec['logtime'][nRecords-1::nRecords])
+        snDir = os.path.join(rawDir, str(sn))
+        os.makedirs(snDir, exist_ok=True)
+        for momsn, (name, p) in enumerate(zip(names, packets)):
+            with open(os.path.join(snDir, name + '.csv'), 'w') as file:
+                file.write(f"imei: {sn}\nserial: {sn}\nmomsn: {momsn}\n"
+                           f"transmit time: {name}\nlatitude: 64.8\nlongitude: -147.7\n"
+                           f"{p.hex().upper()}\n")
+            nFiles += 1
+    return nFiles
+
+
+def writeLegacy(dataDir, nSerials=3, days=365, interval=600):
+    labels = ["UnixTime","Pressure[bar_1E-4]","Ambient[DN]","Backscatter[DN]","WaterTemp[C_1E-2]"]
+    nFiles = 0
+    for k, sn in enumerate(serialNumbers(nSerials)):
+        rec = simulate(int(days*86400/interval), interval, seed=k)
+        packets = packetsLegacy(rec)
+        names = receiveStrings(rec['logtime'][legacyRecords-1::legacyRecords])
+        snDir = os.path.join(dataDir, str(sn))
+        os.makedirs(snDir, exist_ok=True)
+        for momsn, (name, p) in enumerate(zip(names, packets)):
+            #same decode and file shape as rockblock.py
+            batteryVolts = (p[1]<<8 | p[0]) / 1023 * 5
+            records = [list(r) for r in struct.iter_unpack("<2L2Hh", p[:-2])]
+            records[0][0] = records[1][0] - (records[2][0]-records[1][0])
+            with open(os.path.join(snDir, f"{name}_{momsn}.csv"), 'w') as file:
+                write = csv.writer(file)
+                write.writerow([f"imei: {sn}"])
+                write.writerow([f"serial: {sn}"])
+                write.writerow([f"transmit time: {name}"])
+                write.writerow(["latitude: 64.8"])
+                write.writerow(["longitude: -147.7"])
+                write.writerow(["cep: 3"])
+                write.writerow([f"battery: {batteryVolts}"])
+                write.writerow(labels)
+                write.writerows(records)
+            nFiles += 1
+    return nFiles
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('2023', 'legacy'):
+        sys.exit(__doc__)
+    args = [int(a) for a in sys.argv[3:6]]
+    if sys.argv[1] == '2023':
+        n = write2023(sys.argv[2], *args)
+    else:
+        n = writeLegacy(sys.argv[2], *args)
+    print(f"wrote {n} transmissions to {sys.argv[2]}")
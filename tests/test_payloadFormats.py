@@ -0,0 +1,46 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_backend', 'data'))
+import deltaCodec
+import payloadFormats
+
+
+def records(n):
+    t = np.arange(n)
+    return {'logtime': (1672531200 + 600*t).astype(np.uint32),
+            'tuBackground': (20 + t % 3).astype(np.uint32),
+            'tuBackscatter': (4000 + 37*t % 500).astype(np.uint32),
+            'waterPressure': (115000 + t).astype(np.uint32),
+            'waterTemp': (80 - t % 5).astype(np.int32),
+            'baroAnomaly': (t % 7 - 3).astype(np.int32),
+            'airTemp': (60 + t % 11).astype(np.int32),
+            'batteryVoltage': np.full(n, 130, np.uint32)}
+
+
+def test_corrupt_delta_payloads_are_unrecognized():
+    rec = records(40)
+    good, used = deltaCodec.encode(rec)
+    assert used > 1
+    #header claims more records than the bit stream holds
+    truncated = good[:1] + bytes([255]) + good[2:]
+    #a varint that never ends
+    garbage = bytes([deltaCodec.version, 3]) + b'\xff'*(deltaCodec.nBytes - 2)
+    empty = bytes([deltaCodec.version, 0]) + bytes(deltaCodec.nBytes - 2)
+
+    groups, counts = payloadFormats.decodeBatch([truncated, good, garbage, empty])
+    assert counts['2023-delta-v1'] == 1
+    assert counts['unrecognized'] == 3
+    (name, cols), = groups
+    assert name == '2023-delta-v1'
+    assert np.all(cols['packet'] == 1)
+    assert np.array_equal(cols['logtime'], rec['logtime'][:used])
+
+
+def test_fuzzed_delta_payloads_never_raise():
+    rng = np.random.default_rng(0)
+    payloads = [bytes([deltaCodec.version]) + rng.integers(0, 256, deltaCodec.nBytes - 1, np.uint8).tobytes()
+                for i in range(500)]
+    groups, counts = payloadFormats.decodeBatch(payloads)
+    assert counts['2023-delta-v1'] + counts['unrecognized'] == len(payloads)
@@ -0,0 +1,47 @@
+import os
+import sys
+import json
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_backend', 'data'))
+import seriesStore
+
+
+def writeOldLayout(storeDir, sn, t):
+    #the first store layout: segments named 000000, 000001, ... with no
+    #partition, and no qc column
+    columns = {c: dt for c, dt in seriesStore.schema.items() if c != 'qc'}
+    path = os.path.join(storeDir, sn)
+    segments = []
+    for k, part in enumerate(np.array_split(t, 2)):
+        name = f"{k:06d}"
+        os.makedirs(os.path.join(path, name))
+        for c, dt in columns.items():
+            v = part if c == 'time' else np.arange(len(part))
+            v.astype(dt).tofile(os.path.join(path, name, c + '.bin'))
+        segments.append({'name': name, 'rows': len(part), 'tmin': int(part.min()), 'tmax': int(part.max())})
+    with open(os.path.join(path, 'index.json'), 'w') as file:
+        json.dump({'columns': columns, 'segments': segments}, file)
+
+
+def test_compact_old_layout(tmp_path):
+    day = 86400
+    t = np.arange(1672531200, 1672531200 + 90*day, 3600)  #Jan to Mar 2023
+    #repeats inside and across the old segments
+    old = np.concatenate([t, t[:5], t[-5:]])
+    writeOldLayout(str(tmp_path), '209175', old)
+
+    store = seriesStore.SeriesStore(str(tmp_path), '209175')
+    #new records after the upgrade go to partitions, two of them repeats
+    new = np.concatenate([t[-1:] + 3600*np.arange(1, 4), t[100:102]])
+    store.append({c: new if c == 'time' else np.zeros(len(new)) for c in store.columns})
+
+    assert store.compact() == 12
+    store = seriesStore.SeriesStore(str(tmp_path), '209175')
+    d = store.load(['time', 'backscatter'])
+    times = d['time'].astype('int64')
+    assert np.array_equal(times, np.concatenate([t, t[-1:] + 3600*np.arange(1, 4)]))
+    #first copies kept, which for the old records is their value there
+    assert np.array_equal(d['backscatter'][:len(t)//2], np.arange(len(t)//2))
+    assert all('partition' in s for s in store.index['segments'])
+    assert store.compact() == 0